@@ -0,0 +1,296 @@
+"""
+Low-precision closed-form Sun and Moon positions.
+
+The Sun uses the NOAA / Meeus chapter 25 solar equations and the Moon a
+truncated Meeus chapter 47 lunar series. Rise and set times agree with the
+JPL ephemeris to well under a minute outside the polar regions, which is all
+a clock showing HH:MM needs, and nothing here touches ``de421.bsp``.
+
+All functions take Unix timestamps (float or NumPy array) in UTC.
+"""
+
+import numpy as np
+
+# TT - UTC in seconds (32.184 + 37 leap seconds since 2017)
+TT_MINUS_UTC = 69.184
+
+EARTH_RADIUS_KM = 6378.14
+
+# Horizons used by skyfield's sunrise_sunset() and, for the Moon,
+# risings_and_settings() with a 0.25 degree radius
+SUN_HORIZON_DEGREES = -0.8333
+MOON_HORIZON_DEGREES = -34.0 / 60.0 - 0.25
+
+# Periodic terms for the Moon's longitude and distance (Meeus table 47.A):
+# multiples of D, M, M', F, then sine coefficient for longitude (1e-6 degrees)
+# and cosine coefficient for distance (1e-3 km)
+MOON_LONGITUDE_TERMS = np.array(
+    [
+        (0, 0, 1, 0, 6288774, -20905355),
+        (2, 0, -1, 0, 1274027, -3699111),
+        (2, 0, 0, 0, 658314, -2955968),
+        (0, 0, 2, 0, 213618, -569925),
+        (0, 1, 0, 0, -185116, 48888),
+        (0, 0, 0, 2, -114332, -3149),
+        (2, 0, -2, 0, 58793, 246158),
+        (2, -1, -1, 0, 57066, -152138),
+        (2, 0, 1, 0, 53322, -170733),
+        (2, -1, 0, 0, 45758, -204586),
+        (0, 1, -1, 0, -40923, -129620),
+        (1, 0, 0, 0, -34720, 108743),
+        (0, 1, 1, 0, -30383, 104755),
+        (2, 0, 0, -2, 15327, 10321),
+        (0, 0, 1, 2, -12528, 0),
+        (0, 0, 1, -2, 10980, 79661),
+        (4, 0, -1, 0, 10675, -34782),
+        (0, 0, 3, 0, 10034, -23210),
+        (4, 0, -2, 0, 8548, -21636),
+        (2, 1, -1, 0, -7888, 24208),
+        (2, 1, 0, 0, -6766, 30824),
+        (1, 0, -1, 0, -5163, -8379),
+        (1, 1, 0, 0, 4987, -16675),
+        (2, -1, 1, 0, 4036, -12831),
+        (2, 0, 2, 0, 3994, -10445),
+        (4, 0, 0, 0, 3861, -11650),
+        (2, 0, -3, 0, 3665, 14403),
+        (0, 1, -2, 0, -2689, -7003),
+        (2, 0, -1, 2, -2602, 0),
+        (2, -1, -2, 0, 2390, 10056),
+        (1, 0, 1, 0, -2348, 6322),
+        (2, -2, 0, 0, 2236, -9884),
+    ],
+    dtype=float,
+)
+
+# Periodic terms for the Moon's latitude (Meeus table 47.B): multiples of
+# D, M, M', F, then sine coefficient (1e-6 degrees)
+MOON_LATITUDE_TERMS = np.array(
+    [
+        (0, 0, 0, 1, 5128122),
+        (0, 0, 1, 1, 280602),
+        (0, 0, 1, -1, 277693),
+        (2, 0, 0, -1, 173237),
+        (2, 0, -1, 1, 55413),
+        (2, 0, -1, -1, 46271),
+        (2, 0, 0, 1, 32573),
+        (0, 0, 2, 1, 17198),
+        (2, 0, 1, -1, 9266),
+        (0, 0, 2, -1, 8822),
+        (2, -1, 0, -1, 8216),
+        (2, 0, -2, -1, 4324),
+        (2, 0, 1, 1, 4200),
+        (2, 1, 0, -1, -3359),
+        (2, -1, -1, 1, 2463),
+        (2, -1, 0, 1, 2211),
+        (2, -1, -1, -1, 2065),
+        (0, 1, -1, -1, -1870),
+        (4, 0, -1, -1, 1828),
+        (0, 1, 0, 1, -1794),
+    ],
+    dtype=float,
+)
+
+
+def julian_centuries(timestamp):
+    """Julian centuries of TT since J2000.0."""
+    return (timestamp + TT_MINUS_UTC - 946728000.0) / (86400.0 * 36525.0)
+
+
+def greenwich_sidereal_degrees(timestamp):
+    """Greenwich mean sidereal time in degrees (Meeus 12.4)."""
+    days = (timestamp - 946728000.0) / 86400.0
+    centuries = days / 36525.0
+    return (
+        280.46061837
+        + 360.98564736629 * days
+        + 0.000387933 * centuries**2
+        - centuries**3 / 38710000.0
+    ) % 360.0
+
+
+def _obliquity_degrees(centuries):
+    omega = np.radians(125.04 - 1934.136 * centuries)
+    return 23.439291 - 0.0130042 * centuries + 0.00256 * np.cos(omega)
+
+
+def sun_ecliptic_longitude(timestamp):
+    """Apparent ecliptic longitude of the Sun in degrees."""
+    centuries = julian_centuries(timestamp)
+    mean_longitude = 280.46646 + 36000.76983 * centuries + 0.0003032 * centuries**2
+    anomaly = np.radians(357.52911 + 35999.05029 * centuries)
+    center = (
+        (1.914602 - 0.004817 * centuries) * np.sin(anomaly)
+        + (0.019993 - 0.000101 * centuries) * np.sin(2 * anomaly)
+        + 0.000289 * np.sin(3 * anomaly)
+    )
+    omega = np.radians(125.04 - 1934.136 * centuries)
+    return (mean_longitude + center - 0.00569 - 0.00478 * np.sin(omega)) % 360.0
+
+
+def moon_ecliptic_position(timestamp):
+    """
+    Apparent geocentric ecliptic position of the Moon.
+
+    Returns a tuple of (longitude_degrees, latitude_degrees, distance_km).
+    """
+    centuries = julian_centuries(timestamp)
+    mean_longitude = 218.3164477 + 481267.88123421 * centuries
+    elongation = 297.8501921 + 445267.1114034 * centuries
+    sun_anomaly = 357.5291092 + 35999.0502909 * centuries
+    moon_anomaly = 134.9633964 + 477198.8675055 * centuries
+    node_distance = 93.2720950 + 483202.0175233 * centuries
+    a1 = np.radians(119.75 + 131.849 * centuries)
+    a2 = np.radians(53.09 + 479264.290 * centuries)
+    a3 = np.radians(313.45 + 481266.484 * centuries)
+    eccentricity = 1 - 0.002516 * centuries - 0.0000074 * centuries**2
+
+    arguments = np.radians(
+        np.stack(
+            np.broadcast_arrays(elongation, sun_anomaly, moon_anomaly, node_distance),
+            axis=-1,
+        )
+    )
+
+    longitude_arguments = arguments @ MOON_LONGITUDE_TERMS[:, :4].T
+    longitude_scale = eccentricity[..., np.newaxis] ** np.abs(
+        MOON_LONGITUDE_TERMS[:, 1]
+    )
+    sum_longitude = np.sum(
+        MOON_LONGITUDE_TERMS[:, 4] * longitude_scale * np.sin(longitude_arguments),
+        axis=-1,
+    )
+    sum_distance = np.sum(
+        MOON_LONGITUDE_TERMS[:, 5] * longitude_scale * np.cos(longitude_arguments),
+        axis=-1,
+    )
+
+    latitude_arguments = arguments @ MOON_LATITUDE_TERMS[:, :4].T
+    latitude_scale = eccentricity[..., np.newaxis] ** np.abs(MOON_LATITUDE_TERMS[:, 1])
+    sum_latitude = np.sum(
+        MOON_LATITUDE_TERMS[:, 4] * latitude_scale * np.sin(latitude_arguments),
+        axis=-1,
+    )
+
+    mean_longitude_radians = np.radians(mean_longitude)
+    node_distance_radians = np.radians(node_distance)
+    sum_longitude += (
+        3958 * np.sin(a1)
+        + 1962 * np.sin(mean_longitude_radians - node_distance_radians)
+        + 318 * np.sin(a2)
+    )
+    sum_latitude += (
+        -2235 * np.sin(mean_longitude_radians)
+        + 382 * np.sin(a3)
+        + 175 * np.sin(a1 - node_distance_radians)
+        + 175 * np.sin(a1 + node_distance_radians)
+        + 127 * np.sin(mean_longitude_radians - np.radians(moon_anomaly))
+        - 115 * np.sin(mean_longitude_radians + np.radians(moon_anomaly))
+    )
+
+    # Nutation in longitude, main term only
+    omega = np.radians(125.04452 - 1934.136261 * centuries)
+    nutation = -17.2 / 3600.0 * np.sin(omega)
+
+    longitude = (mean_longitude + sum_longitude / 1e6 + nutation) % 360.0
+    latitude = sum_latitude / 1e6
+    distance = 385000.56 + sum_distance / 1000.0
+    return longitude, latitude, distance
+
+
+def _altitude_degrees(
+    timestamp, longitude, latitude, observer_latitude, observer_longitude
+):
+    """Altitude of a body at ecliptic (longitude, latitude) for an observer."""
+    centuries = julian_centuries(timestamp)
+    obliquity = np.radians(_obliquity_degrees(centuries))
+    longitude = np.radians(longitude)
+    latitude = np.radians(latitude)
+
+    right_ascension = np.arctan2(
+        np.sin(longitude) * np.cos(obliquity) - np.tan(latitude) * np.sin(obliquity),
+        np.cos(longitude),
+    )
+    declination = np.arcsin(
+        np.sin(latitude) * np.cos(obliquity)
+        + np.cos(latitude) * np.sin(obliquity) * np.sin(longitude)
+    )
+    hour_angle = (
+        np.radians(greenwich_sidereal_degrees(timestamp) + observer_longitude)
+        - right_ascension
+    )
+    phi = np.radians(observer_latitude)
+    return np.degrees(
+        np.arcsin(
+            np.sin(phi) * np.sin(declination)
+            + np.cos(phi) * np.cos(declination) * np.cos(hour_angle)
+        )
+    )
+
+
+def sun_altitude(timestamp, latitude, longitude):
+    """Altitude of the Sun's centre in degrees, without refraction."""
+    timestamp = np.asarray(timestamp, dtype=float)
+    return _altitude_degrees(
+        timestamp, sun_ecliptic_longitude(timestamp), 0.0, latitude, longitude
+    )
+
+
+def moon_altitude(timestamp, latitude, longitude):
+    """Topocentric altitude of the Moon's centre in degrees, without
+    refraction."""
+    timestamp = np.asarray(timestamp, dtype=float)
+    moon_longitude, moon_latitude, distance = moon_ecliptic_position(timestamp)
+    altitude = _altitude_degrees(
+        timestamp, moon_longitude, moon_latitude, latitude, longitude
+    )
+    parallax = np.degrees(np.arcsin(EARTH_RADIUS_KM / distance))
+    return altitude - parallax * np.cos(np.radians(altitude))
+
+
+def moon_phase(timestamp):
+    """Moon phase 0-360 degrees, where 180 is Full Moon, matching
+    ``almanac.moon_phase``."""
+    timestamp = np.asarray(timestamp, dtype=float)
+    moon_longitude, _, _ = moon_ecliptic_position(timestamp)
+    return (moon_longitude - sun_ecliptic_longitude(timestamp)) % 360.0
+
+
+def find_risings_and_settings(altitude, horizon, start, end, step=1800.0, iterations=5):
+    """
+    Find when ``altitude(timestamps)`` crosses ``horizon`` between ``start``
+    and ``end``.
+
+    The altitude is sampled every ``step`` seconds, then each crossing is
+    refined with a few vectorised secant steps, which converge to well under
+    a second because altitude is smooth over one step. A rise and
+    set closer together than ``step`` can be missed, which only happens at
+    grazing polar events.
+
+    Returns a tuple of (times, events, is_up) where:
+    - times: NumPy array of crossing timestamps
+    - events: NumPy array of bools, True for a rising
+    - is_up: Whether the body is above the horizon at ``start``
+    """
+    samples = np.append(np.arange(start, end, step), end)
+    heights = altitude(samples) - horizon
+    is_up = heights > 0
+    crossings = np.flatnonzero(is_up[1:] != is_up[:-1])
+
+    low, high = samples[crossings], samples[crossings + 1]
+    previous, previous_height = low, heights[crossings]
+    times, height = high, heights[crossings + 1]
+    for _ in range(iterations):
+        if not len(times):
+            break
+        change = height - previous_height
+        correction = np.divide(
+            height * (times - previous),
+            change,
+            out=np.zeros_like(change),
+            where=change != 0,
+        )
+        previous, previous_height = times, height
+        times = np.clip(times - correction, low, high)
+        height = altitude(times) - horizon
+
+    return times, is_up[crossings + 1], bool(is_up[0])
@@ -1,22 +1,104 @@
+import atexit
+import bisect
+import collections
 import colorsys
+import concurrent.futures
 import datetime
+import functools
+import json
+import math
 import os
 import secrets
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import struct
+import threading
+import time
+from typing import NamedTuple
+from zoneinfo import TZPATH, ZoneInfo, ZoneInfoNotFoundError
 
-from flask import Flask, abort, g, request
-from skyfield import almanac
-from skyfield.api import load, wgs84
+from flask import Flask, Response, abort, g, request
+
+import device_registry
+import metrics
+import profiling
+import shared_cache
+import snapshot
 
 app = Flask(__name__)
 
-EPH = load("de421.bsp")
+# "full" serves every route. "time" serves only /time and /metrics, for
+# nodes that never import skyfield or numpy nor load the ephemeris.
+SERVICE_PROFILES = ("full", "time")
+SERVICE_PROFILE = os.getenv("SERVICE_PROFILE", "full")
+if SERVICE_PROFILE not in SERVICE_PROFILES:
+    raise ValueError(
+        "SERVICE_PROFILE must be one of %s, not %r"
+        % (", ".join(SERVICE_PROFILES), SERVICE_PROFILE)
+    )
+
+
+def load_once(func):
+    """
+    Cache the result of a loader taking no arguments, like
+    ``functools.cache``, but hold a lock while it runs, so threads asking
+    for it at the same time wait for one load instead of each running their
+    own.
+    """
+    lock = threading.Lock()
+    loaded = []
+
+    @functools.wraps(func)
+    def wrapper():
+        if not loaded:
+            with lock:
+                if not loaded:
+                    loaded.append(func())
+        return loaded[0]
+
+    return wrapper
+
+
+# skyfield, numpy and the ephemeris are only imported and loaded by the first
+# astronomy request (or preload_shared_state), so /time starts fast and small.
+@load_once
+def get_ephemeris():
+    from skyfield.api import load
+
+    ephemeris = load(os.getenv("EPHEMERIS_FILE", "de421.bsp"))
+    # jplephem maps a segment's coefficients on its first use. Map them all
+    # now, so threads can't each map their own copy.
+    for segment in ephemeris.segments:
+        segment.spk_segment.compute(segment.spk_segment.start_jd)
+    return ephemeris
+
+
+@load_once
+def get_timescale():
+    from skyfield.api import load
+
+    return load.timescale()
+
+
+def __getattr__(name: str):
+    # EPH and TS were loaded at import before they were lazy
+    if name == "EPH":
+        return get_ephemeris()
+    if name == "TS":
+        return get_timescale()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 SUN_COLOR = 0x201000
 MOON_COLOR = 0x001020
 
 MOON_RADIUS_DEGREES = 0.25
 
+# Events are always known at least this far ahead of a lookup
+ALMANAC_SEARCH_DAYS = 1.5
+# How far past that a timeline is extended, so it's extended about once a day
+TIMELINE_EXTEND_DAYS = 1.0
+# Locations are snapped to a grid of this size before almanac lookups
+ALMANAC_GRID_DEGREES = float(os.getenv("ALMANAC_GRID_DEGREES", "0.05"))
+
 MOTD_OPTIONS = [
     "Hello",
     ":)",
@@ -59,80 +141,967 @@ def get_rand_color():
     return color
 
 
-def get_next_sun_event(event_index=0):
-    now = datetime.datetime.now(g.tzinfo)
-    now_plus = now + datetime.timedelta(days=1.5)
+class BodyEvents(NamedTuple):
+    """Rise/set events for one body at one location, valid from ``start``
+    until ``expires``."""
+
+    start: float
+    expires: float
+    times: tuple[float, ...]
+    events: tuple[bool, ...]
+    is_up: bool
+
+
+class EventTimeline(NamedTuple):
+    """
+    Sorted rise/set events of one body at one location from ``start`` to
+    ``end``, and whether it is up at ``start``.
+
+    The next event, the one after and whether the body is up at any time in
+    the window all come from one binary search. A timeline running short is
+    extended by searching only past its ``end``.
+    """
+
+    start: float
+    end: float
+    times: tuple[float, ...]
+    events: tuple[bool, ...]
+    is_up: bool
+
+    def covers(self, now: float, days: float = ALMANAC_SEARCH_DAYS) -> bool:
+        """Whether every event from ``now`` to ``days`` later is known."""
+        return self.start <= now and now + days * 24 * 3600 <= self.end
+
+    def at(self, now: float) -> BodyEvents:
+        """The events after ``now``, valid until the first of them."""
+        index = bisect.bisect_right(self.times, now)
+        times = self.times[index:]
+        events = self.events[index:]
+        if events:
+            # Up if it sets next, down if it rises next
+            is_up = not events[0]
+        elif index:
+            is_up = self.events[index - 1]
+        else:
+            is_up = self.is_up
+        return BodyEvents(
+            start=self.times[index - 1] if index else self.start,
+            expires=times[0] if times else self.end,
+            times=times,
+            events=events,
+            is_up=is_up,
+        )
+
+    def extend(self, search: BodyEvents, end: float, now: float) -> "EventTimeline":
+        """
+        Add the events of ``search``, which starts at this timeline's end and
+        runs to ``end``, dropping the events up to ``now``.
+        """
+        current = self.at(now)
+        return EventTimeline(
+            start=max(now, self.start),
+            end=end,
+            times=current.times + search.times,
+            events=current.events + search.events,
+            is_up=current.is_up,
+        )
+
+
+class AlmanacCache:
+    """
+    Bounded LRU cache of ``EventTimeline`` keyed by (body, latitude,
+    longitude).
+
+    Timelines are only returned while they cover ALMANAC_SEARCH_DAYS from the
+    lookup time, so a cached timeline never hides an event a fresh search
+    would find.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[tuple, EventTimeline] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: tuple, now: float) -> EventTimeline | None:
+        with self._lock:
+            timeline = self._entries.get(key)
+            if timeline is None or not timeline.covers(now):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return timeline
+
+    def peek(self, key: tuple, now: float | None = None) -> EventTimeline | None:
+        """The timeline for ``key``, however far it runs, without touching
+        the LRU order or hit counts. ``now`` is only used by
+        ``SharedAlmanacCache``."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: tuple, timeline: EventTimeline):
+        with self._lock:
+            self._entries[key] = timeline
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def items(self) -> list[tuple[tuple, EventTimeline]]:
+        with self._lock:
+            return list(self._entries.items())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class SharedAlmanacCache:
+    """
+    ``AlmanacCache`` backed by a ``shared_cache.SharedCache``, so every worker
+    reads the timelines any of them searched or extended.
+
+    Each worker also keeps the ``local_size`` timelines it used most
+    recently in a small local ``AlmanacCache``, so a warm lookup for an
+    active location doesn't touch the database. The database is read when
+    the local timeline is missing or doesn't cover the lookup, and every
+    timeline put is written to both. Timelines don't change once searched,
+    so a local copy is never wrong, only perhaps shorter than the shared
+    one. ``max_size`` only bounds the locations the warmer tracks.
+
+    ``hits`` and ``misses`` count this process's lookups.
+    """
+
+    TABLE = "timelines"
 
-    ts = load.timescale()
-    t_now = ts.from_datetime(now)
-    t_now_plus = ts.from_datetime(now_plus)
+    def __init__(
+        self, shared: shared_cache.SharedCache, max_size: int, local_size: int = 32
+    ):
+        self.shared = shared
+        self.max_size = max_size
+        self.local = AlmanacCache(local_size)
+        self.hits = 0
+        self.misses = 0
 
-    get_sun_up = almanac.sunrise_sunset(EPH, g.location)
-    times, events = almanac.find_discrete(t_now, t_now_plus, get_sun_up)
+    def __len__(self):
+        return self.shared.count(self.TABLE)
 
-    sun_event_str = "SR" if events[event_index] else "SS"
-    sun_event_time = times[event_index].astimezone(g.tzinfo) + datetime.timedelta(
-        seconds=30
+    @staticmethod
+    def _key(key: tuple) -> str:
+        return "%s,%r,%r" % key
+
+    def get(self, key: tuple, now: float) -> EventTimeline | None:
+        timeline = self.local.get(key, now)
+        if timeline is None:
+            timeline = self._get_shared(key, now, self.local.peek(key))
+        if timeline is None or not timeline.covers(now):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return timeline
+
+    def peek(self, key: tuple, now: float | None = None) -> EventTimeline | None:
+        """The timeline for ``key``, however far it runs, without touching
+        the hit counts. The database is only read if the local timeline is
+        missing or doesn't cover ALMANAC_SEARCH_DAYS from ``now``, by default
+        the current time, so a warmer looking ahead finds an extension
+        another worker already wrote."""
+        timeline = self.local.peek(key)
+        if timeline is not None and timeline.covers(
+            time.time() if now is None else now
+        ):
+            return timeline
+        return self._get_shared(key, -math.inf, timeline)
+
+    def _get_shared(
+        self, key: tuple, now: float, local: EventTimeline | None
+    ) -> EventTimeline | None:
+        """The shared timeline for ``key``, kept locally if it runs past
+        ``local``, or else ``local``."""
+        record = self.shared.get(self.TABLE, self._key(key), now)
+        if record is None:
+            return local
+        timeline = EventTimeline(*shared_cache.unpack_timeline(record))
+        if local is not None and local.end >= timeline.end:
+            return local
+        self.local.put(key, timeline)
+        return timeline
+
+    def put(self, key: tuple, timeline: EventTimeline):
+        record = shared_cache.pack_timeline(*timeline)
+        # Ends sooner if it had to be cut short
+        timeline = EventTimeline(*shared_cache.unpack_timeline(record))
+        self.local.put(key, timeline)
+        self.shared.put(self.TABLE, self._key(key), record, timeline.end)
+
+    def items(self) -> list[tuple[tuple, EventTimeline]]:
+        items = []
+        for key, record in self.shared.records(self.TABLE, time.time()):
+            body, latitude, longitude = key.split(",")
+            timeline = EventTimeline(*shared_cache.unpack_timeline(record))
+            items.append(((body, float(latitude), float(longitude)), timeline))
+        return items
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear(self.TABLE)
+        self.hits = 0
+        self.misses = 0
+
+
+# With SHARED_CACHE set to a database path, almanac timelines and DST tables
+# are shared by every worker on the host (see SHARED_CACHE.md).
+SHARED_CACHE = shared_cache.SharedCache(os.getenv("SHARED_CACHE", ""))
+
+ALMANAC_CACHE_SIZE = int(os.getenv("ALMANAC_CACHE_SIZE", "256"))
+# Timelines each worker keeps in memory in front of SHARED_CACHE
+SHARED_CACHE_LOCAL_SIZE = int(os.getenv("SHARED_CACHE_LOCAL_SIZE", "32"))
+ALMANAC_CACHE = (
+    SharedAlmanacCache(SHARED_CACHE, ALMANAC_CACHE_SIZE, SHARED_CACHE_LOCAL_SIZE)
+    if SHARED_CACHE.enabled
+    else AlmanacCache(ALMANAC_CACHE_SIZE)
+)
+
+
+def snap_location(latitude: float, longitude: float) -> tuple[float, float]:
+    """
+    Snap a location to the centre of its ALMANAC_GRID_DEGREES grid cell.
+
+    Nearby devices then share one cached almanac. See ALMANAC_CACHE.md for
+    the worst-case error in minutes this introduces.
+    """
+    return (
+        round(
+            (math.floor(latitude / ALMANAC_GRID_DEGREES) + 0.5) * ALMANAC_GRID_DEGREES,
+            6,
+        ),
+        round(
+            (math.floor(longitude / ALMANAC_GRID_DEGREES) + 0.5) * ALMANAC_GRID_DEGREES,
+            6,
+        ),
     )
-    return "%s %02d:%02d" % (sun_event_str, sun_event_time.hour, sun_event_time.minute)
 
 
-def get_next_moon_event(event_index=0):
-    now = datetime.datetime.now(g.tzinfo)
-    now_plus = now + datetime.timedelta(days=1.5)
+def make_body_events(start: float, end: float, times, events, is_up) -> BodyEvents:
+    """
+    Build ``BodyEvents`` for a search from ``start`` to ``end``.
+
+    The result expires at the first event found, or at the end of the search
+    window if the body neither rises nor sets in it.
+    """
+    timestamps = tuple(float(timestamp) for timestamp in times)
+    return BodyEvents(
+        start=start,
+        expires=timestamps[0] if timestamps else end,
+        times=timestamps,
+        events=tuple(bool(event) for event in events),
+        is_up=bool(is_up),
+    )
+
+
+class SkyfieldEngine:
+    """Rise/set searches and moon phase from a JPL ephemeris, ``EPH`` by
+    default."""
+
+    def __init__(self, ephemeris=None):
+        self._ephemeris = ephemeris
+
+    @property
+    def ephemeris(self):
+        return get_ephemeris() if self._ephemeris is None else self._ephemeris
+
+    def get_rise_set_function(self, body: str, location):
+        from skyfield import almanac
 
-    ts = load.timescale()
-    t_now = ts.from_datetime(now)
-    t_now_plus = ts.from_datetime(now_plus)
+        if body == "sun":
+            return almanac.sunrise_sunset(self.ephemeris, location)
+        return almanac.risings_and_settings(
+            self.ephemeris,
+            self.ephemeris["moon"],
+            location,
+            radius_degrees=MOON_RADIUS_DEGREES,
+        )
+
+    def body_events(
+        self, body: str, astronomy, days: float = ALMANAC_SEARCH_DAYS
+    ) -> BodyEvents:
+        """
+        Search for rise/set events of ``body`` at the context's location over
+        the next ``days`` days.
+        """
+        from skyfield import almanac
+
+        t_start = astronomy.t_now
+        t_end = t_start + days
+
+        is_up = self.get_rise_set_function(body, astronomy.observer)
+        times, events = almanac.find_discrete(t_start, t_end, is_up)
+
+        return make_body_events(
+            t_start.utc_datetime().timestamp(),
+            t_end.utc_datetime().timestamp(),
+            (event_time.timestamp() for event_time in times.utc_datetime()),
+            events,
+            is_up(t_start),
+        )
+
+    def moon_phase(self, timestamps):
+        """Moon phase angles in degrees at an array of Unix timestamps."""
+        import numpy as np
+        from skyfield import almanac
+
+        # Unix time has no leap seconds, so counting seconds from 1970 would
+        # land 27 seconds late: count them from the start of each day instead
+        timestamps = np.asarray(timestamps, dtype=float)
+        days = np.floor(timestamps / (24 * 3600))
+        t = get_timescale().utc(1970, 1, 1 + days, 0, 0, timestamps - days * 24 * 3600)
+        return almanac.moon_phase(self.ephemeris, t).degrees
+
+
+class AnalyticEngine:
+    """
+    Closed-form rise/set times and moon phase from ``analytic_almanac``.
+
+    Runs in well under a millisecond without touching the ephemeris, and
+    agrees with ``SkyfieldEngine`` to within a minute outside the polar
+    regions (see ASTRONOMY_ENGINES.md).
+    """
+
+    def body_events(
+        self, body: str, astronomy, days: float = ALMANAC_SEARCH_DAYS
+    ) -> BodyEvents:
+        """
+        Search for rise/set events of ``body`` at the context's location over
+        the next ``days`` days.
+        """
+        import analytic_almanac
+
+        latitude, longitude = astronomy.location
+        start = astronomy.now.timestamp()
+        end = start + days * 24 * 3600
+
+        if body == "sun":
+            altitude = analytic_almanac.sun_altitude
+            horizon = analytic_almanac.SUN_HORIZON_DEGREES
+        else:
+            altitude = analytic_almanac.moon_altitude
+            horizon = analytic_almanac.MOON_HORIZON_DEGREES
+
+        times, events, is_up = analytic_almanac.find_risings_and_settings(
+            lambda timestamps: altitude(timestamps, latitude, longitude),
+            horizon,
+            start,
+            end,
+        )
+        return make_body_events(start, end, times, events, is_up)
+
+    def moon_phase(self, timestamps):
+        """Moon phase angles in degrees at an array of Unix timestamps."""
+        import analytic_almanac
+
+        return analytic_almanac.moon_phase(timestamps)
+
+
+ASTRONOMY_ENGINES = {"skyfield": SkyfieldEngine, "analytic": AnalyticEngine}
+
+ENGINE = ASTRONOMY_ENGINES[os.getenv("ASTRONOMY_ENGINE", "skyfield")]()
+
+
+def update_timeline(
+    cache: AlmanacCache,
+    body: str,
+    location: tuple[float, float],
+    now: float,
+    lookahead: float = 0.0,
+) -> EventTimeline:
+    """
+    Return the cached timeline of ``body`` at a snapped location, first
+    extending it if it doesn't cover ALMANAC_SEARCH_DAYS from ``lookahead``
+    seconds after ``now``.
 
-    get_moon_up = almanac.risings_and_settings(
-        EPH, EPH["moon"], g.location, radius_degrees=MOON_RADIUS_DEGREES
+    The extension searches only from the timeline's end to
+    TIMELINE_EXTEND_DAYS past what's needed, so it runs about once a day. A
+    missing timeline, or one ending before ``now``, is searched in full.
+    """
+    key = (body, *location)
+    timeline = cache.peek(key, now + lookahead)
+    if timeline is not None and timeline.covers(now + lookahead):
+        return timeline
+
+    end = now + lookahead + (ALMANAC_SEARCH_DAYS + TIMELINE_EXTEND_DAYS) * 24 * 3600
+    if timeline is None or not timeline.start <= now <= timeline.end:
+        timeline = None
+    start = now if timeline is None else timeline.end
+    search = ENGINE.body_events(
+        body,
+        AstronomyContext.at(
+            location, datetime.datetime.fromtimestamp(start, tz=datetime.UTC)
+        ),
+        days=(end - start) / (24 * 3600),
     )
-    times, events = almanac.find_discrete(t_now, t_now_plus, get_moon_up)
+    if timeline is None:
+        timeline = EventTimeline(start, end, search.times, search.events, search.is_up)
+    else:
+        timeline = timeline.extend(search, end, now)
+    cache.put(key, timeline)
+    return timeline
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers asking for a key whose
+    call is still running wait for it and get its result, or its exception,
+    and are counted in ``counter``.
+    """
+
+    class Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, counter):
+        self.counter = counter
+        self._lock = threading.Lock()
+        self._calls: dict[tuple, SingleFlight.Call] = {}
+
+    def do(self, key: tuple, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+        if not leader:
+            self.counter.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+# Requests for a timeline in the same minute share one search: the timeline it
+# returns covers ALMANAC_SEARCH_DAYS from any of them.
+ALMANAC_SEARCH_BUCKET_SECONDS = 60
+ALMANAC_SEARCHES = SingleFlight(metrics.COALESCED_SEARCHES)
+
+
+class AlmanacWarmer:
+    """
+    Background thread that keeps the almanac cache warm for recently seen
+    locations.
+
+    Every ``interval`` seconds it rebuilds the moon phase table if it is
+    about to run out, and extends each tracked location's sun and moon
+    timelines so they still cover ALMANAC_SEARCH_DAYS at the next pass.
+    Requests from active clients are then always answered from the cache.
+    Locations not seen for ``ttl`` seconds are dropped. With SNAPSHOT_FILE
+    set, a pass also saves the snapshot every SNAPSHOT_INTERVAL seconds.
+
+    Its searches, the timelines it extended before they ran short and the
+    lookups that would otherwise have missed are counted in ``metrics``.
+    """
+
+    def __init__(self, cache: AlmanacCache, interval: float, ttl: float):
+        self.cache = cache
+        self.interval = interval
+        self.ttl = ttl
+        self.last_refresh_seconds = None
+        self.last_snapshot = time.time()
+        self._lock = threading.Lock()
+        self._locations: collections.OrderedDict[tuple[float, float], float] = (
+            collections.OrderedDict()
+        )
+        # The end each timeline had before this warmer extended it, until a
+        # lookup it wouldn't have covered
+        self._extended: dict[tuple, float] = {}
+        self._thread = None
+
+    @property
+    def tracked_locations(self) -> int:
+        return len(self._locations)
+
+    def track(self, latitude: float, longitude: float):
+        """Record a snapped location as seen, starting the thread if needed."""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            self._locations[(latitude, longitude)] = time.time()
+            self._locations.move_to_end((latitude, longitude))
+            while len(self._locations) > self.cache.max_size // 2:
+                self._locations.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="almanac-warmer", daemon=True
+                )
+                self._thread.start()
+
+    def note_hit(self, key: tuple, now: float):
+        """Count a cache hit at ``now`` that ``key``'s timeline wouldn't
+        have covered before this warmer extended it."""
+        end = self._extended.get(key)
+        if (
+            end is not None
+            and now + ALMANAC_SEARCH_DAYS * 24 * 3600 > end
+            and self._extended.pop(key, None) is not None
+        ):
+            metrics.WARMER_MISSES_AVOIDED.inc()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                app.logger.exception("Almanac warm-up pass failed")
+
+    def refresh(self):
+        """Extend every location's timelines to last until the next pass."""
+        started = time.perf_counter()
+        now = time.time()
+        with self._lock:
+            while self._locations and next(iter(self._locations.values())) < (
+                now - self.ttl
+            ):
+                self._locations.popitem(last=False)
+            locations = list(self._locations)
+
+        MOON_PHASE_TABLE.refresh(now)
+        if SHARED_CACHE.enabled:
+            SHARED_CACHE.purge(now)
+        self._extended = {
+            key: end for key, end in self._extended.items() if key[1:] in locations
+        }
+        for location in locations:
+            for body in ("sun", "moon"):
+                key = (body, *location)
+                before = self.cache.peek(key, now + self.interval)
+                timeline = update_timeline(
+                    self.cache, body, location, now, self.interval
+                )
+                if timeline == before:
+                    continue
+                metrics.WARMER_SEARCHES.inc()
+                if before is not None and before.covers(now):
+                    metrics.WARMER_REFRESHES.inc()
+                    self._extended[key] = before.end
+
+        if SNAPSHOT_FILE and now - self.last_snapshot >= SNAPSHOT_INTERVAL:
+            save_snapshot(SNAPSHOT_FILE, now)
+            self.last_snapshot = now
+
+        self.last_refresh_seconds = time.perf_counter() - started
+        metrics.WARMER_TRACKED_LOCATIONS.set(len(locations))
+        metrics.WARMER_PASS_SECONDS.observe(self.last_refresh_seconds)
+        app.logger.debug(
+            "Almanac warm-up pass: %d locations in %.3fs",
+            len(locations),
+            self.last_refresh_seconds,
+        )
+
+
+ALMANAC_WARMER = AlmanacWarmer(
+    ALMANAC_CACHE,
+    interval=float(os.getenv("ALMANAC_WARMER_INTERVAL", "60")),
+    ttl=float(os.getenv("ALMANAC_WARMER_TTL", str(24 * 3600))),
+)
+
+
+class AstronomyContext:
+    """
+    Astronomy inputs for one request.
+
+    Each value is built the first time a helper asks for it and then shared
+    by every helper in the request, so the location header is only parsed,
+    and the ``Time`` and observer only created, when an endpoint needs them.
+    """
+
+    def __init__(
+        self, location_header: str | None, now: datetime.datetime | None = None
+    ):
+        self.location_header = location_header
+        self.now = now or datetime.datetime.now(datetime.UTC)
+
+    @classmethod
+    def at(cls, location: tuple[float, float], now: datetime.datetime):
+        """Build a context for an already snapped location, outside a request."""
+        astronomy = cls(None, now)
+        astronomy.location = location
+        return astronomy
+
+    @functools.cached_property
+    def t_now(self):
+        return get_timescale().from_datetime(self.now)
+
+    @functools.cached_property
+    def location(self) -> tuple[float, float]:
+        """The request location, snapped to the almanac grid."""
+        latitude, longitude = self.location_header.split(",")
+        return snap_location(float(latitude), float(longitude))
+
+    @functools.cached_property
+    def observer(self):
+        from skyfield.api import wgs84
+
+        return wgs84.latlon(*self.location)
+
+
+def get_astronomy() -> AstronomyContext:
+    """Return the request's astronomy context, creating it on first use."""
+    if "astronomy" not in g:
+        if "device" in g:
+            g.astronomy = AstronomyContext.at(
+                g.device.location, datetime.datetime.now(datetime.UTC)
+            )
+        else:
+            g.astronomy = AstronomyContext(
+                request.headers.get("X-Location", "40.7,-74.0")
+            )
+    return g.astronomy
+
+
+@metrics.timed
+def get_body_events(body: str) -> BodyEvents:
+    """Return the upcoming rise/set events of ``body`` at the request location,
+    from its cached timeline."""
+    astronomy = get_astronomy()
+    now = astronomy.now.timestamp()
+    ALMANAC_WARMER.track(*astronomy.location)
+
+    return get_timeline(body, astronomy.location, now).at(now)
 
-    moon_event_str = "MR" if events[event_index] else "MS"
-    moon_event_time = times[event_index].astimezone(g.tzinfo) + datetime.timedelta(
-        seconds=30
+
+def get_timeline(body: str, location: tuple[float, float], now: float) -> EventTimeline:
+    """The timeline of ``body`` at a snapped location, searching for it if the
+    cache has none covering ALMANAC_SEARCH_DAYS from ``now``."""
+    timeline = ALMANAC_CACHE.get((body, *location), now)
+    if timeline is None:
+        # Coalesced with identical searches already running in other threads
+        timeline = ALMANAC_SEARCHES.do(
+            (body, *location, int(now // ALMANAC_SEARCH_BUCKET_SECONDS)),
+            update_timeline,
+            ALMANAC_CACHE,
+            body,
+            location,
+            now,
+        )
+    else:
+        ALMANAC_WARMER.note_hit((body, *location), now)
+    return timeline
+
+
+def format_event_time(timestamp: float) -> str:
+    event_time = datetime.datetime.fromtimestamp(
+        timestamp, tz=g.tzinfo
+    ) + datetime.timedelta(seconds=30)
+    return "%02d:%02d" % (event_time.hour, event_time.minute)
+
+
+@metrics.timed
+def get_next_sun_event(event_index=0):
+    body_events = get_body_events("sun")
+    sun_event_str = "SR" if body_events.events[event_index] else "SS"
+    return "%s %s" % (
+        sun_event_str,
+        format_event_time(body_events.times[event_index]),
     )
-    return "%s %02d:%02d" % (
+
+
+@metrics.timed
+def get_next_moon_event(event_index=0):
+    body_events = get_body_events("moon")
+    moon_event_str = "MR" if body_events.events[event_index] else "MS"
+    return "%s %s" % (
         moon_event_str,
-        moon_event_time.hour,
-        moon_event_time.minute,
+        format_event_time(body_events.times[event_index]),
     )
 
 
+@metrics.timed
 def get_sun_state():
-    now = datetime.datetime.now(g.tzinfo)
-    ts = load.timescale()
-    t_now = ts.from_datetime(now)
-    sun_is_up = almanac.sunrise_sunset(EPH, g.location)(t_now)
+    sun_is_up = get_body_events("sun").is_up
     return "Daytime" if sun_is_up else "Nighttime"
 
 
+@metrics.timed
 def get_moon_state():
-    now = datetime.datetime.now(g.tzinfo)
-    ts = load.timescale()
-    t_now = ts.from_datetime(now)
-    moon_is_up = almanac.risings_and_settings(
-        EPH, EPH["moon"], g.location, radius_degrees=MOON_RADIUS_DEGREES
-    )(t_now)
+    moon_is_up = get_body_events("moon").is_up
     return "Moon up" if moon_is_up else "Moon down"
 
 
+MOON_PHASE_NAMES = ["New Moon", "1st Qtr Mn", "Full Moon", "Lst Qtr Mn"]
+
+
+def get_moon_quarter(angles):
+    """
+    Index into MOON_PHASE_NAMES for an array of phase angles in degrees.
+
+    Matches rounding ``int(angle)`` to the nearest quarter, with ties going to
+    the earlier quarter, so each name starts at 46, 136, 226 or 316 degrees.
+    """
+    import numpy as np
+
+    return ((np.floor(angles) - 46) // 90 + 1).astype(int) % 4
+
+
+class MoonPhaseTable:
+    """
+    Table of the instants the displayed moon phase changes.
+
+    Moon phase doesn't depend on location, so one table per process answers
+    every request with a binary search. The table covers ``days`` days and is
+    rebuilt once fewer than ``refresh_days`` of it remain.
+    """
+
+    def __init__(self, days: float, refresh_days: float):
+        self.days = days
+        self.refresh_days = refresh_days
+        self._lock = threading.Lock()
+        self._table = None
+
+    def build(self, now: float):
+        """Find every quarter change from a day before ``now`` to the end of
+        the table, to a tenth of a second."""
+        import numpy as np
+
+        start = now - 24 * 3600
+        end = start + self.days * 24 * 3600
+
+        # Phase changes by at most 15 degrees a day, so daily samples can't
+        # skip a quarter
+        samples = np.arange(start, end + 24 * 3600, 24 * 3600.0)
+        quarters = get_moon_quarter(ENGINE.moon_phase(samples))
+        changes = np.flatnonzero(quarters[1:] != quarters[:-1])
+
+        low, high = samples[changes], samples[changes + 1]
+        low_quarters = quarters[changes]
+        while len(low) and np.max(high - low) > 0.1:
+            middle = (low + high) / 2
+            moved = get_moon_quarter(ENGINE.moon_phase(middle)) == low_quarters
+            low = np.where(moved, middle, low)
+            high = np.where(moved, high, middle)
+
+        self._table = (
+            start,
+            end,
+            tuple(float(timestamp) for timestamp in high),
+            (int(quarters[0]), *(int(quarter) for quarter in quarters[changes + 1])),
+        )
+
+    @property
+    def table(self) -> tuple | None:
+        """(start, end, change times, quarters), or None before it's built."""
+        return self._table
+
+    def load(self, table: tuple):
+        """Use a table built earlier, such as one from a snapshot."""
+        with self._lock:
+            self._table = table
+
+    @property
+    def end(self) -> float | None:
+        """Unix timestamp the table runs out at, or None before it's built."""
+        return None if self._table is None else self._table[1]
+
+    def is_stale(self, now: float) -> bool:
+        """Whether the table is missing or close enough to running out to
+        rebuild."""
+        return (
+            self._table is None or now >= self._table[1] - self.refresh_days * 24 * 3600
+        )
+
+    def refresh(self, now: float):
+        """Rebuild the table if it is missing or close to running out."""
+        if self.is_stale(now):
+            with self._lock:
+                if self.is_stale(now):
+                    self.build(now)
+
+    def quarter_at(self, now: float) -> int:
+        """Index into MOON_PHASE_NAMES of the moon phase at ``now``."""
+        self.refresh(now)
+        _, _, timestamps, quarters = self._table
+        return quarters[bisect.bisect_right(timestamps, now)]
+
+    def next_change(self, now: float) -> float:
+        """Unix timestamp of the first moon phase change after ``now``."""
+        self.refresh(now)
+        _, end, timestamps, _ = self._table
+        index = bisect.bisect_right(timestamps, now)
+        return timestamps[index] if index < len(timestamps) else end
+
+
+MOON_PHASE_TABLE = MoonPhaseTable(
+    days=float(os.getenv("MOON_PHASE_TABLE_DAYS", "400")),
+    refresh_days=float(os.getenv("MOON_PHASE_REFRESH_DAYS", "30")),
+)
+
+
+@metrics.timed
 def get_moon_phase():
-    now = datetime.datetime.now(g.tzinfo)
-    ts = load.timescale()
-    t_now = ts.from_datetime(now)
-    angle = int(almanac.moon_phase(EPH, t_now).degrees)
-    angle_options = [0, 90, 180, 270, 360]
-    closest_match = (
-        min(angle_options, key=lambda angle_option: abs(angle_option - angle)) % 360
+    now = get_astronomy().now.timestamp()
+    return MOON_PHASE_NAMES[MOON_PHASE_TABLE.quarter_at(now)]
+
+
+def preload_shared_state():
+    """
+    Load everything workers can share, for gunicorn to call in the master
+    process before forking (see gunicorn.conf.py).
+
+    Reads the ephemeris segments apparent positions use and builds the moon phase
+    table, so each worker starts with them in copy-on-write memory instead of
+    loading its own copy on its first request. The analytic engine never reads
+    the ephemeris, so with it only the table is built. Does nothing in the
+    time-only profile, which never loads them.
+
+    Restoring the snapshot may have opened the shared cache database. It's
+    closed again, so workers don't inherit the connection.
+    """
+    if SHARED_CACHE.enabled:
+        SHARED_CACHE.close()
+    if SERVICE_PROFILE == "time":
+        return
+    now = time.time()
+    if isinstance(ENGINE, SkyfieldEngine):
+        ephemeris = get_ephemeris()
+        earth = ephemeris["earth"].at(get_timescale().now())
+        earth.observe(ephemeris["sun"]).apparent()
+        earth.observe(ephemeris["moon"]).apparent()
+    MOON_PHASE_TABLE.refresh(now)
+
+
+# Span of each precomputed DST transition chunk, in seconds (365 days). It is
+# a whole number of DST_SCAN_STEP intervals so every chunk's scan points line
+# up with its neighbours'.
+DST_CHUNK_SECONDS = 365 * 24 * 3600
+DST_SCAN_STEP = 900
+DST_SEARCH_WINDOW = 2 * 3600
+
+
+def _get_utc_offset(tzinfo: ZoneInfo, timestamp: float) -> int:
+    return int(
+        datetime.datetime.fromtimestamp(timestamp, tz=tzinfo)
+        .utcoffset()
+        .total_seconds()
     )
-    return {0: "New Moon", 90: "1st Qtr Mn", 180: "Full Moon", 270: "Lst Qtr Mn"}[
-        closest_match
-    ]
 
 
+DST_TABLES_SIZE = 1024
+
+# The most recently used tables built or restored in this process, by zone
+# name and chunk, for the warm-start snapshot. Bounded like the lru_cache in
+# front of it.
+DST_TABLES: collections.OrderedDict[
+    tuple[str, int], tuple[tuple[int, ...], tuple[int, ...]]
+] = collections.OrderedDict()
+DST_TABLES_LOCK = threading.Lock()
+
+
+def _remember_dst_table(
+    key: tuple[str, int], table: tuple[tuple[int, ...], tuple[int, ...]]
+):
+    with DST_TABLES_LOCK:
+        DST_TABLES[key] = table
+        DST_TABLES.move_to_end(key)
+        while len(DST_TABLES) > DST_TABLES_SIZE:
+            DST_TABLES.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=DST_TABLES_SIZE)
+def get_dst_transitions(
+    tzinfo: ZoneInfo, chunk: int
+) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    """
+    Build the table of UTC offset transitions for one chunk of time.
+
+    Chunk ``n`` covers transitions ``T`` with
+    ``n * DST_CHUNK_SECONDS < T <= (n + 1) * DST_CHUNK_SECONDS``.
+
+    Returns a tuple of (timestamps, offsets) where:
+    - timestamps: Sorted Unix timestamps (int) of each transition
+    - offsets: UTC offset in seconds (int) in effect from each transition on
+
+    The chunk is scanned once every 15 minutes, then each change is narrowed
+    down to the second with a binary search. Tables are cached per ZoneInfo,
+    so the scan only runs the first time a zone is seen in a given chunk.
+    With SHARED_CACHE set, it only runs the first time any worker sees it,
+    and with SNAPSHOT_FILE set, tables survive a restart.
+    """
+    if tzinfo.key is None:
+        return _build_dst_transitions(tzinfo, chunk)
+    with DST_TABLES_LOCK:
+        table = DST_TABLES.get((tzinfo.key, chunk))
+    if table is not None:
+        return table
+
+    key = "%s:%d" % (tzinfo.key, chunk)
+    if SHARED_CACHE.enabled:
+        record = SHARED_CACHE.get("dst_transitions", key, time.time())
+        if record is not None:
+            table = shared_cache.unpack_dst_transitions(record)
+    if table is None:
+        table = _build_dst_transitions(tzinfo, chunk)
+        # Shared until the chunk ends, unless it's already past
+        expires = (chunk + 1) * DST_CHUNK_SECONDS
+        record = shared_cache.pack_dst_transitions(*table)
+        if SHARED_CACHE.enabled and record is not None and expires > time.time():
+            SHARED_CACHE.put("dst_transitions", key, record, expires)
+    _remember_dst_table((tzinfo.key, chunk), table)
+    return table
+
+
+def _build_dst_transitions(
+    tzinfo: ZoneInfo, chunk: int
+) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    chunk_start = chunk * DST_CHUNK_SECONDS
+    timestamps = []
+    offsets = []
+
+    low_ts = chunk_start
+    low_offset = _get_utc_offset(tzinfo, low_ts)
+    for high_ts in range(
+        chunk_start + DST_SCAN_STEP,
+        chunk_start + DST_CHUNK_SECONDS + 1,
+        DST_SCAN_STEP,
+    ):
+        high_offset = _get_utc_offset(tzinfo, high_ts)
+        if high_offset != low_offset:
+            # Binary search for the first second with the new offset
+            left, right = low_ts, high_ts
+            while (right - left) > 1:
+                mid = (left + right) // 2
+                if _get_utc_offset(tzinfo, mid) == low_offset:
+                    left = mid
+                else:
+                    right = mid
+            timestamps.append(right)
+            offsets.append(high_offset)
+        low_ts, low_offset = high_ts, high_offset
+
+    return tuple(timestamps), tuple(offsets)
+
+
+@metrics.timed
 def get_next_dst_transition(
     tzinfo: ZoneInfo, current_time: datetime.datetime
 ) -> tuple[int, int] | tuple[None, None]:
@@ -143,52 +1112,25 @@ def get_next_dst_transition(
     - next_dst_change: Unix timestamp (int) of the next transition, or None
     - new_utc_offset: New UTC offset in seconds (int) after the transition, or None
 
+    Transitions are looked up with a binary search over the zone's
+    precomputed table (see ``get_dst_transitions``).
+
     Note: Only searches 2 hours ahead since clients poll at least once per hour.
     """
     try:
-        # Work in UTC timestamps to avoid timezone ambiguity issues
         current_timestamp = current_time.timestamp()
-        search_end_timestamp = (
-            current_timestamp + (2 * 3600) + (15 * 60)
-        )  # 2h 15m buffer
-
-        # Get current UTC offset
-        current_offset = current_time.utcoffset().total_seconds()
-
-        # Iterate through time to find the next transition
-        # Check every 15 minutes (900 seconds) to find when the UTC offset changes
-        search_timestamp = current_timestamp
-
-        while search_timestamp < search_end_timestamp:
-            search_timestamp += 900  # 15 minutes in seconds
-            search_time = datetime.datetime.fromtimestamp(search_timestamp, tz=tzinfo)
-            next_offset = search_time.utcoffset().total_seconds()
-
-            if next_offset != current_offset:
-                # Found a transition, now narrow it down
-                # Binary search to find the exact transition time (in timestamps)
-                low_ts = search_timestamp - 900  # 15 minutes before
-                high_ts = search_timestamp
-
-                while (high_ts - low_ts) > 1:  # Within 1 second
-                    mid_ts = (low_ts + high_ts) / 2
-                    mid_time = datetime.datetime.fromtimestamp(mid_ts, tz=tzinfo)
-                    mid_offset = mid_time.utcoffset().total_seconds()
-
-                    if mid_offset == current_offset:
-                        low_ts = mid_ts
-                    else:
-                        high_ts = mid_ts
-
-                # The transition happens at 'high_ts'
-                transition_timestamp = int(high_ts)
-
-                # Only return if transition is within 2 hours from the original current_time
-                time_until_transition = transition_timestamp - current_timestamp
-                if time_until_transition <= 7200:  # 2 hours in seconds
-                    return transition_timestamp, int(next_offset)
-                else:
-                    return None, None
+        chunk = int(current_timestamp // DST_CHUNK_SECONDS)
+
+        # The search window is much shorter than a chunk, so the next
+        # transition is either in the current chunk or the one after it
+        for search_chunk in (chunk, chunk + 1):
+            timestamps, offsets = get_dst_transitions(tzinfo, search_chunk)
+            index = bisect.bisect_right(timestamps, current_timestamp)
+            if index < len(timestamps):
+                transition_timestamp = timestamps[index]
+                if transition_timestamp - current_timestamp <= DST_SEARCH_WINDOW:
+                    return transition_timestamp, offsets[index]
+                return None, None
 
         # No transition found in the next 2 hours
         return None, None
@@ -198,8 +1140,348 @@ def get_next_dst_transition(
         return None, None
 
 
+# Longest /time?horizon= schedule a client may ask for, in days
+DST_SCHEDULE_MAX_DAYS = int(os.getenv("DST_SCHEDULE_MAX_DAYS", "731"))
+
+
+@metrics.timed
+def get_dst_schedule(
+    tzinfo: ZoneInfo, current_time: datetime.datetime, horizon_seconds: float
+) -> list[tuple[int, int]]:
+    """
+    List every transition in the next ``horizon_seconds`` for the given
+    timezone, as (timestamp, new_utc_offset) pairs.
+
+    Bisects into each precomputed chunk the horizon overlaps (see
+    ``get_dst_transitions``), so a year's schedule costs a couple of
+    lookups rather than a longer scan.
+    """
+    start = current_time.timestamp()
+    end = start + horizon_seconds
+    schedule = []
+    for chunk in range(
+        int(start // DST_CHUNK_SECONDS), int(end // DST_CHUNK_SECONDS) + 1
+    ):
+        timestamps, offsets = get_dst_transitions(tzinfo, chunk)
+        index = bisect.bisect_right(timestamps, start)
+        while index < len(timestamps) and timestamps[index] <= end:
+            schedule.append((timestamps[index], offsets[index]))
+            index += 1
+    return schedule
+
+
+def get_schedule_horizon() -> float | None:
+    """
+    The ``?horizon=`` of a /time request in seconds, or None if not given.
+    It must be a whole number of days from 1 to DST_SCHEDULE_MAX_DAYS.
+    """
+    horizon = request.args.get("horizon")
+    if horizon is None:
+        return None
+    try:
+        days = int(horizon)
+    except ValueError:
+        abort(400)
+    if not 1 <= days <= DST_SCHEDULE_MAX_DAYS:
+        abort(400)
+    return days * 24 * 3600
+
+
+# With SNAPSHOT_FILE set, computed tables are saved there every
+# SNAPSHOT_INTERVAL seconds and at exit, and restored at startup (see
+# SNAPSHOT.md).
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+
+
+def get_tzdata_version() -> str | None:
+    """
+    IANA version of the time zone data ZoneInfo reads: the first zoneinfo
+    directory's, or the tzdata package's if there is none. None if the
+    directory doesn't record its version.
+    """
+    for directory in TZPATH:
+        if os.path.isdir(directory):
+            try:
+                with open(os.path.join(directory, "tzdata.zi")) as data:
+                    return data.readline().removeprefix("# version").strip()
+            except OSError:
+                return None
+    try:
+        import tzdata
+    except ImportError:
+        return None
+    return tzdata.IANA_VERSION
+
+
+@functools.cache
+def get_ephemeris_version() -> str | None:
+    """
+    The names of the kernels the ephemeris file's segments come from, such
+    as ``DE-0421LE-0421``, or None if it hasn't been downloaded. An excerpt
+    written by ``trim_ephemeris.py`` keeps them, so rebuilding it for other
+    dates, as every image build does, keeps the version.
+    """
+    from jplephem.spk import SPK
+
+    try:
+        kernel = SPK.open(os.getenv("EPHEMERIS_FILE", "de421.bsp"))
+    except (OSError, ValueError):
+        return None
+    try:
+        return ",".join(
+            sorted(
+                {
+                    segment.source.decode("latin-1").strip()
+                    for segment in kernel.segments
+                }
+            )
+        )
+    finally:
+        kernel.close()
+
+
+def get_snapshot_versions() -> dict:
+    """
+    What the snapshot's tables were computed from. DST tables are only
+    restored if ``dst`` matches, and almanac tables only if ``almanac``
+    does. None for tables that can't be restored, such as almanac tables in
+    the time-only profile. The analytic engine's tables only depend on the
+    engine, so they're versioned without reading the ephemeris.
+    """
+    tzdata_version = get_tzdata_version()
+    if SERVICE_PROFILE == "time":
+        almanac_version = None
+    elif isinstance(ENGINE, AnalyticEngine):
+        almanac_version = [type(ENGINE).__name__, ALMANAC_GRID_DEGREES]
+    else:
+        ephemeris_version = get_ephemeris_version()
+        almanac_version = ephemeris_version and [
+            ephemeris_version,
+            type(ENGINE).__name__,
+            ALMANAC_GRID_DEGREES,
+        ]
+    return {
+        "dst": tzdata_version and [tzdata_version, DST_CHUNK_SECONDS],
+        "almanac": almanac_version,
+    }
+
+
+def save_snapshot(path: str = SNAPSHOT_FILE, now: float | None = None):
+    """
+    Save this process's unexpired tables to the snapshot at ``path``, along
+    with those other workers saved there.
+    """
+    now = time.time() if now is None else now
+    versions = get_snapshot_versions()
+    # Other workers may be saving at the same time
+    with snapshot.locked(path):
+        timelines = {}
+        dst_tables = {}
+        moon_phase = None
+        saved = snapshot.read(path)
+        if saved is not None and saved.versions["dst"] == versions["dst"]:
+            dst_tables.update(saved.dst_tables)
+        if saved is not None and saved.versions["almanac"] == versions["almanac"]:
+            timelines.update(saved.timelines)
+            moon_phase = saved.moon_phase
+
+        if versions["dst"] is None:
+            dst_tables = {}
+        else:
+            with DST_TABLES_LOCK:
+                dst_tables.update(DST_TABLES)
+        if versions["almanac"] is None:
+            timelines = {}
+            moon_phase = None
+        else:
+            timelines.update(ALMANAC_CACHE.items())
+            moon_phase = MOON_PHASE_TABLE.table or moon_phase
+
+        snapshot.write(
+            path,
+            snapshot.Snapshot(
+                versions,
+                {
+                    key: tuple(timeline)
+                    for key, timeline in timelines.items()
+                    if timeline[1] > now
+                },
+                {
+                    key: table
+                    for key, table in dst_tables.items()
+                    if (key[1] + 1) * DST_CHUNK_SECONDS > now
+                },
+                moon_phase if moon_phase is not None and moon_phase[1] > now else None,
+            ),
+        )
+
+
+def load_snapshot(path: str = SNAPSHOT_FILE, now: float | None = None):
+    """Restore the tables saved at ``path`` that are still valid."""
+    now = time.time() if now is None else now
+    saved = snapshot.read(path)
+    if saved is None:
+        return
+    versions = get_snapshot_versions()
+    if versions["dst"] is not None and saved.versions["dst"] == versions["dst"]:
+        for key, table in saved.dst_tables.items():
+            _remember_dst_table(key, table)
+    if (
+        versions["almanac"] is not None
+        and saved.versions["almanac"] == versions["almanac"]
+    ):
+        for key, timeline in saved.timelines.items():
+            timeline = EventTimeline(*timeline)
+            if timeline.start <= now < timeline.end:
+                ALMANAC_CACHE.put(key, timeline)
+        if saved.moon_phase is not None and saved.moon_phase[0] <= now:
+            MOON_PHASE_TABLE.load(saved.moon_phase)
+
+
+def _save_snapshot_logging_errors():
+    try:
+        save_snapshot()
+    except Exception:
+        app.logger.exception("Saving the snapshot failed")
+
+
+if SNAPSHOT_FILE:
+    load_snapshot()
+    atexit.register(_save_snapshot_logging_errors)
+
+
+# Packed /time response: timestamp ms, UTC offset s, next DST change ms (0 if
+# none), new UTC offset s (0 if none), little-endian
+TIME_STRUCT = struct.Struct("<qiqi")
+# Packed /motd response: 0xRRGGBB color, then the UTF-8 text prefixed with its
+# length, little-endian
+MOTD_COLOR_STRUCT = struct.Struct("<I")
+MOTD_LENGTH_STRUCT = struct.Struct("<H")
+
+# Packed /time?horizon= schedule: transition count, then each transition's
+# timestamp ms and new UTC offset s
+SCHEDULE_COUNT_STRUCT = struct.Struct("<H")
+SCHEDULE_ENTRY_STRUCT = struct.Struct("<qi")
+
+BINARY_MIMETYPE = "application/octet-stream"
+RESPONSE_FORMATS = {"json": "application/json", "bin": BINARY_MIMETYPE}
+
+
+def get_response_format() -> str:
+    """
+    Pick the response format from ``?fmt=`` or, failing that, the ``Accept``
+    header. JSON is the default; unknown ``fmt`` values are a 400.
+    """
+    fmt = request.args.get("fmt")
+    if fmt is not None:
+        if fmt not in RESPONSE_FORMATS:
+            abort(400)
+        return fmt
+    best = request.accept_mimetypes.best_match(
+        list(RESPONSE_FORMATS.values()), default="application/json"
+    )
+    return "bin" if best == BINARY_MIMETYPE else "json"
+
+
+def pack_time(timestamp_ms, utc_offset, next_change_ms, new_utc_offset) -> bytes:
+    return TIME_STRUCT.pack(
+        timestamp_ms, utc_offset, next_change_ms or 0, new_utc_offset or 0
+    )
+
+
+def pack_schedule(schedule: list[tuple[int, int]]) -> bytes:
+    return SCHEDULE_COUNT_STRUCT.pack(len(schedule)) + b"".join(
+        SCHEDULE_ENTRY_STRUCT.pack(timestamp * 1000, offset)
+        for timestamp, offset in schedule
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def pack_motd_text(text: str) -> bytes:
+    """
+    Length-prefixed UTF-8 ``/motd`` text. Cached, since the MOTD options, moon
+    phases and states, and each upcoming event repeat across requests.
+    """
+    encoded = text.encode()
+    return MOTD_LENGTH_STRUCT.pack(len(encoded)) + encoded
+
+
+def pack_motd(text: str, color: int) -> bytes:
+    return MOTD_COLOR_STRUCT.pack(color) + pack_motd_text(text)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+PROFILER = profiling.RequestProfiler(
+    every=int(os.getenv("PROFILE_EVERY", "0")),
+    directory=os.getenv("PROFILE_DIR", "profiles"),
+    token=os.getenv("PROFILE_TOKEN", ""),
+)
+
+
+def get_endpoint_label() -> str:
+    """The request's route, or "unmatched", for metrics and profile tags."""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@app.before_request
+def start_request_profile():
+    if PROFILER.enabled:
+        g.profile = PROFILER.start(request.headers.get("X-Profile"))
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        PROFILER.stop(
+            profile,
+            get_endpoint_label(),
+            g.get("motd_branch", "-"),
+            # Only zones that exist, so a client can't add files at will
+            g.tzinfo.key if "tzinfo" in g else "invalid",
+        )
+
+
+DEVICE_REGISTRY = device_registry.DeviceRegistry(
+    os.getenv("DEVICE_REGISTRY", ""),
+    flush_interval=float(os.getenv("DEVICE_REGISTRY_FLUSH_INTERVAL", "5")),
+    cache_size=int(os.getenv("DEVICE_REGISTRY_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("DEVICE_REGISTRY_TTL", str(30 * 24 * 3600))),
+    max_devices=int(os.getenv("DEVICE_REGISTRY_MAX_DEVICES", "100000")),
+)
+
+
+@app.before_request
+def load_device():
+    """
+    Look up the device sending ``X-Device-Id`` in the registry. It's only
+    used if it hasn't changed timezone or moved since it was registered.
+    """
+    device_id = request.headers.get("X-Device-Id")
+    if not device_id or not DEVICE_REGISTRY.enabled:
+        return
+    g.device_id = device_id
+    DEVICE_REGISTRY.seen(device_id, time.time())
+    device = DEVICE_REGISTRY.lookup(device_id)
+    if (
+        device is not None
+        and request.headers.get("X-Timezone", device.timezone) == device.timezone
+        and request.headers.get("X-Location", device.location_header)
+        == device.location_header
+    ):
+        g.device = device
+
+
 @app.before_request
 def load_timezone():
+    if "device" in g:
+        g.tzinfo = g.device.tzinfo
+        return
     timezone = request.headers.get("X-Timezone", "UTC")
     try:
         g.tzinfo = ZoneInfo(timezone)
@@ -207,12 +1489,15 @@ def load_timezone():
         abort(404)
 
 
-@app.before_request
-def load_location():
-    latitude, longitude = request.headers.get("X-Location", "40.7,-74.0").split(",")
-    latitude = float(latitude)
-    longitude = float(longitude)
-    g.location = wgs84.latlon(latitude, longitude)
+@app.after_request
+def record_request_metrics(response):
+    # Label by route rather than path, so unknown paths share one series
+    endpoint = get_endpoint_label()
+    metrics.REQUESTS.labels(endpoint, response.status_code).inc()
+    metrics.REQUEST_SECONDS.labels(endpoint).observe(
+        time.perf_counter() - g.request_start
+    )
+    return response
 
 
 @app.after_request
@@ -227,15 +1512,20 @@ def add_cache_headers(response):
     return response
 
 
-@app.get("/time")
-def get_time():
+def get_current_time(tzinfo: ZoneInfo) -> datetime.datetime:
     if os.getenv("OVERRIDE_CURRENT_TIME"):
-        now = datetime.datetime.fromtimestamp(
+        return datetime.datetime.fromtimestamp(
             float(os.getenv("OVERRIDE_CURRENT_TIME"))
-        ).astimezone(g.tzinfo)
-    else:
-        now = datetime.datetime.now(g.tzinfo)
-    next_dst_change, new_utc_offset = get_next_dst_transition(g.tzinfo, now)
+        ).astimezone(tzinfo)
+    return datetime.datetime.now(tzinfo)
+
+
+def get_time_fields(now: datetime.datetime) -> list:
+    """
+    The /time fields for an aware ``now``: timestamp ms, UTC offset, next DST
+    change ms within 2 hours or None, and the UTC offset after it or None.
+    """
+    next_dst_change, new_utc_offset = get_next_dst_transition(now.tzinfo, now)
     return [
         int(now.timestamp() * 1000),
         int(now.tzinfo.utcoffset(now).total_seconds()),
@@ -244,24 +1534,339 @@ def get_time():
     ]
 
 
-@app.get("/motd")
-def get_motd():
-    rand_num = secrets.randbelow(8)
+@app.get("/time")
+def get_time():
+    now = get_current_time(g.tzinfo)
+    fmt = get_response_format()
+    horizon = get_schedule_horizon()
+    fields = get_time_fields(now)
+    schedule = None if horizon is None else get_dst_schedule(g.tzinfo, now, horizon)
+
+    if fmt == "bin":
+        body = pack_time(*fields)
+        if schedule is not None:
+            body += pack_schedule(schedule)
+        return Response(body, mimetype=BINARY_MIMETYPE)
+    if schedule is not None:
+        fields.append([[timestamp * 1000, offset] for timestamp, offset in schedule])
+    return fields
+
+
+class TimeFastPath:
+    """
+    WSGI middleware answering plain ``GET /time`` requests without Flask.
+
+    A request naming at most its ``X-Timezone``, and accepting JSON, skips the
+    request context, the before and after request hooks and Flask's response
+    building: the zone comes from a dict of ``ZoneInfo`` by name, and the
+    headers are built once. Anything else, including ``?fmt=``, ``?horizon=``,
+    ``X-Device-Id``, an unknown zone and every other route, is passed on to
+    ``wsgi_app``. The body, CORS and ``Cache-Control`` headers and request
+    metrics are the same as Flask's.
+    """
+
+    ACCEPT_JSON = frozenset({"", "*/*", "application/json"})
+    CONTENT_TYPE = ("Content-Type", "application/json")
+    # After Content-Length, in the order the after_request hooks add them
+    HEADERS = [("Cache-Control", "no-store"), ("Access-Control-Allow-Origin", "*")]
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.zones: dict[str, ZoneInfo] = {}
+        self.requests = metrics.REQUESTS.labels("/time", 200)
+        self.request_seconds = metrics.REQUEST_SECONDS.labels("/time")
+
+    def get_zone(self, name: str) -> ZoneInfo | None:
+        tzinfo = self.zones.get(name)
+        if tzinfo is None:
+            try:
+                tzinfo = ZoneInfo(name)
+            except (ZoneInfoNotFoundError, IsADirectoryError, ValueError):
+                return None
+            self.zones[name] = tzinfo
+        return tzinfo
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        if (
+            environ.get("PATH_INFO") != "/time"
+            or environ.get("REQUEST_METHOD") != "GET"
+            or environ.get("QUERY_STRING")
+            or environ.get("HTTP_ACCEPT", "") not in self.ACCEPT_JSON
+            or "HTTP_X_DEVICE_ID" in environ
+            or PROFILER.enabled
+        ):
+            return self.wsgi_app(environ, start_response)
+        tzinfo = self.get_zone(environ.get("HTTP_X_TIMEZONE", "UTC"))
+        if tzinfo is None:
+            return self.wsgi_app(environ, start_response)
+
+        body = (
+            json.dumps(get_time_fields(get_current_time(tzinfo)), separators=(",", ":"))
+            + "\n"
+        ).encode()
+        start_response(
+            "200 OK",
+            [self.CONTENT_TYPE, ("Content-Length", str(len(body))), *self.HEADERS],
+        )
+        self.requests.inc()
+        self.request_seconds.observe(time.perf_counter() - started)
+        return [body]
+
+
+def astronomy_route(rule: str):
+    """Register a GET route needing astronomy, except in the time-only profile."""
+
+    def register(view):
+        return app.get(rule)(view) if SERVICE_PROFILE == "full" else view
+
+    return register
+
+
+# Label of each choose_motd() branch in the metrics
+MOTD_BRANCHES = [
+    "message",
+    "next_sun_event",
+    "following_sun_event",
+    "next_moon_event",
+    "following_moon_event",
+    "sun_state",
+    "moon_state",
+    "moon_phase",
+]
+MOTD_BRANCH_TIMERS = [
+    metrics.MOTD_BRANCH_SECONDS.labels(branch) for branch in MOTD_BRANCHES
+]
+
+# What each branch computes: the timelines of "sun" or "moon" at the request
+# location, or the moon "phase" table
+MOTD_BRANCH_NEEDS = [
+    (),
+    ("sun",),
+    ("sun",),
+    ("moon",),
+    ("moon",),
+    ("sun",),
+    ("moon",),
+    ("phase",),
+]
+# How long /motd waits for anything its branch has to compute, in seconds.
+# 0 waits as long as it takes.
+MOTD_DEADLINE_SECONDS = float(os.getenv("MOTD_DEADLINE_SECONDS", "0.25"))
+# Runs those computations, so one still running at the deadline carries on
+# and is cached for the next request
+MOTD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("MOTD_BACKGROUND_THREADS", "2")),
+    thread_name_prefix="motd-background",
+)
+# How many of those computations can be queued or running at once. Past that,
+# /motd doesn't submit more and falls back straight away, so a burst of new
+# locations can't pile up work for requests that have already been answered.
+MOTD_BACKGROUND_QUEUE = int(os.getenv("MOTD_BACKGROUND_QUEUE", "16"))
+motd_background_pending = 0
+motd_background_lock = threading.Lock()
+
+
+def run_logging_errors(func, *args):
+    try:
+        return func(*args)
+    except Exception:
+        app.logger.exception("Background /motd computation failed")
+        raise
+
+
+def submit_motd_background(func, *args) -> concurrent.futures.Future | None:
+    """Run ``func`` on MOTD_EXECUTOR, or return None if MOTD_BACKGROUND_QUEUE
+    computations are already queued or running."""
+    global motd_background_pending
+    with motd_background_lock:
+        if motd_background_pending >= MOTD_BACKGROUND_QUEUE:
+            return None
+        motd_background_pending += 1
+
+    def finished(_):
+        global motd_background_pending
+        with motd_background_lock:
+            motd_background_pending -= 1
+
+    future = MOTD_EXECUTOR.submit(run_logging_errors, func, *args)
+    future.add_done_callback(finished)
+    return future
+
+
+def prepare_motd(rand_num: int) -> bool:
+    """
+    Compute whatever the chosen branch needs that isn't cached, giving up
+    after MOTD_DEADLINE_SECONDS, or at once if the background queue is full.
+    Returns whether it's ready.
+
+    A device whose payload has expired needs every almanac item.
+    """
+    needs = MOTD_BRANCH_NEEDS[rand_num]
+    if MOTD_DEADLINE_SECONDS <= 0 or not needs:
+        return True
+    if "device_id" in g:
+        device = g.get("device")
+        if device is not None and device.expires > time.time():
+            return True
+        needs = ("sun", "moon", "phase")
+
+    astronomy = get_astronomy()
+    now = astronomy.now.timestamp()
+    pending = []
+    for need in needs:
+        if need == "phase":
+            if not MOON_PHASE_TABLE.is_stale(now):
+                continue
+            future = submit_motd_background(MOON_PHASE_TABLE.refresh, now)
+        else:
+            timeline = ALMANAC_CACHE.peek((need, *astronomy.location), now)
+            if timeline is not None and timeline.covers(now):
+                continue
+            ALMANAC_WARMER.track(*astronomy.location)
+            future = submit_motd_background(get_timeline, need, astronomy.location, now)
+        if future is None:
+            return False
+        pending.append(future)
+    if not pending:
+        return True
+    _, not_done = concurrent.futures.wait(pending, timeout=MOTD_DEADLINE_SECONDS)
+    return not not_done
+
 
+def get_fallback_motd() -> tuple[str, int]:
+    """An item that costs nothing to compute: the moon phase while its table
+    is fresh, otherwise a random message."""
+    if not MOON_PHASE_TABLE.is_stale(get_astronomy().now.timestamp()):
+        return get_moon_phase(), MOON_COLOR
+    return secrets.choice(MOTD_OPTIONS), get_rand_color()
+
+
+def choose_motd(rand_num: int) -> tuple[str, int]:
+    if rand_num and "device_id" in g:
+        # The astronomy branches are the almanac items, in the same order
+        item = get_almanac_payload()[rand_num - 1]
+        if item is not None:
+            return tuple(item)
     match rand_num:
         case 0:
-            return [secrets.choice(MOTD_OPTIONS), get_rand_color()]
+            return secrets.choice(MOTD_OPTIONS), get_rand_color()
         case 1:
-            return [get_next_sun_event(), SUN_COLOR]
+            return get_next_sun_event(), SUN_COLOR
         case 2:
-            return [get_next_sun_event(1), SUN_COLOR]
+            return get_next_sun_event(1), SUN_COLOR
         case 3:
-            return [get_next_moon_event(), MOON_COLOR]
+            return get_next_moon_event(), MOON_COLOR
         case 4:
-            return [get_next_moon_event(1), MOON_COLOR]
+            return get_next_moon_event(1), MOON_COLOR
         case 5:
-            return [get_sun_state(), SUN_COLOR]
+            return get_sun_state(), SUN_COLOR
         case 6:
-            return [get_moon_state(), MOON_COLOR]
+            return get_moon_state(), MOON_COLOR
         case 7:
-            return [get_moon_phase(), MOON_COLOR]
+            return get_moon_phase(), MOON_COLOR
+
+
+@astronomy_route("/motd")
+def get_motd():
+    fmt = get_response_format()
+    rand_num = secrets.randbelow(len(MOTD_BRANCHES))
+    g.motd_branch = MOTD_BRANCHES[rand_num]
+    with MOTD_BRANCH_TIMERS[rand_num].time():
+        if prepare_motd(rand_num):
+            text, color = choose_motd(rand_num)
+        else:
+            metrics.MOTD_FALLBACKS.labels(g.motd_branch).inc()
+            text, color = get_fallback_motd()
+    if fmt == "bin":
+        return Response(pack_motd(text, color), mimetype=BINARY_MIMETYPE)
+    return [text, color]
+
+
+ALMANAC_ITEMS = [
+    (lambda: get_next_sun_event(), SUN_COLOR),
+    (lambda: get_next_sun_event(1), SUN_COLOR),
+    (lambda: get_next_moon_event(), MOON_COLOR),
+    (lambda: get_next_moon_event(1), MOON_COLOR),
+    (get_sun_state, SUN_COLOR),
+    (get_moon_state, MOON_COLOR),
+    (get_moon_phase, MOON_COLOR),
+]
+
+
+def get_almanac_payload() -> list[list | None]:
+    """
+    The almanac items in ALMANAC_ITEMS order, None where there's no event.
+
+    A registered device gets its stored payload until it expires. Any other
+    request with ``X-Device-Id`` registers the device with a new one.
+    """
+    device = g.get("device")
+    if device is not None and device.expires > time.time():
+        return device.payload
+    payload = []
+    for get_item, color in ALMANAC_ITEMS:
+        try:
+            payload.append([get_item(), color])
+        except IndexError:
+            payload.append(None)
+    if "device_id" in g:
+        register_device(payload)
+    return payload
+
+
+def register_device(payload: list[list | None]):
+    astronomy = get_astronomy()
+    DEVICE_REGISTRY.register(
+        g.device_id,
+        device_registry.Device(
+            g.tzinfo.key,
+            g.tzinfo,
+            g.device.location_header if "device" in g else astronomy.location_header,
+            astronomy.location,
+            payload,
+            get_almanac_expiry(),
+        ),
+    )
+
+
+def get_almanac_items() -> list[list]:
+    return [item for item in get_almanac_payload() if item is not None]
+
+
+def get_almanac_expiry() -> float:
+    """
+    Unix timestamp the request location's almanac items next change: the
+    next sun or moon event, or moon phase change.
+    """
+    now = get_astronomy().now.timestamp()
+    return min(
+        get_body_events("sun").expires,
+        get_body_events("moon").expires,
+        MOON_PHASE_TABLE.next_change(now),
+    )
+
+
+@astronomy_route("/almanac")
+def get_almanac():
+    """
+    Return every astronomy MOTD item for the request location at once, so a
+    device can rotate through them locally instead of polling /motd.
+
+    All items share one cached event search per body and one ``Time``.
+    Events that don't happen within the search window (polar day or night)
+    are left out.
+    """
+    return get_almanac_items()
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus metrics, added up across all worker processes."""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+# Serve plain /time requests ahead of Flask (see PERFORMANCE.md)
+if os.getenv("TIME_FAST_PATH", "0") == "1":
+    app.wsgi_app = TimeFastPath(app.wsgi_app)
@@ -0,0 +1,184 @@
+"""
+ASGI entry point serving the Flask app from an event loop.
+
+``/time`` is answered directly on the loop, so it never waits behind
+astronomy work, as is the ``/stream`` of Server-Sent Events (see STREAM.md).
+With the device registry enabled, a ``/time`` from a device reads its row, so
+it's answered on a small thread pool instead of blocking the loop.
+Every other route runs in a bounded process pool whose workers each load
+their own ``EPH``. Run with:
+
+    uvicorn async_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+# The loop and pool processes write their metrics here, for /metrics to add
+# up. Set before the app imports prometheus_client; pool workers inherit it.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="matrix-portal-metrics-")
+)
+
+import stream  # noqa: E402
+from app import (  # noqa: E402
+    DEVICE_REGISTRY,
+    preload_shared_state,
+)
+from app import app as flask_app  # noqa: E402
+
+# Routes cheap enough to answer on the event loop
+LOOP_PATHS = frozenset({"/time", "/metrics"})
+
+# Threads answering loop requests that read the device registry
+REGISTRY_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("DEVICE_REGISTRY_THREADS", "2")),
+    thread_name_prefix="device-registry",
+)
+
+ASTRONOMY_POOL_SIZE = int(os.getenv("ASTRONOMY_POOL_SIZE", str(os.cpu_count() or 1)))
+# Requests allowed to wait for or run in the pool before new ones get a 503
+ASTRONOMY_QUEUE_SIZE = int(
+    os.getenv("ASTRONOMY_QUEUE_SIZE", str(ASTRONOMY_POOL_SIZE * 64))
+)
+
+
+def handle_request(
+    method: str, path: str, query_string: str, headers: list[tuple[str, str]]
+) -> tuple[int, list[tuple[str, str]], bytes]:
+    """
+    Run one request through the Flask app and return its status, headers and
+    body. Takes and returns only plain values, so it can run in the pool.
+    """
+    environ = EnvironBuilder(
+        path=path, method=method, query_string=query_string, headers=headers
+    ).get_environ()
+    app_iter, status, response_headers = run_wsgi_app(flask_app, environ)
+    try:
+        body = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return int(status.split(" ", 1)[0]), list(response_headers), body
+
+
+def init_pool_worker():
+    """Load the ephemeris and moon phase table once per pool worker."""
+    preload_shared_state()
+
+
+class AstronomyPool:
+    """
+    Process pool for astronomy requests, with at most ``queue_size`` requests
+    waiting for or running in it at once.
+    """
+
+    def __init__(self, size: int, queue_size: int):
+        self.size = size
+        self.queue_size = queue_size
+        self.executor = None
+        self.pending = 0
+
+    def start(self):
+        # Spawn rather than fork, since the parent runs an event loop
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_pool_worker,
+        )
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.queue_size
+
+    async def run(self, func, *args):
+        if self.executor is None:
+            # Never on the loop's default thread pool, which would run
+            # searches beside /time
+            raise RuntimeError("astronomy pool not started; enable the lifespan")
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+
+ASTRONOMY_POOL = AstronomyPool(ASTRONOMY_POOL_SIZE, ASTRONOMY_QUEUE_SIZE)
+
+STREAM_HUB = stream.StreamHub(
+    lambda timezone, location: ASTRONOMY_POOL.run(
+        stream.compute_almanac, timezone, location
+    )
+)
+
+BUSY_RESPONSE = (503, [("Retry-After", "1"), ("Content-Length", "0")], b"")
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            ASTRONOMY_POOL.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            STREAM_HUB.close()
+            ASTRONOMY_POOL.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if scope["path"] == "/stream":
+        await stream.serve(STREAM_HUB, scope, receive, send)
+        return
+
+    args = (
+        scope["method"],
+        scope["path"],
+        scope["query_string"].decode("latin-1"),
+        [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        ],
+    )
+    if scope["path"] in LOOP_PATHS and not (
+        DEVICE_REGISTRY.enabled
+        and any(name == b"x-device-id" for name, _ in scope["headers"])
+    ):
+        status, headers, body = handle_request(*args)
+    elif scope["path"] in LOOP_PATHS:
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(
+            REGISTRY_EXECUTOR, handle_request, *args
+        )
+    elif ASTRONOMY_POOL.full:
+        status, headers, body = BUSY_RESPONSE
+    else:
+        status, headers, body = await ASTRONOMY_POOL.run(handle_request, *args)
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Compute sun and moon timelines for many locations at once.
+
+The Sun's and Moon's apparent positions are the same for every observer at a
+given instant, so they are evaluated once with skyfield on a shared time grid.
+Each observer's topocentric altitude at every grid point is then a NumPy
+expression over (observer, time) arrays, horizon crossings are found between
+grid points and refined by interpolating the positions, and the timelines go
+into the almanac cache:
+
+    uv run python batch_almanac.py locations.csv
+    uv run python batch_almanac.py locations.csv --snapshot snapshot.bin
+    uv run python batch_almanac.py --random 500 --compare 20
+
+Each line of the input is ``zone,latitude,longitude``. Each location's
+``/almanac`` items are printed as a JSON line, and the throughput to stderr.
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from collections.abc import Iterable, Sequence
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from flask import g
+
+import app
+
+GRID_STEP_SECONDS = 600.0
+OBSERVER_BLOCK = 512
+DAY = 24 * 3600
+
+# Where each body counts as up, as in skyfield's sunrise_sunset and
+# risings_and_settings
+HORIZON_DEGREES = {
+    "sun": -0.8333,
+    "moon": -34.0 / 60.0 - app.MOON_RADIUS_DEGREES,
+}
+
+# WGS84 ellipsoid
+EARTH_RADIUS_KM = 6378.137
+EARTH_FLATTENING = 1 / 298.257223563
+EARTH_E2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+
+
+def body_positions(body: str, timestamps) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Geocentric apparent position of ``body`` in km, in the true equator and
+    equinox of date, with shape (3, len(timestamps)), and Greenwich apparent
+    sidereal time in radians, unwrapped so it can be interpolated.
+    """
+    from skyfield import framelib
+
+    ephemeris = app.get_ephemeris()
+    # Counting seconds from the first day rather than from 1970, where they
+    # would include every leap second since
+    day = math.floor(timestamps[0] / DAY)
+    t = app.get_timescale().utc(1970, 1, 1 + day, 0, 0, timestamps - day * DAY)
+    position = ephemeris["earth"].at(t).observe(ephemeris[body]).apparent()
+    xyz = position.frame_xyz(framelib.true_equator_and_equinox_of_date).km
+    return xyz, np.unwrap(t.gast * (math.pi / 12))
+
+
+def observer_coordinates(latitudes, longitudes) -> tuple[np.ndarray, ...]:
+    """
+    Each observer's distance from the Earth's axis and height above the
+    equator in km, and geodetic latitude and longitude in radians.
+    """
+    latitude = np.radians(np.asarray(latitudes, dtype=float))
+    longitude = np.radians(np.asarray(longitudes, dtype=float))
+    radius = EARTH_RADIUS_KM / np.sqrt(1 - EARTH_E2 * np.sin(latitude) ** 2)
+    return (
+        radius * np.cos(latitude),
+        radius * (1 - EARTH_E2) * np.sin(latitude),
+        latitude,
+        longitude,
+    )
+
+
+def altitudes(position, angle, observer) -> np.ndarray:
+    """
+    Topocentric altitude in degrees of a body at geocentric ``position`` for
+    observers given by ``observer_coordinates``, with the Earth turned to
+    sidereal ``angle``. The arguments broadcast against each other.
+    """
+    axis_distance, height, latitude, longitude = observer
+    hour_angle = longitude + angle
+    cos_hour, sin_hour = np.cos(hour_angle), np.sin(hour_angle)
+    x = position[0] - axis_distance * cos_hour
+    y = position[1] - axis_distance * sin_hour
+    z = position[2] - height
+    up = np.cos(latitude) * (x * cos_hour + y * sin_hour) + np.sin(latitude) * z
+    return np.degrees(np.arcsin(up / np.sqrt(x * x + y * y + z * z)))
+
+
+def find_crossings(body, samples, position, angle, observer, iterations=5):
+    """
+    Every horizon crossing of ``body`` for a block of observers, as arrays of
+    observer index, timestamp and whether it's a rising, and whether the body
+    is up at the first sample for each observer.
+
+    Crossings are refined with vectorised secant steps on positions
+    interpolated linearly between grid points, which is accurate to well
+    under a second over GRID_STEP_SECONDS.
+    """
+    horizon = HORIZON_DEGREES[body]
+    heights = (
+        altitudes(
+            position[:, np.newaxis, :],
+            angle,
+            tuple(value[:, np.newaxis] for value in observer),
+        )
+        - horizon
+    )
+    is_up = heights > 0
+    observers, intervals = np.nonzero(is_up[:, 1:] != is_up[:, :-1])
+    low, high = samples[intervals], samples[intervals + 1]
+    crossing_observer = tuple(value[observers] for value in observer)
+
+    def height_at(timestamps):
+        fraction = (timestamps - low) / (high - low)
+        return (
+            altitudes(
+                position[:, intervals]
+                + fraction * (position[:, intervals + 1] - position[:, intervals]),
+                angle[intervals] + fraction * (angle[intervals + 1] - angle[intervals]),
+                crossing_observer,
+            )
+            - horizon
+        )
+
+    previous, previous_height = low, heights[observers, intervals]
+    times, height = high, heights[observers, intervals + 1]
+    for _ in range(iterations):
+        if not len(times):
+            break
+        change = height - previous_height
+        correction = np.divide(
+            height * (times - previous),
+            change,
+            out=np.zeros_like(change),
+            where=change != 0,
+        )
+        previous, previous_height = times, height
+        times = np.clip(times - correction, low, high)
+        height = height_at(times)
+
+    return observers, times, is_up[observers, intervals + 1], is_up[:, 0]
+
+
+def compute_timelines(
+    locations: Sequence[tuple[float, float]],
+    now: float,
+    days: float = app.ALMANAC_SEARCH_DAYS + app.TIMELINE_EXTEND_DAYS,
+) -> dict[tuple, app.EventTimeline]:
+    """
+    The sun and moon timelines from ``now`` to ``days`` later at each snapped
+    location, keyed as in the almanac cache.
+    """
+    end = now + days * DAY
+    samples = np.append(np.arange(now, end, GRID_STEP_SECONDS), end)
+    timelines = {}
+    for body in ("sun", "moon"):
+        position, angle = body_positions(body, samples)
+        for first in range(0, len(locations), OBSERVER_BLOCK):
+            block = locations[first : first + OBSERVER_BLOCK]
+            observer = observer_coordinates(*zip(*block))
+            observers, times, events, is_up = find_crossings(
+                body, samples, position, angle, observer
+            )
+            # np.nonzero gives each observer's crossings in time order
+            bounds = np.searchsorted(observers, np.arange(len(block) + 1))
+            for index, location in enumerate(block):
+                found = slice(bounds[index], bounds[index + 1])
+                timelines[(body, *location)] = app.EventTimeline(
+                    now,
+                    end,
+                    tuple(times[found].tolist()),
+                    tuple(events[found].tolist()),
+                    bool(is_up[index]),
+                )
+    return timelines
+
+
+def precompute(
+    locations: Iterable[tuple[str, float, float]],
+    now: float | None = None,
+    cache=None,
+) -> dict[tuple, app.EventTimeline]:
+    """
+    Compute and cache the sun and moon timelines of every (zone, latitude,
+    longitude), in ``app.ALMANAC_CACHE`` by default. Locations in the same
+    grid cell are computed once.
+    """
+    now = time.time() if now is None else now
+    cache = app.ALMANAC_CACHE if cache is None else cache
+    snapped = list(
+        dict.fromkeys(
+            app.snap_location(latitude, longitude)
+            for _, latitude, longitude in locations
+        )
+    )
+    timelines = compute_timelines(snapped, now)
+    for key, timeline in timelines.items():
+        cache.put(key, timeline)
+    return timelines
+
+
+def almanac_items(zone: str, latitude: float, longitude: float) -> list[list]:
+    """A location's ``/almanac`` items, answered from the cache."""
+    with app.app.test_request_context(
+        headers={"X-Location": "%r,%r" % (latitude, longitude)}
+    ):
+        g.tzinfo = ZoneInfo(zone)
+        return app.get_almanac_items()
+
+
+def per_call_timelines(locations, now: float) -> dict[tuple, app.EventTimeline]:
+    """The same timelines from one ``update_timeline`` search per location and
+    body, as requests compute them."""
+    cache = app.AlmanacCache(2 * len(locations))
+    for location in locations:
+        for body in ("sun", "moon"):
+            app.update_timeline(cache, body, location, now)
+    return dict(cache.items())
+
+
+def largest_difference(timelines, expected) -> float | None:
+    """The largest difference in seconds between matching events, or None if
+    any timeline has different events or state."""
+    largest = 0.0
+    for key, timeline in expected.items():
+        found = timelines[key]
+        if found.events != timeline.events or found.is_up != timeline.is_up:
+            return None
+        for first, second in zip(found.times, timeline.times):
+            largest = max(largest, abs(first - second))
+    return largest
+
+
+def read_locations(lines: Iterable[str]) -> list[tuple[str, float, float]]:
+    locations = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            zone, latitude, longitude = line.split(",")
+            locations.append((zone.strip(), float(latitude), float(longitude)))
+    return locations
+
+
+def random_locations(count: int) -> list[tuple[str, float, float]]:
+    """Locations spread over the inhabited latitudes, all displayed in UTC."""
+    return [
+        ("UTC", random.uniform(-55, 60), random.uniform(-180, 180))
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "file", nargs="?", help="zone,latitude,longitude lines, - for stdin"
+    )
+    parser.add_argument(
+        "--random", type=int, default=0, help="add this many random locations"
+    )
+    parser.add_argument("--snapshot", help="save the results to this snapshot file")
+    parser.add_argument(
+        "--compare",
+        type=int,
+        default=0,
+        metavar="N",
+        help="also time the per-call path on the first N locations",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="don't print the almanac items"
+    )
+    args = parser.parse_args()
+
+    locations = random_locations(args.random)
+    if args.file == "-":
+        locations += read_locations(sys.stdin)
+    elif args.file:
+        with open(args.file) as file:
+            locations += read_locations(file)
+    if not locations:
+        parser.error("no locations: give a file or --random")
+    # Keep every location's timelines for the output and the snapshot
+    if len(locations) * 2 > app.ALMANAC_CACHE.max_size:
+        app.ALMANAC_CACHE.max_size = len(locations) * 2
+
+    # Load the ephemeris and timescale before timing
+    app.get_ephemeris()
+    app.get_timescale()
+    now = time.time()
+    started = time.perf_counter()
+    timelines = precompute(locations, now)
+    seconds = time.perf_counter() - started
+    print(
+        "Batch: %d locations (%d grid cells) in %.3fs, %.0f locations/s"
+        % (len(locations), len(timelines) // 2, seconds, len(locations) / seconds),
+        file=sys.stderr,
+    )
+
+    if args.compare:
+        compared = list(
+            dict.fromkeys(
+                app.snap_location(latitude, longitude)
+                for _, latitude, longitude in locations[: args.compare]
+            )
+        )
+        started = time.perf_counter()
+        expected = per_call_timelines(compared, now)
+        per_call_seconds = time.perf_counter() - started
+        difference = largest_difference(timelines, expected)
+        print(
+            "Per call (%s): %d locations in %.3fs, %.1f locations/s"
+            % (
+                type(app.ENGINE).__name__,
+                len(compared),
+                per_call_seconds,
+                len(compared) / per_call_seconds,
+            ),
+            file=sys.stderr,
+        )
+        print(
+            "Largest difference: %s"
+            % ("events differ" if difference is None else "%.2fs" % difference),
+            file=sys.stderr,
+        )
+
+    if not args.quiet:
+        for zone, latitude, longitude in locations:
+            print(
+                json.dumps(
+                    {
+                        "zone": zone,
+                        "location": [latitude, longitude],
+                        "almanac": almanac_items(zone, latitude, longitude),
+                    }
+                )
+            )
+
+    if args.snapshot:
+        app.save_snapshot(args.snapshot, now)
+
+
+if __name__ == "__main__":
+    main()
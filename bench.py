@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the hot paths in app.py.
+
+Runs offline against the local ephemeris. Prints the median, best and
+interquartile range per call, and with ``--output`` writes them as JSON for
+``--compare`` to diff against a later run:
+
+    uv run python bench.py --output before.json
+    uv run python bench.py --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from zoneinfo import ZoneInfo
+
+from werkzeug.test import EnvironBuilder
+
+# A background warm-up pass would skew the timings
+os.environ.setdefault("ALMANAC_WARMER_INTERVAL", "0")
+
+import app as server  # noqa: E402
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7128,-74.0060"}
+
+DST_ZONES = [
+    "America/New_York",
+    "America/Los_Angeles",
+    "America/Santiago",
+    "America/Havana",
+    "Europe/London",
+    "Europe/Berlin",
+    "Africa/Cairo",
+    "Asia/Jerusalem",
+    "Australia/Sydney",
+    "Australia/Lord_Howe",
+    "Pacific/Auckland",
+    "Pacific/Chatham",
+]
+# Including zones that have since stopped observing DST
+NO_DST_ZONES = [
+    "UTC",
+    "America/Phoenix",
+    "Asia/Tokyo",
+    "America/Sao_Paulo",
+    "Europe/Moscow",
+    "Asia/Tehran",
+]
+
+# Seconds from a zone's next transition, covering each branch of the lookup
+DST_POSITIONS = {
+    "30 days before": -30 * 86400,
+    "3 hours before": -3 * 3600,
+    "1 hour before": -3600,
+    "1 second before": -1,
+    "1 second after": 1,
+}
+
+# Latitude, longitude, timezone
+LOCATIONS = {
+    "equator": (0.0, -78.5, "America/Guayaquil"),
+    "new york": (40.7128, -74.006, "America/New_York"),
+    "sydney": (-33.87, 151.21, "Australia/Sydney"),
+    "helsinki": (60.17, 24.94, "Europe/Helsinki"),
+    "tromso": (69.65, 18.96, "Europe/Oslo"),
+    "svalbard": (78.22, 15.65, "Arctic/Longyearbyen"),
+}
+
+ASTRONOMY_HELPERS = {
+    "get_next_sun_event": server.get_next_sun_event,
+    "get_next_sun_event(1)": lambda: server.get_next_sun_event(1),
+    "get_next_moon_event": server.get_next_moon_event,
+    "get_next_moon_event(1)": lambda: server.get_next_moon_event(1),
+    "get_sun_state": server.get_sun_state,
+    "get_moon_state": server.get_moon_state,
+    "get_moon_phase": server.get_moon_phase,
+}
+
+
+def bench(results, name, func, repeat=5, min_time=0.2):
+    """
+    Time ``func``, calibrating the number of calls per run so each run takes
+    at least ``min_time`` seconds. Print and record the per-call statistics.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if number < 100 else 2
+    timings = [timing / number for timing in timer.repeat(repeat, number)]
+    quartiles = statistics.quantiles(timings, n=4, method="inclusive")
+    result = {
+        "name": name,
+        "number": number,
+        "repeat": repeat,
+        "median_us": statistics.median(timings) * 1e6,
+        "best_us": min(timings) * 1e6,
+        "iqr_us": (quartiles[2] - quartiles[0]) * 1e6,
+    }
+    results.append(result)
+    print(
+        "%-58s median %10.1f us   best %10.1f us   iqr %8.1f us"
+        % (name, result["median_us"], result["best_us"], result["iqr_us"])
+    )
+
+
+def next_transition(tzinfo: ZoneInfo, after: float) -> float:
+    """Timestamp of the first transition of ``tzinfo`` after ``after``."""
+    chunk = int(after // server.DST_CHUNK_SECONDS)
+    for search_chunk in range(chunk, chunk + 3):
+        timestamps, _ = server.get_dst_transitions(tzinfo, search_chunk)
+        for timestamp in timestamps:
+            if timestamp > after:
+                return timestamp
+    raise ValueError("%s has no upcoming transitions" % tzinfo.key)
+
+
+def dst_cases(results, now: float):
+    zones = [ZoneInfo(zone) for zone in DST_ZONES]
+    no_dst_zones = [ZoneInfo(zone) for zone in NO_DST_ZONES]
+    transitions = [next_transition(tzinfo, now) for tzinfo in zones]
+
+    for position, offset in DST_POSITIONS.items():
+        times = [
+            datetime.datetime.fromtimestamp(transition + offset, tzinfo)
+            for tzinfo, transition in zip(zones, transitions)
+        ]
+        pairs = list(zip(zones, times))
+
+        def lookup_all(pairs=pairs):
+            for tzinfo, current_time in pairs:
+                server.get_next_dst_transition(tzinfo, current_time)
+
+        # Per call, averaged over the zones
+        bench(
+            results,
+            "dst: %s transition (x%d zones)" % (position, len(pairs)),
+            lookup_all,
+        )
+        results[-1]["per_zone_us"] = results[-1]["median_us"] / len(pairs)
+
+    now_times = [
+        (tzinfo, datetime.datetime.fromtimestamp(now, tzinfo))
+        for tzinfo in no_dst_zones
+    ]
+    bench(
+        results,
+        "dst: no-DST zones (x%d zones)" % len(now_times),
+        lambda: [server.get_next_dst_transition(*pair) for pair in now_times],
+    )
+
+    def cold_lookup():
+        server.get_dst_transitions.cache_clear()
+        server.DST_TABLES.clear()
+        server.get_next_dst_transition(zones[0], datetime.datetime.now(zones[0]))
+
+    bench(results, "dst: cold lookup, builds two chunk tables", cold_lookup)
+
+
+def astronomy_cases(results, cold: bool):
+    for location_name, (latitude, longitude, timezone) in LOCATIONS.items():
+        headers = {"X-Location": "%s,%s" % (latitude, longitude)}
+        headers["X-Timezone"] = timezone
+        for helper_name, helper in ASTRONOMY_HELPERS.items():
+            if cold and helper is server.get_moon_phase:
+                # Doesn't use the almanac cache; see "moon phase table build"
+                continue
+
+            def call(headers=headers, helper=helper):
+                if cold:
+                    server.ALMANAC_CACHE.clear()
+                with server.app.test_request_context(headers=headers):
+                    server.app.preprocess_request()
+                    try:
+                        helper()
+                    except IndexError:
+                        # No such event in the window, e.g. polar day
+                        pass
+
+            bench(
+                results,
+                "%s: %s @ %s"
+                % ("cold" if cold else "warm", helper_name, location_name),
+                call,
+                repeat=3 if cold else 5,
+            )
+
+
+def request_cases(results):
+    client = server.app.test_client()
+
+    def empty_request_context():
+        with server.app.test_request_context(headers=HEADERS):
+            server.app.preprocess_request()
+
+    def build_astronomy_context():
+        astronomy = server.AstronomyContext(HEADERS["X-Location"])
+        astronomy.t_now
+        astronomy.observer
+
+    bench(results, "request context + before_request", empty_request_context)
+    bench(results, "astronomy context (Time + observer)", build_astronomy_context)
+    bench(
+        results,
+        "moon phase table build",
+        lambda: server.MOON_PHASE_TABLE.build(time.time()),
+        repeat=3,
+    )
+    for path in ("/time", "/time?fmt=bin", "/motd", "/motd?fmt=bin", "/almanac"):
+        # Warm the almanac cache, so /motd's random pick doesn't decide the cost
+        client.get(path, headers=HEADERS)
+        bench(results, "request: %s" % path, lambda: client.get(path, headers=HEADERS))
+
+    # /time as a server calls the app, through Flask and through the fast path
+    environ = EnvironBuilder(path="/time", headers=HEADERS).get_environ()
+
+    def call_wsgi(wsgi_app):
+        for chunk in wsgi_app(dict(environ), lambda status, headers: None):
+            pass
+
+    fast_path = server.TimeFastPath(server.app.wsgi_app)
+    bench(results, "wsgi: /time", lambda: call_wsgi(server.app.wsgi_app))
+    bench(results, "wsgi: /time, fast path", lambda: call_wsgi(fast_path))
+
+    # The same requests from a registered device, answered from its payload
+    with tempfile.TemporaryDirectory() as directory:
+        original_registry = server.DEVICE_REGISTRY
+        server.DEVICE_REGISTRY = server.device_registry.DeviceRegistry(
+            os.path.join(directory, "devices.db"), flush_interval=3600
+        )
+        device_headers = {"X-Device-Id": "bench"}
+        try:
+            client.get("/almanac", headers={**HEADERS, **device_headers})
+            for path in ("/time", "/motd", "/almanac"):
+                bench(
+                    results,
+                    "request: %s, registered device" % path,
+                    lambda: client.get(path, headers=device_headers),
+                )
+        finally:
+            server.DEVICE_REGISTRY.flush()
+            server.DEVICE_REGISTRY = original_registry
+
+
+GROUPS = {
+    "dst": lambda results: dst_cases(results, time.time()),
+    "warm": lambda results: astronomy_cases(results, cold=False),
+    "cold": lambda results: astronomy_cases(results, cold=True),
+    "request": request_cases,
+}
+
+
+def get_metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "date": datetime.datetime.now(datetime.UTC).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "engine": os.getenv("ASTRONOMY_ENGINE", "skyfield"),
+        "ephemeris": os.getenv("EPHEMERIS_FILE", "de421.bsp"),
+    }
+
+
+def compare(results, path: str):
+    """Print each result's median against the same benchmark in ``path``."""
+    with open(path) as file:
+        previous = {result["name"]: result for result in json.load(file)["results"]}
+    print("\nCompared with %s:" % path)
+    for result in results:
+        if result["name"] not in previous:
+            continue
+        before = previous[result["name"]]["median_us"]
+        print(
+            "%-58s %10.1f -> %10.1f us  %+7.1f%%"
+            % (
+                result["name"],
+                before,
+                result["median_us"],
+                (result["median_us"] / before - 1) * 100,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "groups",
+        nargs="*",
+        default=list(GROUPS),
+        help="Benchmark groups to run: %s (default: all)" % ", ".join(GROUPS),
+    )
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare with results from --output")
+    args = parser.parse_args()
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error("unknown group %r" % group)
+
+    results = []
+    for group in args.groups:
+        GROUPS[group](results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"metadata": get_metadata(), "results": results}, file, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Optional registry of devices, stored in a local SQLite database.
+
+A device sending ``X-Device-Id`` is registered with its timezone, snapped
+location and almanac payload, which stays valid until its next event. Later
+requests from it can leave out ``X-Timezone`` and ``X-Location``, and are
+answered from the registered payload with one keyed lookup, until it expires.
+
+Each process keeps the devices it has seen most recently in memory, and
+checks each one against its row's update time, so a device registered again
+by another process is reloaded. Registrations and last-seen times are queued
+and written by a background thread every ``flush_interval`` seconds, so
+requests never wait on a write. Devices not seen for ``ttl`` seconds, and
+the least recently seen past ``max_devices``, are deleted as they're written,
+so made-up IDs can't grow the database without bound.
+"""
+
+import atexit
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    timezone TEXT NOT NULL,
+    location_header TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    payload TEXT NOT NULL,
+    expires REAL NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    updated REAL NOT NULL DEFAULT 0
+)
+"""
+LAST_SEEN_INDEX = "CREATE INDEX IF NOT EXISTS devices_last_seen ON devices (last_seen)"
+
+
+class Device(NamedTuple):
+    """A registered device and its precomputed almanac payload."""
+
+    timezone: str
+    tzinfo: ZoneInfo
+    # As the device sent it, to tell whether it has moved without re-parsing
+    location_header: str
+    # Snapped to the almanac grid
+    location: tuple[float, float]
+    # The almanac items in ALMANAC_ITEMS order, None where there's no event
+    payload: list[list | None]
+    expires: float
+
+
+class DeviceRegistry:
+    """
+    Devices by ID, in the SQLite database at ``path`` and, up to
+    ``cache_size`` of the most recently used, in memory. The database keeps
+    at most ``max_devices``, each until it hasn't been seen for ``ttl``
+    seconds.
+
+    Disabled, remembering nothing, when ``path`` is empty.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float,
+        cache_size: int = 4096,
+        ttl: float = 30 * 24 * 3600,
+        max_devices: int = 100_000,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.max_devices = max_devices
+        # Each device with the time it was registered, which is also written
+        # to its row as ``updated``
+        self._devices: collections.OrderedDict[str, tuple[Device, float]] = (
+            collections.OrderedDict()
+        )
+        self._pending_devices: dict[str, tuple[Device, float]] = {}
+        self._pending_seen: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; WAL lets lookups read during a flush
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(SCHEMA)
+            columns = {
+                row[1] for row in connection.execute("PRAGMA table_info(devices)")
+            }
+            if "updated" not in columns:
+                # A database from before rows recorded their update time
+                connection.execute(
+                    "ALTER TABLE devices ADD COLUMN updated REAL NOT NULL DEFAULT 0"
+                )
+            connection.execute(LAST_SEEN_INDEX)
+            self._local.connection = connection
+        return connection
+
+    def lookup(self, device_id: str) -> Device | None:
+        """
+        The registered device. The one in memory is used unless its row has
+        been updated since, by another process, or it's waiting to be written.
+        """
+        with self._lock:
+            cached = self._devices.get(device_id)
+            if cached is not None:
+                self._devices.move_to_end(device_id)
+                if device_id in self._pending_devices:
+                    return cached[0]
+        row = (
+            self._connection()
+            .execute(
+                "SELECT timezone, location_header, latitude, longitude, payload,"
+                " expires, updated FROM devices WHERE device_id = ?",
+                (device_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            # Or registered here and being written
+            return None if cached is None else cached[0]
+        timezone, location_header, latitude, longitude, payload, expires, updated = row
+        if cached is not None and updated <= cached[1]:
+            return cached[0]
+        device = Device(
+            timezone,
+            ZoneInfo(timezone),
+            location_header,
+            (latitude, longitude),
+            json.loads(payload),
+            expires,
+        )
+        self._remember(device_id, device, updated)
+        return device
+
+    def register(self, device_id: str, device: Device):
+        """Register or update a device, queueing the write."""
+        updated = time.time()
+        with self._lock:
+            self._pending_devices[device_id] = (device, updated)
+        self._remember(device_id, device, updated)
+        self._start()
+
+    def _remember(self, device_id: str, device: Device, updated: float):
+        with self._lock:
+            self._devices[device_id] = (device, updated)
+            self._devices.move_to_end(device_id)
+            while len(self._devices) > self.cache_size:
+                self._devices.popitem(last=False)
+
+    def seen(self, device_id: str, now: float):
+        """Queue a device's last-seen time."""
+        with self._lock:
+            self._pending_seen[device_id] = now
+        self._start()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="device-registry", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self._flush_logging_errors)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_logging_errors()
+
+    def _flush_logging_errors(self):
+        try:
+            self.flush()
+        except sqlite3.Error:
+            logger.exception("Device registry flush failed")
+
+    def flush(self):
+        """
+        Write the queued registrations and last-seen times in one
+        transaction, deleting the devices that have gone unseen too long or
+        are past ``max_devices``.
+        """
+        with self._lock:
+            devices, self._pending_devices = self._pending_devices, {}
+            seen, self._pending_seen = self._pending_seen, {}
+        if not devices and not seen:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # A registration never replaces a newer one from another process
+            connection.executemany(
+                "INSERT INTO devices (device_id, timezone, location_header,"
+                " latitude, longitude, payload, expires, first_seen, last_seen,"
+                " updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (device_id) DO UPDATE SET timezone = excluded.timezone,"
+                " location_header = excluded.location_header,"
+                " latitude = excluded.latitude, longitude = excluded.longitude,"
+                " payload = excluded.payload, expires = excluded.expires,"
+                " updated = excluded.updated"
+                " WHERE excluded.updated >= devices.updated",
+                [
+                    (
+                        device_id,
+                        device.timezone,
+                        device.location_header,
+                        *device.location,
+                        json.dumps(device.payload),
+                        device.expires,
+                        seen.get(device_id, now),
+                        seen.get(device_id, now),
+                        updated,
+                    )
+                    for device_id, (device, updated) in devices.items()
+                ],
+            )
+            connection.executemany(
+                "UPDATE devices SET last_seen = ? WHERE device_id = ?",
+                [(last_seen, device_id) for device_id, last_seen in seen.items()],
+            )
+            pruned = connection.execute(
+                "DELETE FROM devices WHERE last_seen < ?", (now - self.ttl,)
+            ).rowcount
+            if devices:
+                # Only registrations add rows
+                pruned += connection.execute(
+                    "DELETE FROM devices WHERE device_id IN (SELECT device_id"
+                    " FROM devices ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                    (self.max_devices,),
+                ).rowcount
+        if devices or pruned:
+            device_count, location_count = self.counts()
+            metrics.REGISTERED_DEVICES.set(device_count)
+            metrics.REGISTERED_LOCATIONS.set(location_count)
+
+    def counts(self) -> tuple[int, int]:
+        """Devices registered, and distinct snapped locations among them."""
+        return (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*), COUNT(DISTINCT latitude || ',' || longitude)"
+                " FROM devices"
+            )
+            .fetchone()
+        )
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+
+# Import the app and load the ephemeris once in the master process so forked
+# workers share them. Set PRELOAD_APP=0 to load them in each worker instead.
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+
+# Threads per worker. More than one switches to the gthread worker, whose
+# threads share the worker's ephemeris and caches (see PERFORMANCE.md).
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# Workers write their metrics here, for /metrics to add up across workers.
+# It has to be set before the app imports prometheus_client, and emptied so
+# counts from an earlier run aren't included.
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), "matrix-portal-metrics"),
+)
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+# Workers share almanac timelines and DST tables through this database (see
+# SHARED_CACHE.md). Set SHARED_CACHE= to give each worker its own cache. It's
+# emptied so tables built with an earlier run's tzdata aren't used.
+shared_cache = os.environ.setdefault(
+    "SHARED_CACHE", os.path.join(tempfile.gettempdir(), "matrix-portal-cache.db")
+)
+for suffix in ("", "-wal", "-shm"):
+    if shared_cache and os.path.exists(shared_cache + suffix):
+        os.remove(shared_cache + suffix)
+
+# Computed tables are saved here and restored when the server starts again
+# (see SNAPSHOT.md). The temporary directory doesn't outlive a container, so
+# the Docker image sets it to a file on its volume instead.
+os.environ.setdefault(
+    "SNAPSHOT_FILE", os.path.join(tempfile.gettempdir(), "matrix-portal-snapshot.bin")
+)
+
+
+def when_ready(server):
+    if preload_app:
+        from app import preload_shared_state
+
+        preload_shared_state()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Measure /time latency while /motd is saturated with uncached locations.
+
+Starts the server, times /time requests on their own, then again while
+``--clients`` threads keep requesting /motd for random locations:
+
+    uv run python load_test.py --server sync
+    uv run python load_test.py --server threaded
+    uv run python load_test.py --server async
+
+It finishes with those /motd requests' latency and throughput, and the memory
+held by the server and all its processes. ``--time-throughput`` instead
+measures how many /time requests ``--clients`` threads get answered:
+
+    TIME_FAST_PATH=1 uv run python load_test.py --server sync --time-throughput
+"""
+
+import argparse
+import http.client
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+SERVERS = {
+    "sync": ["gunicorn", "-w", "4", "-b", "127.0.0.1:{port}", "app:app"],
+    "threaded": [
+        "gunicorn",
+        "-w",
+        "1",
+        "--threads",
+        "4",
+        "-b",
+        "127.0.0.1:{port}",
+        "app:app",
+    ],
+    "async": ["uvicorn", "async_app:app", "--host", "127.0.0.1", "--port", "{port}"],
+}
+
+
+def request(port: int, path: str, headers: dict | None = None) -> tuple[int, float]:
+    """Make one request on a new connection, returning its status and seconds."""
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        connection.close()
+
+
+def wait_until_ready(port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if request(port, "/time")[0] == 200:
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError("server did not start")
+
+
+def time_latencies(port: int, duration: float, interval: float) -> list[float]:
+    """/time latencies in milliseconds, one request every ``interval`` seconds."""
+    latencies = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        status, seconds = request(port, "/time", {"X-Timezone": "America/New_York"})
+        assert status == 200, status
+        latencies.append(seconds * 1000)
+        time.sleep(interval)
+    return latencies
+
+
+def time_throughput(port: int, clients: int, duration: float) -> float:
+    """/time requests answered per second with ``clients`` threads requesting
+    it back to back."""
+    counts = [0] * clients
+    deadline = time.monotonic() + duration
+
+    def run(index):
+        while time.monotonic() < deadline:
+            status, _ = request(port, "/time", {"X-Timezone": "America/New_York"})
+            assert status == 200, status
+            counts[index] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / duration
+
+
+def saturate_motd(
+    port: int, stop: threading.Event, statuses: list[int], latencies: list[float]
+):
+    """Request /motd for random locations, so each misses the almanac cache."""
+    while not stop.is_set():
+        location = f"{random.uniform(-60, 60):.3f},{random.uniform(-180, 180):.3f}"
+        try:
+            status, seconds = request(port, "/motd", {"X-Location": location})
+        except OSError:
+            status = 0
+        else:
+            latencies.append(seconds * 1000)
+        statuses.append(status)
+
+
+def rss_mb(pid: int) -> float:
+    """Resident memory of a process and all its descendants, in MB."""
+    with open(f"/proc/{pid}/status") as status:
+        rss = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+    with open(f"/proc/{pid}/task/{pid}/children") as children:
+        return rss / 1024 + sum(rss_mb(int(child)) for child in children.read().split())
+
+
+def summarize(name: str, latencies: list[float]):
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(
+        f"{name:>10}: n={len(latencies):4}"
+        f"  p50={quantiles[49]:7.2f} ms  p99={quantiles[98]:7.2f} ms"
+        f"  max={max(latencies):7.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--server", choices=SERVERS, default="async")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument(
+        "--time-throughput",
+        action="store_true",
+        help="only measure /time throughput from --clients threads",
+    )
+    args = parser.parse_args()
+
+    command = [part.format(port=args.port) for part in SERVERS[args.server]]
+    server = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_ready(args.port)
+        if args.time_throughput:
+            throughput = time_throughput(args.port, args.clients, args.duration)
+            print(f"{args.server} server, {args.clients} /time clients")
+            print(f"     /time: {throughput:.1f} req/s")
+            return
+        print(f"{args.server} server, {args.clients} /motd clients")
+        summarize("idle", time_latencies(args.port, args.duration, args.interval))
+
+        stop = threading.Event()
+        statuses = []
+        motd_latencies = []
+        clients = [
+            threading.Thread(
+                target=saturate_motd, args=(args.port, stop, statuses, motd_latencies)
+            )
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        try:
+            summarize(
+                "saturated",
+                time_latencies(args.port, args.duration, args.interval),
+            )
+        finally:
+            stop.set()
+            for client in clients:
+                client.join()
+
+        summarize("/motd", motd_latencies)
+        completed = statuses.count(200)
+        print(
+            f"     /motd: {completed / args.duration:.1f} req/s,"
+            f" {statuses.count(503)} rejected, "
+            f"{len(statuses) - completed - statuses.count(503)} failed"
+        )
+        print(f"    memory: {rss_mb(server.pid):.1f} MB")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
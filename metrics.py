@@ -0,0 +1,141 @@
+"""
+Prometheus metrics for the server.
+
+When ``PROMETHEUS_MULTIPROC_DIR`` is set (gunicorn.conf.py and async_app.py
+set it), each process writes its samples to memory-mapped files in that
+directory and ``render()`` adds them up across every process, so ``/metrics``
+reports the whole server rather than whichever worker answered.
+"""
+
+import functools
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# prometheus_client picks its storage when imported, so decide once here too
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# From 50 µs cache hits to multi-second cold searches
+LATENCY_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    10.0,
+)
+
+REQUESTS = Counter(
+    "matrix_portal_requests",
+    "Requests by endpoint and status code",
+    ["endpoint", "status"],
+)
+REQUEST_SECONDS = Histogram(
+    "matrix_portal_request_seconds",
+    "Request latency by endpoint",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+MOTD_BRANCH_SECONDS = Histogram(
+    "matrix_portal_motd_branch_seconds",
+    "Latency of each /motd branch",
+    ["branch"],
+    buckets=LATENCY_BUCKETS,
+)
+HELPER_SECONDS = Histogram(
+    "matrix_portal_helper_seconds",
+    "Latency of the almanac and DST helpers",
+    ["helper"],
+    buckets=LATENCY_BUCKETS,
+)
+COALESCED_SEARCHES = Counter(
+    "matrix_portal_coalesced_searches",
+    "Almanac searches answered by an identical search already running",
+)
+MOTD_FALLBACKS = Counter(
+    "matrix_portal_motd_fallbacks",
+    "/motd requests answered with a fallback item by branch, because the"
+    " branch's computation missed the deadline",
+    ["branch"],
+)
+WARMER_SEARCHES = Counter(
+    "matrix_portal_warmer_searches",
+    "Almanac searches run by the background warm-up",
+)
+WARMER_REFRESHES = Counter(
+    "matrix_portal_warmer_refreshes",
+    "Timelines the background warm-up extended before they ran short",
+)
+WARMER_MISSES_AVOIDED = Counter(
+    "matrix_portal_warmer_misses_avoided",
+    "Almanac lookups answered from the cache only because the background"
+    " warm-up had extended the timeline",
+)
+WARMER_TRACKED_LOCATIONS = Gauge(
+    "matrix_portal_warmer_tracked_locations",
+    "Locations the background warm-up keeps warm, at its last pass",
+    multiprocess_mode="livesum",
+)
+WARMER_PASS_SECONDS = Histogram(
+    "matrix_portal_warmer_pass_seconds",
+    "Duration of each background warm-up pass",
+    buckets=LATENCY_BUCKETS,
+)
+# Set by each process after it writes to the device registry, which all of
+# them share, so the latest write is the current count
+REGISTERED_DEVICES = Gauge(
+    "matrix_portal_registered_devices",
+    "Devices in the device registry",
+    multiprocess_mode="mostrecent",
+)
+REGISTERED_LOCATIONS = Gauge(
+    "matrix_portal_registered_locations",
+    "Distinct snapped locations of the devices in the device registry",
+    multiprocess_mode="mostrecent",
+)
+
+
+def timed(func):
+    """Record each call's duration in ``HELPER_SECONDS`` under its name."""
+    # Bind the label once, so each call only pays for the observation
+    observe = HELPER_SECONDS.labels(func.__name__).observe
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+def render() -> tuple[bytes, str]:
+    """Return the metrics in the Prometheus text format, and its content type."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Merge the request profiles written with PROFILE_EVERY or X-Profile into a
+report of the hottest functions:
+
+    uv run python profile_report.py profiles --endpoint motd --top 20
+"""
+
+import argparse
+import collections
+import glob
+import os
+import pstats
+
+
+def parse_profile_name(path: str) -> tuple[str, str, str]:
+    """The endpoint, branch and timezone tags of a profile file."""
+    endpoint, branch, timezone, _pid, _ = os.path.basename(path).split(".")
+    return endpoint, branch, timezone.replace("~", "/")
+
+
+def find_profiles(
+    directory: str,
+    endpoint: str | None = None,
+    branch: str | None = None,
+    timezone: str | None = None,
+) -> list[str]:
+    """Profile files in ``directory`` matching the given tags."""
+    paths = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.prof"))):
+        tags = parse_profile_name(path)
+        if all(
+            wanted is None or wanted == tag
+            for wanted, tag in zip((endpoint, branch, timezone), tags)
+        ):
+            paths.append(path)
+    return paths
+
+
+def merge_profiles(paths: list[str]) -> pstats.Stats:
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("directory", help="PROFILE_DIR the server wrote to")
+    parser.add_argument("--endpoint", help="Only this endpoint, e.g. motd")
+    parser.add_argument("--branch", help="Only this /motd branch, e.g. moon_phase")
+    parser.add_argument("--timezone", help="Only this timezone, e.g. Europe/London")
+    parser.add_argument("--top", type=int, default=25, help="Functions to list")
+    parser.add_argument(
+        "--sort",
+        default="cumulative",
+        choices=["cumulative", "tottime", "ncalls"],
+        help="Sort order (default: cumulative)",
+    )
+    parser.add_argument(
+        "--full-paths", action="store_true", help="Keep full file paths"
+    )
+    args = parser.parse_args()
+
+    paths = find_profiles(args.directory, args.endpoint, args.branch, args.timezone)
+    if not paths:
+        parser.exit(1, "No matching profiles in %s\n" % args.directory)
+
+    files_per_tag = collections.Counter(parse_profile_name(path) for path in paths)
+    print("Merged %d profile files:" % len(paths))
+    for (endpoint, branch, timezone), count in sorted(files_per_tag.items()):
+        print("  %-10s %-22s %-30s %d" % (endpoint, branch, timezone, count))
+    print()
+
+    stats = merge_profiles(paths)
+    # The files are already listed above, with their tags
+    stats.files = []
+    if not args.full_paths:
+        stats.strip_dirs()
+    stats.sort_stats(args.sort).print_stats(args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Opt-in sampled request profiling.
+
+With ``PROFILE_EVERY=N``, every Nth request in each worker is run under
+cProfile. A request carrying ``X-Profile: <PROFILE_TOKEN>`` is always
+profiled. Profiles are added up per endpoint, ``/motd`` branch and timezone,
+and written to ``PROFILE_DIR`` for ``profile_report.py`` to merge.
+"""
+
+import cProfile
+import itertools
+import os
+import pstats
+import re
+import secrets
+import threading
+
+
+def _safe_tag(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_+~-]", "_", value.strip("/").replace("/", "~"))
+
+
+class RequestProfiler:
+    """
+    Decides which requests to profile and accumulates their profiles.
+
+    Only one request per process is profiled at a time, since only one
+    profiler can be active. A request picked while another is being
+    profiled just runs without it.
+    """
+
+    def __init__(self, every: int, directory: str, token: str = ""):
+        self.every = every
+        self.directory = directory
+        self.token = token
+        self._requests = itertools.count(1)
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        self._profiles = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.every > 0 or bool(self.token)
+
+    def should_profile(self, token: str | None) -> bool:
+        if self.token and token and secrets.compare_digest(token, self.token):
+            return True
+        return self.every > 0 and next(self._requests) % self.every == 0
+
+    def start(self, token: str | None = None) -> cProfile.Profile | None:
+        """Start profiling the current request if it's picked."""
+        if not self.should_profile(token):
+            return None
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, such as a debugger's, is already active
+            self._active.release()
+            return None
+        return profile
+
+    def stop(
+        self, profile: cProfile.Profile, endpoint: str, branch: str, timezone: str
+    ):
+        """
+        Stop ``profile`` and add it to the profile file for its tags. Each
+        combination of tags is kept in memory and written to its own file, so
+        they must come from a bounded set, not straight from the request.
+        """
+        profile.disable()
+        self._active.release()
+
+        tags = (endpoint, branch, timezone)
+        with self._lock:
+            stats = self._profiles.get(tags)
+            if stats is None:
+                stats = self._profiles[tags] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            os.makedirs(self.directory, exist_ok=True)
+            stats.dump_stats(self.path(*tags))
+
+    def path(self, endpoint: str, branch: str, timezone: str) -> str:
+        """Profile file for this process and these tags."""
+        name = ".".join(
+            [_safe_tag(tag) for tag in (endpoint, branch, timezone)]
+            + [str(os.getpid()), "prof"]
+        )
+        return os.path.join(self.directory, name)
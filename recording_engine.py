@@ -0,0 +1,38 @@
+"""Astronomy engine wrapper the tests use to count and slow down searches"""
+
+import time
+
+from app import ALMANAC_SEARCH_DAYS
+
+
+class RecordingEngine:
+    """
+    Wraps an astronomy engine, counting its searches and the days they
+    cover. Each search first sleeps for ``delay`` seconds, and raises
+    ``error`` instead of searching if it's set. ``running`` counts searches
+    in progress.
+    """
+
+    def __init__(self, engine, delay=0.0, error=None):
+        self.engine = engine
+        self.delay = delay
+        self.error = error
+        self.searches = 0
+        self.days_searched = 0.0
+        self.running = 0
+
+    def body_events(self, body, astronomy, days=ALMANAC_SEARCH_DAYS):
+        self.searches += 1
+        self.days_searched += days
+        self.running += 1
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            return self.engine.body_events(body, astronomy, days)
+        finally:
+            self.running -= 1
+
+    def moon_phase(self, timestamps):
+        return self.engine.moon_phase(timestamps)
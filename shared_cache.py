@@ -0,0 +1,173 @@
+"""
+Almanac timelines and DST tables shared by every worker on a host.
+
+Records are packed into fixed-size ``struct`` layouts and stored in a local
+SQLite database, which each process reads through a memory map, so the
+operating system keeps one copy of the pages however many workers read them.
+A record computed by one worker is used by all of them.
+
+Each write replaces a whole record in one statement, so readers see either
+the old record or the new one. Each record expires when it can no longer
+answer a lookup: a timeline at its end, a DST table at its chunk's end.
+"""
+
+import os
+import sqlite3
+import struct
+import threading
+
+# Events kept per timeline. About 6 fit in the window a timeline covers; one
+# with more is cut short at its last kept event and extended sooner.
+MAX_TIMELINE_EVENTS = 12
+# Transitions per DST chunk. Zones with more in a year aren't shared.
+MAX_DST_TRANSITIONS = 8
+
+# start, end, is up at start, event count, rise bitmask, event times
+TIMELINE_STRUCT = struct.Struct("<ddBBH%dd" % MAX_TIMELINE_EVENTS)
+# transition count, transition timestamps, offsets from each
+DST_STRUCT = struct.Struct("<B%dq%di" % (MAX_DST_TRANSITIONS, MAX_DST_TRANSITIONS))
+
+TABLES = ("timelines", "dst_transitions")
+
+# Memory map this much of the database, rather than copying pages into each
+# connection's private page cache
+MMAP_SIZE = 64 * 1024 * 1024
+
+
+def pack_timeline(
+    start: float,
+    end: float,
+    times: tuple[float, ...],
+    events: tuple[bool, ...],
+    is_up: bool,
+) -> bytes:
+    """Pack a timeline, cutting it short at MAX_TIMELINE_EVENTS events."""
+    if len(times) > MAX_TIMELINE_EVENTS:
+        times = times[:MAX_TIMELINE_EVENTS]
+        events = events[:MAX_TIMELINE_EVENTS]
+        end = times[-1]
+    rises = sum(1 << index for index, event in enumerate(events) if event)
+    padding = (0.0,) * (MAX_TIMELINE_EVENTS - len(times))
+    return TIMELINE_STRUCT.pack(start, end, is_up, len(times), rises, *times, *padding)
+
+
+def unpack_timeline(
+    record: bytes,
+) -> tuple[float, float, tuple[float, ...], tuple[bool, ...], bool]:
+    """The (start, end, times, events, is_up) of a packed timeline."""
+    start, end, is_up, count, rises, *times = TIMELINE_STRUCT.unpack(record)
+    return (
+        start,
+        end,
+        tuple(times[:count]),
+        tuple(bool(rises >> index & 1) for index in range(count)),
+        bool(is_up),
+    )
+
+
+def pack_dst_transitions(
+    timestamps: tuple[int, ...], offsets: tuple[int, ...]
+) -> bytes | None:
+    """Pack a DST table, or None if it has too many transitions to share."""
+    if len(timestamps) > MAX_DST_TRANSITIONS:
+        return None
+    padding = (0,) * (MAX_DST_TRANSITIONS - len(timestamps))
+    return DST_STRUCT.pack(len(timestamps), *timestamps, *padding, *offsets, *padding)
+
+
+def unpack_dst_transitions(record: bytes) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    count, *values = DST_STRUCT.unpack(record)
+    return (
+        tuple(values[:count]),
+        tuple(values[MAX_DST_TRANSITIONS : MAX_DST_TRANSITIONS + count]),
+    )
+
+
+class SharedCache:
+    """
+    Tables of packed records by key, in the SQLite database at ``path``.
+    Disabled when ``path`` is empty.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        # Connections a forked worker inherited. SQLite connections mustn't
+        # be used or closed across fork(), so they're kept open and unused.
+        self._inherited: list[sqlite3.Connection] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, and a new one in a forked worker
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            if connection is not None:
+                self._inherited.append(connection)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+            for table in TABLES:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY,"
+                    " record BLOB NOT NULL, expires REAL NOT NULL) WITHOUT ROWID"
+                    % table
+                )
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)"
+                    % (table, table)
+                )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def close(self):
+        """Close this thread's connection, as the master process does before
+        forking workers."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+            del self._local.connection
+
+    def get(self, table: str, key: str, now: float) -> bytes | None:
+        """The record for ``key``, unless it expired by ``now``."""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT record FROM %s WHERE key = ? AND expires > ?" % table,
+                (key, now),
+            )
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def put(self, table: str, key: str, record: bytes, expires: float):
+        """Replace the record for ``key`` in one atomic write."""
+        self._connection().execute(
+            "INSERT OR REPLACE INTO %s VALUES (?, ?, ?)" % table,
+            (key, record, expires),
+        )
+
+    def records(self, table: str, now: float) -> list[tuple[str, bytes]]:
+        """Every (key, record) in ``table`` that hasn't expired by ``now``."""
+        return (
+            self._connection()
+            .execute("SELECT key, record FROM %s WHERE expires > ?" % table, (now,))
+            .fetchall()
+        )
+
+    def purge(self, now: float):
+        """Delete every record that expired by ``now``."""
+        connection = self._connection()
+        for table in TABLES:
+            connection.execute("DELETE FROM %s WHERE expires <= ?" % table, (now,))
+
+    def count(self, table: str) -> int:
+        return (
+            self._connection().execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+        )
+
+    def clear(self, table: str):
+        self._connection().execute("DELETE FROM %s" % table)
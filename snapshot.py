@@ -0,0 +1,150 @@
+"""
+Snapshot of the almanac timelines, DST tables and moon phase table a server
+has computed, so a restarted server starts with them instead of computing
+them again.
+
+The file is a JSON header, recording the versions of the data the tables were
+computed from, followed by fixed-size ``struct`` records: timelines and DST
+tables in the layouts of ``shared_cache``. It's written to a temporary file
+and renamed over the old one, so a reader never sees half a snapshot.
+Processes merging their tables into it hold ``locked`` around the read and
+the write, so none drops the tables another wrote in between.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import struct
+from typing import NamedTuple
+
+import shared_cache
+
+MAGIC = b"MPSNAP1\n"
+
+HEADER_LENGTH_STRUCT = struct.Struct("<I")
+BODIES = ("sun", "moon")
+# body, latitude, longitude
+TIMELINE_KEY_STRUCT = struct.Struct("<Bdd")
+# zone name length, then the name, then the chunk
+ZONE_LENGTH_STRUCT = struct.Struct("<B")
+CHUNK_STRUCT = struct.Struct("<q")
+# start, end, change count, then the change times and count + 1 quarters
+MOON_PHASE_STRUCT = struct.Struct("<ddH")
+
+
+class Snapshot(NamedTuple):
+    """
+    Tables to save or restore, and the versions of the data they came from.
+
+    - timelines: (start, end, times, events, is_up) by (body, latitude,
+      longitude)
+    - dst_tables: (timestamps, offsets) by (zone name, chunk)
+    - moon_phase: (start, end, change times, quarters), or None
+    """
+
+    versions: dict
+    timelines: dict[tuple[str, float, float], tuple]
+    dst_tables: dict[tuple[str, int], tuple[tuple[int, ...], tuple[int, ...]]]
+    moon_phase: tuple | None
+
+
+@contextlib.contextmanager
+def locked(path: str):
+    """Hold an exclusive lock on ``path``, in a lock file beside it."""
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def write(path: str, snapshot: Snapshot):
+    """Write ``snapshot`` to ``path``, replacing it in one rename."""
+    dst_records = {}
+    for key, table in snapshot.dst_tables.items():
+        record = shared_cache.pack_dst_transitions(*table)
+        if record is not None:
+            dst_records[key] = record
+
+    header = json.dumps(
+        {
+            "versions": snapshot.versions,
+            "timelines": len(snapshot.timelines),
+            "dst_tables": len(dst_records),
+            "moon_phase": snapshot.moon_phase is not None,
+        }
+    ).encode()
+    parts = [MAGIC, HEADER_LENGTH_STRUCT.pack(len(header)), header]
+    for (body, latitude, longitude), timeline in snapshot.timelines.items():
+        parts.append(TIMELINE_KEY_STRUCT.pack(BODIES.index(body), latitude, longitude))
+        parts.append(shared_cache.pack_timeline(*timeline))
+    for (zone, chunk), record in dst_records.items():
+        name = zone.encode()
+        parts += [ZONE_LENGTH_STRUCT.pack(len(name)), name, CHUNK_STRUCT.pack(chunk)]
+        parts.append(record)
+    if snapshot.moon_phase is not None:
+        start, end, timestamps, quarters = snapshot.moon_phase
+        parts.append(MOON_PHASE_STRUCT.pack(start, end, len(timestamps)))
+        parts.append(struct.pack("<%dd" % len(timestamps), *timestamps))
+        parts.append(bytes(quarters))
+
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary, "wb") as file:
+        file.write(b"".join(parts))
+    os.replace(temporary, path)
+
+
+def read(path: str) -> Snapshot | None:
+    """The snapshot at ``path``, or None if there isn't a readable one."""
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        return _parse(data)
+    except (OSError, ValueError, KeyError, IndexError, struct.error):
+        return None
+
+
+def _parse(data: bytes) -> Snapshot:
+    if not data.startswith(MAGIC):
+        raise ValueError("not a snapshot")
+    offset = len(MAGIC)
+    (length,) = HEADER_LENGTH_STRUCT.unpack_from(data, offset)
+    offset += HEADER_LENGTH_STRUCT.size
+    header = json.loads(data[offset : offset + length])
+    offset += length
+
+    timelines = {}
+    record_size = shared_cache.TIMELINE_STRUCT.size
+    for _ in range(header["timelines"]):
+        body, latitude, longitude = TIMELINE_KEY_STRUCT.unpack_from(data, offset)
+        offset += TIMELINE_KEY_STRUCT.size
+        timelines[(BODIES[body], latitude, longitude)] = shared_cache.unpack_timeline(
+            data[offset : offset + record_size]
+        )
+        offset += record_size
+
+    dst_tables = {}
+    record_size = shared_cache.DST_STRUCT.size
+    for _ in range(header["dst_tables"]):
+        (length,) = ZONE_LENGTH_STRUCT.unpack_from(data, offset)
+        offset += ZONE_LENGTH_STRUCT.size
+        zone = data[offset : offset + length].decode()
+        offset += length
+        (chunk,) = CHUNK_STRUCT.unpack_from(data, offset)
+        offset += CHUNK_STRUCT.size
+        dst_tables[(zone, chunk)] = shared_cache.unpack_dst_transitions(
+            data[offset : offset + record_size]
+        )
+        offset += record_size
+
+    moon_phase = None
+    if header["moon_phase"]:
+        start, end, count = MOON_PHASE_STRUCT.unpack_from(data, offset)
+        offset += MOON_PHASE_STRUCT.size
+        timestamps = struct.unpack_from("<%dd" % count, data, offset)
+        offset += 8 * count
+        quarters = tuple(data[offset : offset + count + 1])
+        if len(quarters) != count + 1:
+            raise ValueError("truncated snapshot")
+        moon_phase = (start, end, timestamps, quarters)
+
+    return Snapshot(header["versions"], timelines, dst_tables, moon_phase)
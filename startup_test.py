@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measure how long importing the app takes and how much memory a process
+serving it holds, for each service profile.
+
+Each measurement runs in a fresh interpreter, which imports ``app``, answers
+its first ``/time`` and then, in the full profile, its first ``/almanac``:
+
+    uv run python startup_test.py
+    uv run python startup_test.py --app-dir ../other-checkout
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROFILES = ("full", "time")
+
+# Run in the fresh interpreter; prints one JSON object of measurements
+MEASURE_SCRIPT = """
+import json
+import sys
+import time
+
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+
+baseline = rss_mb()
+start = time.perf_counter()
+import app
+
+result = {
+    "import_ms": (time.perf_counter() - start) * 1000,
+    "baseline_mb": baseline,
+    "import_mb": rss_mb(),
+}
+client = app.app.test_client()
+headers = {"X-Timezone": "Europe/London", "X-Location": "51.5,-0.1"}
+
+start = time.perf_counter()
+client.get("/time", headers=headers)
+result["first_time_ms"] = (time.perf_counter() - start) * 1000
+result["time_mb"] = rss_mb()
+result["skyfield_imported"] = "skyfield" in sys.modules
+
+# Not served in the time-only profile
+if client.get("/almanac", headers=headers).status_code == 200:
+    result["almanac_mb"] = rss_mb()
+print(json.dumps(result))
+"""
+
+
+def measure(app_dir: str, profile: str) -> dict:
+    env = dict(
+        os.environ,
+        SERVICE_PROFILE=profile,
+        ALMANAC_WARMER_INTERVAL="0",
+        PYTHONPATH=os.pathsep.join([app_dir, os.environ.get("PYTHONPATH", "")]),
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--app-dir",
+        default=os.path.dirname(os.path.abspath(__file__)),
+        help="Checkout whose app.py to measure (default: this one)",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Runs per profile")
+    args = parser.parse_args()
+
+    print(
+        "%-8s %12s %12s %14s %10s %12s"
+        % ("profile", "import", "RSS import", "first /time", "RSS /time", "RSS almanac")
+    )
+    for profile in PROFILES:
+        runs = [measure(args.app_dir, profile) for _ in range(args.runs)]
+
+        def median(key):
+            values = [run[key] for run in runs if key in run]
+            return statistics.median(values) if values else None
+
+        almanac_mb = median("almanac_mb")
+        print(
+            "%-8s %9.0f ms %9.1f MB %11.1f ms %7.1f MB %12s%s"
+            % (
+                profile,
+                median("import_ms"),
+                median("import_mb"),
+                median("first_time_ms"),
+                median("time_mb"),
+                "-" if almanac_mb is None else "%.1f MB" % almanac_mb,
+                "" if not runs[0]["skyfield_imported"] else "  (skyfield at /time)",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
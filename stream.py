@@ -0,0 +1,293 @@
+"""
+Server-Sent Events stream of time sync and MOTD updates, served on the event
+loop by async_app.py at ``/stream``.
+
+Devices with the same ``X-Timezone`` and snapped ``X-Location`` share one
+``Channel``, which works out each update once and pushes it to all of them:
+
+* ``event: time`` carries the ``/time`` JSON, sent on connect, at each DST
+  transition and every ``STREAM_TIME_INTERVAL`` seconds to correct drift.
+* ``event: motd`` carries a ``[text, color]`` MOTD item, rotating through the
+  ``/almanac`` items and a random message every ``STREAM_MOTD_INTERVAL``
+  seconds. The almanac is recomputed in the astronomy pool only when its
+  next event passes. Not sent in the time-only service profile.
+
+A device that falls behind loses its oldest queued updates rather than
+holding memory for them.
+"""
+
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import random
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from flask import g
+
+from app import (
+    MOTD_OPTIONS,
+    SERVICE_PROFILE,
+    get_almanac_expiry,
+    get_almanac_items,
+    get_current_time,
+    get_dst_schedule,
+    get_rand_color,
+    get_time_fields,
+    snap_location,
+)
+from app import app as flask_app
+
+STREAM_TIME_INTERVAL = float(os.getenv("STREAM_TIME_INTERVAL", "3600"))
+STREAM_MOTD_INTERVAL = float(os.getenv("STREAM_MOTD_INTERVAL", "30"))
+# Sent when nothing else was, so proxies don't close idle connections
+STREAM_KEEPALIVE_INTERVAL = float(os.getenv("STREAM_KEEPALIVE_INTERVAL", "25"))
+# Updates held for a device that isn't reading them
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "8"))
+
+# Earliest an almanac is recomputed after the last, should its expiry be past
+MIN_RECOMPUTE_SECONDS = 1.0
+
+KEEPALIVE = b": keepalive\n\n"
+# Put on a subscriber's queue when its device disconnects
+DISCONNECTED = None
+
+
+def format_event(event: str, data) -> bytes:
+    return b"event: %s\ndata: %s\n\n" % (
+        event.encode(),
+        json.dumps(data, separators=(",", ":")).encode(),
+    )
+
+
+def compute_almanac(timezone: str, location: str) -> tuple[list[list], float]:
+    """
+    The almanac items for a channel and the Unix timestamp they next change.
+    Takes and returns only plain values, so it can run in the pool.
+    """
+    with flask_app.test_request_context(headers={"X-Location": location}):
+        g.tzinfo = ZoneInfo(timezone)
+        return get_almanac_items(), get_almanac_expiry()
+
+
+def next_time_push(tzinfo: ZoneInfo, now: float, interval: float) -> float:
+    """When to next push the time: the next DST transition, or ``interval`` on."""
+    schedule = get_dst_schedule(
+        tzinfo, datetime.datetime.fromtimestamp(now, datetime.UTC), interval
+    )
+    return schedule[0][0] if schedule else now + interval
+
+
+async def sleep_until(timestamp: float):
+    while (delay := timestamp - time.time()) > 0:
+        await asyncio.sleep(delay)
+
+
+class Subscriber:
+    """
+    The updates not yet sent to one device, dropping the oldest past
+    ``size``. Lighter than an ``asyncio.Queue``, for thousands of devices.
+    """
+
+    __slots__ = ("messages", "waiter")
+
+    def __init__(self, size: int):
+        self.messages = collections.deque(maxlen=size)
+        self.waiter = None
+
+    def put(self, message: bytes | None):
+        self.messages.append(message)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self) -> bytes | None:
+        while not self.messages:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.messages.popleft()
+
+
+class Channel:
+    """
+    Updates for one timezone and snapped location, and the queues of the
+    devices subscribed to them.
+    """
+
+    def __init__(self, hub: "StreamHub", timezone: str, location: str):
+        self.hub = hub
+        self.timezone = timezone
+        self.tzinfo = ZoneInfo(timezone)
+        self.location = location
+        self.subscribers: set[Subscriber] = set()
+        self.last_motd: bytes | None = None
+        self.tasks = [asyncio.create_task(self.push_time())]
+        if SERVICE_PROFILE == "full":
+            self.tasks.append(asyncio.create_task(self.push_motd()))
+
+    def time_message(self) -> bytes:
+        return format_event("time", get_time_fields(get_current_time(self.tzinfo)))
+
+    def broadcast(self, message: bytes):
+        for subscriber in self.subscribers:
+            subscriber.put(message)
+
+    async def push_time(self):
+        while True:
+            await sleep_until(
+                next_time_push(self.tzinfo, time.time(), self.hub.time_interval)
+            )
+            self.broadcast(self.time_message())
+
+    async def push_motd(self):
+        while True:
+            self.hub.computations += 1
+            try:
+                items, expires = await self.hub.compute(self.timezone, self.location)
+            except Exception:
+                # Such as a pool worker dying; the devices keep the last item
+                await asyncio.sleep(self.hub.motd_interval)
+                continue
+            expires = max(expires, time.time() + MIN_RECOMPUTE_SECONDS)
+
+            rotation = items + [[random.choice(MOTD_OPTIONS), get_rand_color()]]
+            for item in itertools.cycle(rotation):
+                self.last_motd = format_event("motd", item)
+                self.broadcast(self.last_motd)
+                if time.time() + self.hub.motd_interval >= expires:
+                    await sleep_until(expires)
+                    break
+                await asyncio.sleep(self.hub.motd_interval)
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+
+
+class StreamHub:
+    """
+    The open channels, created by their first subscriber and closed when
+    their last one leaves.
+
+    ``compute`` is an async function running ``compute_almanac`` somewhere
+    that won't block the loop.
+    """
+
+    def __init__(
+        self,
+        compute,
+        time_interval: float = STREAM_TIME_INTERVAL,
+        motd_interval: float = STREAM_MOTD_INTERVAL,
+        keepalive_interval: float = STREAM_KEEPALIVE_INTERVAL,
+        queue_size: int = STREAM_QUEUE_SIZE,
+    ):
+        self.compute = compute
+        self.time_interval = time_interval
+        self.motd_interval = motd_interval
+        self.keepalive_interval = keepalive_interval
+        self.queue_size = queue_size
+        self.channels: dict[tuple[str, str], Channel] = {}
+        # Almanac computations started by all channels, for the tests
+        self.computations = 0
+
+    def subscribe(self, timezone: str, location: str) -> tuple[Channel, Subscriber]:
+        channel = self.channels.get((timezone, location))
+        if channel is None:
+            channel = self.channels[timezone, location] = Channel(
+                self, timezone, location
+            )
+        subscriber = Subscriber(self.queue_size)
+        channel.subscribers.add(subscriber)
+        return channel, subscriber
+
+    def unsubscribe(self, channel: Channel, subscriber: Subscriber):
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers:
+            channel.close()
+            # Already gone if the hub was closed first
+            if self.channels.get((channel.timezone, channel.location)) is channel:
+                del self.channels[channel.timezone, channel.location]
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+        self.channels.clear()
+
+
+def parse_location(header: str) -> str:
+    """The snapped ``"latitude,longitude"`` a channel is keyed by."""
+    latitude, longitude = header.split(",")
+    return "%s,%s" % snap_location(float(latitude), float(longitude))
+
+
+async def send_error(send, status: int):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-length", b"0")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def watch_disconnect(receive, subscriber: Subscriber):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    subscriber.put(DISCONNECTED)
+
+
+async def serve(hub: StreamHub, scope, receive, send):
+    """Answer one ``/stream`` request, until the device disconnects."""
+    headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1")
+        for name, value in scope["headers"]
+    }
+    timezone = headers.get("x-timezone", "UTC")
+    try:
+        ZoneInfo(timezone)
+    except (ZoneInfoNotFoundError, IsADirectoryError, ValueError):
+        await send_error(send, 404)
+        return
+    try:
+        location = parse_location(headers.get("x-location", "40.7,-74.0"))
+    except ValueError:
+        await send_error(send, 400)
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-store"),
+                (b"access-control-allow-origin", b"*"),
+            ],
+        }
+    )
+    channel, subscriber = hub.subscribe(timezone, location)
+    watcher = asyncio.create_task(watch_disconnect(receive, subscriber))
+    try:
+        subscriber.put(channel.time_message())
+        if channel.last_motd is not None:
+            subscriber.put(channel.last_motd)
+        while True:
+            try:
+                async with asyncio.timeout(hub.keepalive_interval):
+                    message = await subscriber.get()
+            except TimeoutError:
+                message = KEEPALIVE
+            if message is DISCONNECTED:
+                return
+            await send(
+                {"type": "http.response.body", "body": message, "more_body": True}
+            )
+    finally:
+        watcher.cancel()
+        hub.unsubscribe(channel, subscriber)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Test the almanac cache, event timelines and location snapping"""
+
+import datetime
+import time
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+import app as server
+from app import (
+    AlmanacCache,
+    AlmanacWarmer,
+    AnalyticEngine,
+    AstronomyContext,
+    BodyEvents,
+    EventTimeline,
+    snap_location,
+    update_timeline,
+)
+from recording_engine import RecordingEngine
+
+DAY = 24 * 3600
+
+
+def make_timeline(start=0.0, end=2 * DAY, times=(), events=(), is_up=False):
+    return EventTimeline(start, end, tuple(times), tuple(events), is_up)
+
+
+class TestAlmanacCache(unittest.TestCase):
+    """Test cache coverage and eviction"""
+
+    def test_hit_while_covered(self):
+        """Timelines are returned while they cover the search window"""
+        cache = AlmanacCache(max_size=4)
+        timeline = make_timeline()
+        cache.put(("sun", 40.725, -74.025), timeline)
+
+        self.assertIs(cache.get(("sun", 40.725, -74.025), 0.5 * DAY), timeline)
+        self.assertEqual(cache.hits, 1)
+
+    def test_miss_when_running_short(self):
+        """Timelines not covering the search window are treated as misses"""
+        cache = AlmanacCache(max_size=4)
+        cache.put(("sun", 40.725, -74.025), make_timeline())
+
+        self.assertIsNone(cache.get(("sun", 40.725, -74.025), 0.6 * DAY))
+        self.assertEqual(cache.misses, 1)
+
+    def test_least_recently_used_evicted(self):
+        """The least recently used timeline is evicted when full"""
+        cache = AlmanacCache(max_size=2)
+        cache.put(("sun", 1.0, 1.0), make_timeline())
+        cache.put(("sun", 2.0, 2.0), make_timeline())
+        cache.get(("sun", 1.0, 1.0), 0.0)
+        cache.put(("sun", 3.0, 3.0), make_timeline())
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get(("sun", 1.0, 1.0), 0.0))
+        self.assertIsNone(cache.get(("sun", 2.0, 2.0), 0.0))
+        self.assertIsNotNone(cache.get(("sun", 3.0, 3.0), 0.0))
+
+
+class TestEventTimeline(unittest.TestCase):
+    """Test lookups in and extensions of an event timeline"""
+
+    def setUp(self):
+        """A sun that rises at 1000, sets at 2000 and rises again at 3000"""
+        self.timeline = make_timeline(
+            times=(1000.0, 2000.0, 3000.0), events=(True, False, True)
+        )
+
+    def test_next_and_following_events(self):
+        """Events after the lookup time are returned, expiring at the first"""
+        body_events = self.timeline.at(1500.0)
+
+        self.assertEqual(body_events.times, (2000.0, 3000.0))
+        self.assertEqual(body_events.events, (False, True))
+        self.assertEqual(body_events.start, 1000.0)
+        self.assertEqual(body_events.expires, 2000.0)
+
+    def test_state_from_next_event(self):
+        """The body is up before a set and down before a rise"""
+        self.assertFalse(self.timeline.at(500.0).is_up)
+        self.assertTrue(self.timeline.at(1000.0).is_up)
+        self.assertFalse(self.timeline.at(2500.0).is_up)
+        self.assertTrue(self.timeline.at(3500.0).is_up)
+
+    def test_no_events(self):
+        """Without events the state is the one at the start (polar day)"""
+        body_events = make_timeline(is_up=True).at(1000.0)
+
+        self.assertTrue(body_events.is_up)
+        self.assertEqual(body_events.times, ())
+        self.assertEqual(body_events.expires, 2 * DAY)
+
+    def test_extend(self):
+        """Extending drops past events and appends the new search's"""
+        search = BodyEvents(
+            start=2 * DAY,
+            expires=2 * DAY + 500,
+            times=(2 * DAY + 500,),
+            events=(False,),
+            is_up=True,
+        )
+
+        extended = self.timeline.extend(search, 3 * DAY, 1500.0)
+
+        self.assertEqual(extended.start, 1500.0)
+        self.assertEqual(extended.end, 3 * DAY)
+        self.assertEqual(extended.times, (2000.0, 3000.0, 2 * DAY + 500))
+        self.assertEqual(extended.events, (False, True, False))
+        self.assertTrue(extended.is_up)
+
+
+class TestUpdateTimeline(unittest.TestCase):
+    """Test timelines are extended incrementally and match fresh searches"""
+
+    def setUp(self):
+        """Count the analytic engine's searches, which are fast enough to
+        compare against at every step"""
+        self.original_engine = server.ENGINE
+        self.engine = RecordingEngine(AnalyticEngine())
+        server.ENGINE = self.engine
+
+    def tearDown(self):
+        """Restore the server's engine"""
+        server.ENGINE = self.original_engine
+
+    def test_one_search_a_day(self):
+        """Looking up every 10 minutes for 5 days searches about once a day"""
+        cache = AlmanacCache(max_size=8)
+        location = snap_location(40.7128, -74.0060)
+        start = datetime.datetime(2025, 6, 1, tzinfo=datetime.UTC).timestamp()
+
+        for step in range(5 * 144):
+            now = start + step * 600
+            for body in ("sun", "moon"):
+                body_events = update_timeline(cache, body, location, now).at(now)
+                fresh = self.engine.engine.body_events(
+                    body,
+                    AstronomyContext.at(
+                        location, datetime.datetime.fromtimestamp(now, datetime.UTC)
+                    ),
+                )
+                with self.subTest(body=body, now=now):
+                    self.assertEqual(body_events.is_up, fresh.is_up)
+                    self.assertEqual(body_events.events[:2], fresh.events[:2])
+                    for cached, searched in zip(body_events.times, fresh.times[:2]):
+                        self.assertAlmostEqual(cached, searched, delta=1)
+
+        # A first 2.5-day search per body, then about one a day
+        self.assertLessEqual(self.engine.searches, 2 * 6)
+        self.assertLessEqual(self.engine.days_searched, 2 * (2.5 + 5))
+
+
+class TestAlmanacWarmer(unittest.TestCase):
+    """Test the background almanac warm-up pass"""
+
+    def test_refresh_extends_timelines(self):
+        """A refresh pass makes timelines last until the next pass"""
+        cache = AlmanacCache(max_size=8)
+        warmer = AlmanacWarmer(cache, interval=3600, ttl=3600)
+        location = snap_location(40.7128, -74.0060)
+        warmer.track(*location)
+
+        warmer.refresh()
+
+        self.assertEqual(warmer.tracked_locations, 1)
+        self.assertIsNotNone(warmer.last_refresh_seconds)
+        timelines = {body: cache.peek((body, *location)) for body in ("sun", "moon")}
+        for timeline in timelines.values():
+            self.assertTrue(timeline.covers(time.time() + 3600))
+
+        # Nothing to search for until the timelines run short again
+        warmer.refresh()
+        for body, timeline in timelines.items():
+            self.assertIs(cache.peek((body, *location)), timeline)
+
+    def test_stale_locations_dropped(self):
+        """Locations not seen within the TTL stop being refreshed"""
+        cache = AlmanacCache(max_size=8)
+        warmer = AlmanacWarmer(cache, interval=3600, ttl=-1)
+        warmer.track(*snap_location(40.7128, -74.0060))
+
+        warmer.refresh()
+
+        self.assertEqual(warmer.tracked_locations, 0)
+        self.assertEqual(len(cache), 0)
+
+    def test_stats_exported(self):
+        """Searches, early refreshes and misses avoided show up in /metrics"""
+
+        def sample(name):
+            return REGISTRY.get_sample_value(f"matrix_portal_warmer_{name}") or 0.0
+
+        names = ("searches_total", "refreshes_total", "misses_avoided_total")
+        before = {name: sample(name) for name in names}
+
+        def counted():
+            return {name: sample(name) - before[name] for name in names}
+
+        engine = RecordingEngine(AnalyticEngine())
+        cache = AlmanacCache(max_size=8)
+        warmer = AlmanacWarmer(cache, interval=3600, ttl=3600)
+        location = snap_location(40.7128, -74.0060)
+        warmer.track(*location)
+        with mock.patch.object(server, "ENGINE", engine):
+            warmer.refresh()
+            # Nothing was cached yet, so nothing was refreshed early
+            self.assertEqual(
+                counted(),
+                {"searches_total": 2, "refreshes_total": 0, "misses_avoided_total": 0},
+            )
+            self.assertEqual(sample("tracked_locations"), 1)
+
+            # Cut the timelines short of the next pass, as if they were aging
+            now = time.time()
+            end = now + server.ALMANAC_SEARCH_DAYS * DAY + 1800
+            for body in ("sun", "moon"):
+                timeline = cache.peek((body, *location))
+                kept = [i for i, t in enumerate(timeline.times) if t <= end]
+                cache.put(
+                    (body, *location),
+                    timeline._replace(
+                        end=end,
+                        times=tuple(timeline.times[i] for i in kept),
+                        events=tuple(timeline.events[i] for i in kept),
+                    ),
+                )
+            warmer.refresh()
+
+        self.assertEqual(engine.searches, 4)
+        self.assertEqual(
+            counted(),
+            {"searches_total": 4, "refreshes_total": 2, "misses_avoided_total": 0},
+        )
+
+        # The old timeline covered this lookup, the next one it wouldn't have
+        warmer.note_hit(("sun", *location), now)
+        self.assertEqual(counted()["misses_avoided_total"], 0)
+        warmer.note_hit(("sun", *location), now + 3600)
+        warmer.note_hit(("sun", *location), now + 3600)
+        self.assertEqual(counted()["misses_avoided_total"], 1)
+
+
+class TestSnapLocation(unittest.TestCase):
+    """Test snapping locations to the almanac grid"""
+
+    def test_nearby_locations_share_cell(self):
+        """Locations in the same grid cell snap to the same point"""
+        self.assertEqual(
+            snap_location(40.7128, -74.0060), snap_location(40.7101, -74.0159)
+        )
+
+    def test_snapped_location_is_close(self):
+        """Snapping moves a location by at most half a grid cell"""
+        latitude, longitude = snap_location(40.7128, -74.0060)
+
+        self.assertLessEqual(abs(latitude - 40.7128), 0.025)
+        self.assertLessEqual(abs(longitude - -74.0060), 0.025)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Test the analytic astronomy engine against the skyfield engine"""
+
+import datetime
+import unittest
+
+from app import (
+    ALMANAC_SEARCH_DAYS,
+    AnalyticEngine,
+    AstronomyContext,
+    SkyfieldEngine,
+    get_timescale,
+)
+
+DATES = [
+    datetime.datetime(2024, 3, 20, 6, 0, tzinfo=datetime.UTC),
+    datetime.datetime(2024, 6, 21, 18, 0, tzinfo=datetime.UTC),
+    datetime.datetime(2024, 9, 22, 0, 0, tzinfo=datetime.UTC),
+    datetime.datetime(2024, 12, 21, 12, 0, tzinfo=datetime.UTC),
+    datetime.datetime(2025, 5, 12, 3, 30, tzinfo=datetime.UTC),
+    datetime.datetime(2026, 1, 3, 21, 45, tzinfo=datetime.UTC),
+]
+MID_LATITUDES = [-50, -35, -20, 0, 20, 35, 50]
+HIGH_LATITUDES = [-65, -60, -55, 55, 60, 65]
+LONGITUDES = [-122.4, -74.0, 0.0, 139.7]
+
+# The displayed HH:MM may differ by at most one minute
+MAX_DIFFERENCE_SECONDS = 60
+
+
+class TestAnalyticEngine(unittest.TestCase):
+    """Compare rise/set events and moon phase between the two engines"""
+
+    def setUp(self):
+        """Set up both engines"""
+        self.skyfield = SkyfieldEngine()
+        self.analytic = AnalyticEngine()
+
+    def _body_events(self, body, latitude, longitude, now):
+        """Return (times, events, is_up) from both engines, leaving out
+        events too close to the end of the search window to be found by
+        both."""
+        astronomy = AstronomyContext.at((latitude, longitude), now)
+        results = []
+        for engine in (self.skyfield, self.analytic):
+            body_events = engine.body_events(body, astronomy)
+            cutoff = (
+                now.timestamp()
+                + ALMANAC_SEARCH_DAYS * 24 * 3600
+                - MAX_DIFFERENCE_SECONDS
+            )
+            kept = [
+                (event_time, event)
+                for event_time, event in zip(body_events.times, body_events.events)
+                if event_time < cutoff
+            ]
+            results.append(
+                (
+                    [event_time for event_time, _ in kept],
+                    [event for _, event in kept],
+                    body_events.is_up,
+                )
+            )
+        return results
+
+    def test_mid_latitude_events_match(self):
+        """Events and states match within a minute up to 50 degrees latitude"""
+        for now in DATES:
+            for latitude in MID_LATITUDES:
+                for longitude in LONGITUDES:
+                    for body in ("sun", "moon"):
+                        with self.subTest(
+                            now=now, latitude=latitude, longitude=longitude, body=body
+                        ):
+                            expected, actual = self._body_events(
+                                body, latitude, longitude, now
+                            )
+                            self.assertEqual(actual[2], expected[2])
+                            self.assertEqual(actual[1], expected[1])
+                            for expected_time, actual_time in zip(
+                                expected[0], actual[0]
+                            ):
+                                self.assertLessEqual(
+                                    abs(actual_time - expected_time),
+                                    MAX_DIFFERENCE_SECONDS,
+                                )
+
+    def test_high_latitude_events_found(self):
+        """Every skyfield event is found within a minute at high latitudes
+
+        The analytic engine samples every 30 minutes, more often than
+        skyfield, so it may also report short-lived events skyfield misses.
+        """
+        for now in DATES:
+            for latitude in HIGH_LATITUDES:
+                for longitude in LONGITUDES:
+                    for body in ("sun", "moon"):
+                        with self.subTest(
+                            now=now, latitude=latitude, longitude=longitude, body=body
+                        ):
+                            expected, actual = self._body_events(
+                                body, latitude, longitude, now
+                            )
+                            for expected_time, expected_event in zip(
+                                expected[0], expected[1]
+                            ):
+                                self.assertTrue(
+                                    any(
+                                        actual_event == expected_event
+                                        and abs(actual_time - expected_time)
+                                        <= MAX_DIFFERENCE_SECONDS
+                                        for actual_time, actual_event in zip(
+                                            actual[0], actual[1]
+                                        )
+                                    )
+                                )
+
+    def test_moon_phase_matches(self):
+        """Moon phase angles match within a tenth of a degree"""
+        timestamps = [now.timestamp() for now in DATES]
+        differences = (
+            self.analytic.moon_phase(timestamps)
+            - self.skyfield.moon_phase(timestamps)
+            + 180
+        ) % 360 - 180
+        for now, difference in zip(DATES, differences):
+            with self.subTest(now=now):
+                self.assertLessEqual(abs(difference), 0.1)
+
+
+class TestSkyfieldEngine(unittest.TestCase):
+    """Test the skyfield engine against skyfield's own almanac"""
+
+    def test_moon_phase_at_utc(self):
+        """Moon phase is evaluated at the UTC instant, leap seconds included"""
+        from skyfield import almanac
+
+        engine = SkyfieldEngine()
+        timestamps = [now.timestamp() for now in DATES]
+
+        angles = engine.moon_phase(timestamps)
+
+        for now, angle in zip(DATES, angles):
+            with self.subTest(now=now):
+                expected = almanac.moon_phase(
+                    engine.ephemeris, get_timescale().from_datetime(now)
+                ).degrees
+                self.assertAlmostEqual(angle, expected, delta=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Test the ASGI entry point and its astronomy process pool"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import app as server
+import async_app
+from device_registry import DeviceRegistry
+
+
+def call(path, headers=None, query_string=b""):
+    """Run one GET request through the ASGI app, returning status, body"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query_string,
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+    }
+    asyncio.run(async_app.app(scope, receive, send))
+    return messages[0]["status"], messages[1]["body"]
+
+
+class TestAsyncApp(unittest.TestCase):
+    """Test requests are answered on the loop or in the pool"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Start the astronomy pool with one worker"""
+        cls.pool = async_app.ASTRONOMY_POOL
+        cls.pool.size = 1
+        cls.pool.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the astronomy pool"""
+        cls.pool.shutdown()
+
+    def test_time_on_loop(self):
+        """/time is answered even when the pool is full"""
+        self.pool.pending = self.pool.queue_size
+        try:
+            status, body = call("/time", {"X-Timezone": "America/New_York"})
+            motd_status, _ = call("/motd", {"X-Location": "40.7,-74.0"})
+        finally:
+            self.pool.pending = 0
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 4)
+        self.assertEqual(motd_status, 503)
+
+    def test_almanac_in_pool(self):
+        """/almanac is answered by a pool worker"""
+        status, body = call("/almanac", {"X-Location": "40.7,-74.0"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 7)
+        self.assertEqual(self.pool.pending, 0)
+
+    def test_query_string(self):
+        """Query strings reach Flask, on the loop and in the pool"""
+        status, body = call(
+            "/time", {"X-Timezone": "America/New_York"}, query_string=b"fmt=bin"
+        )
+        schedule_status, schedule = call(
+            "/time", {"X-Timezone": "America/New_York"}, query_string=b"horizon=365"
+        )
+        motd_status, motd = call(
+            "/motd", {"X-Location": "40.7,-74.0"}, query_string=b"fmt=bin"
+        )
+
+        self.assertEqual((status, len(body)), (200, 24))
+        self.assertEqual(schedule_status, 200)
+        self.assertEqual(len(json.loads(schedule)), 5)
+        self.assertEqual(motd_status, 200)
+        self.assertGreater(len(motd), 6)
+
+    def test_pool_not_started(self):
+        """Astronomy work fails rather than running on the loop's threads"""
+        pool = async_app.AstronomyPool(1, 1)
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(pool.run(len, ""))
+        self.assertEqual(pool.pending, 0)
+
+    def test_error_status_passed_through(self):
+        """Flask's error responses come back unchanged"""
+        status, _ = call("/motd", {"X-Timezone": "Not/AZone"})
+
+        self.assertEqual(status, 404)
+
+    def test_stream_routed(self):
+        """/stream is answered by the stream hub on the loop"""
+        status, _ = call("/stream", {"X-Timezone": "Not/AZone"})
+
+        self.assertEqual(status, 404)
+        self.assertEqual(async_app.STREAM_HUB.channels, {})
+
+    def test_registry_read_off_loop(self):
+        """/time from a device reads the registry on another thread"""
+        threads = []
+        with tempfile.TemporaryDirectory() as directory:
+            registry = DeviceRegistry(
+                os.path.join(directory, "devices.db"), flush_interval=3600
+            )
+            lookup = registry.lookup
+            registry.lookup = lambda device_id: (
+                threads.append(threading.current_thread()) or lookup(device_id)
+            )
+            with (
+                mock.patch.object(server, "DEVICE_REGISTRY", registry),
+                mock.patch.object(async_app, "DEVICE_REGISTRY", registry),
+            ):
+                status, _ = call(
+                    "/time", {"X-Timezone": "UTC", "X-Device-Id": "clock-1"}
+                )
+                other_status, _ = call("/time", {"X-Timezone": "UTC"})
+            registry.flush()
+
+        self.assertEqual((status, other_status), (200, 200))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+if __name__ == "__main__":
+    unittest.main()
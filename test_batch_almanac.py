@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Test batch timelines for many locations match the per-call searches"""
+
+import time
+import unittest
+from zoneinfo import ZoneInfo
+
+from flask import g
+
+import app as server
+import batch_almanac
+from app import AlmanacCache, SkyfieldEngine
+
+LOCATIONS = [
+    ("America/New_York", 40.7, -74.0),
+    ("Europe/London", 51.5, -0.1),
+    ("Asia/Tokyo", 35.7, 139.7),
+    ("Australia/Sydney", -33.9, 151.2),
+    ("Africa/Nairobi", -1.3, 36.8),
+    ("Pacific/Fiji", -18.1, 179.9),
+    ("Pacific/Pago_Pago", -14.3, -170.7),
+    ("Europe/Oslo", 59.9, 10.7),
+]
+# 2025-03-09 06:40 UTC
+NOW = 1741502400.0
+TOLERANCE_SECONDS = 2.0
+
+
+def snapped(locations):
+    return list(
+        dict.fromkeys(
+            server.snap_location(latitude, longitude)
+            for _, latitude, longitude in locations
+        )
+    )
+
+
+class TestComputeTimelines(unittest.TestCase):
+    """Test timelines computed together match one search per location"""
+
+    def setUp(self):
+        self.original_engine = server.ENGINE
+        server.ENGINE = SkyfieldEngine()
+
+    def tearDown(self):
+        server.ENGINE = self.original_engine
+
+    def assertTimelinesMatch(self, timelines, expected):
+        self.assertEqual(timelines.keys(), expected.keys())
+        for key, timeline in expected.items():
+            found = timelines[key]
+            self.assertEqual((found.start, found.end), (timeline.start, timeline.end))
+            self.assertEqual(found.events, timeline.events, key)
+            self.assertEqual(found.is_up, timeline.is_up, key)
+            for first, second in zip(found.times, timeline.times):
+                self.assertAlmostEqual(first, second, delta=TOLERANCE_SECONDS)
+
+    def test_matches_per_call(self):
+        """Test every event, kind and state matches to the second"""
+        locations = snapped(LOCATIONS)
+
+        timelines = batch_almanac.compute_timelines(locations, NOW)
+
+        self.assertTimelinesMatch(
+            timelines, batch_almanac.per_call_timelines(locations, NOW)
+        )
+
+    def test_polar_day(self):
+        """Test a midsummer location where the sun never sets"""
+        # 2025-06-21 12:00 UTC
+        now = 1750507200.0
+        locations = [server.snap_location(78.2, 15.6)]
+
+        timelines = batch_almanac.compute_timelines(locations, now)
+
+        sun = timelines[("sun", *locations[0])]
+        self.assertEqual((sun.times, sun.is_up), ((), True))
+        self.assertTimelinesMatch(
+            timelines, batch_almanac.per_call_timelines(locations, now)
+        )
+
+    def test_more_locations_than_a_block(self):
+        """Test locations split over observer blocks keep their own events"""
+        locations = snapped(LOCATIONS)
+        many = [
+            (latitude + 0.25 * offset, longitude)
+            for offset in range(batch_almanac.OBSERVER_BLOCK // len(locations) + 1)
+            for latitude, longitude in locations
+        ]
+
+        timelines = batch_almanac.compute_timelines(many, NOW)
+
+        self.assertGreater(len(many), batch_almanac.OBSERVER_BLOCK)
+        expected = batch_almanac.compute_timelines(locations, NOW)
+        for key, timeline in expected.items():
+            self.assertEqual(timelines[key], timeline)
+
+
+class TestPrecompute(unittest.TestCase):
+    """Test precomputed timelines answer requests without a search"""
+
+    def setUp(self):
+        self.original_engine = server.ENGINE
+        server.ENGINE = SkyfieldEngine()
+        server.ALMANAC_CACHE.clear()
+
+    def tearDown(self):
+        server.ENGINE = self.original_engine
+        server.ALMANAC_CACHE.clear()
+
+    def next_events(self, zone, latitude, longitude):
+        """The sun and moon helpers' answers at a location, with the times of
+        the events they name"""
+        with server.app.test_request_context(
+            headers={"X-Location": "%r,%r" % (latitude, longitude)}
+        ):
+            g.tzinfo = ZoneInfo(zone)
+            return (
+                [server.get_next_sun_event(index) for index in (0, 1)]
+                + [server.get_next_moon_event(index) for index in (0, 1)],
+                [server.get_sun_state(), server.get_moon_state()],
+                server.get_body_events("sun").times[:2]
+                + server.get_body_events("moon").times[:2],
+            )
+
+    def test_cells_shared(self):
+        """Test locations in one grid cell are computed and cached once"""
+        cache = AlmanacCache(16)
+
+        timelines = batch_almanac.precompute(
+            [("UTC", 40.71, -74.01), ("America/New_York", 40.72, -74.02)],
+            NOW,
+            cache,
+        )
+
+        location = server.snap_location(40.71, -74.01)
+        self.assertEqual(set(timelines), {("sun", *location), ("moon", *location)})
+        self.assertEqual(len(cache), 2)
+
+    def test_next_events_match(self):
+        """Test get_next_sun_event and get_next_moon_event give the same
+        answers from precomputed timelines as from their own searches"""
+        now = time.time()
+        batch_almanac.precompute(LOCATIONS, now)
+        self.assertEqual(len(server.ALMANAC_CACHE), 2 * len(LOCATIONS))
+        server.ENGINE = None
+        precomputed = [self.next_events(*location) for location in LOCATIONS]
+
+        server.ENGINE = SkyfieldEngine()
+        server.ALMANAC_CACHE.clear()
+        for location, (events, states, times) in zip(LOCATIONS, precomputed):
+            expected_events, expected_states, expected_times = self.next_events(
+                *location
+            )
+            self.assertEqual(states, expected_states, location)
+            for found, expected, timestamp, expected_timestamp in zip(
+                events, expected_events, times, expected_times
+            ):
+                self.assertAlmostEqual(
+                    timestamp, expected_timestamp, delta=TOLERANCE_SECONDS
+                )
+                # Times this close to a minute can round either way
+                if abs((expected_timestamp + 30 + 30) % 60 - 30) > TOLERANCE_SECONDS:
+                    self.assertEqual(found, expected, location)
+                else:
+                    self.assertEqual(found[:2], expected[:2], location)
+
+
+class TestReadLocations(unittest.TestCase):
+    """Test the CLI's location list parsing"""
+
+    def test_read(self):
+        """Test comments and blank lines are skipped and spaces trimmed"""
+        lines = ["# zone,latitude,longitude\n", "\n", "Europe/London, 51.5, -0.1\n"]
+
+        self.assertEqual(
+            batch_almanac.read_locations(lines), [("Europe/London", 51.5, -0.1)]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
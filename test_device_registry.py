@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Test the SQLite device registry and requests from registered devices"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+from prometheus_client import REGISTRY
+
+import app as server
+from device_registry import SCHEMA, Device, DeviceRegistry
+
+HEADERS = {"X-Timezone": "Europe/London", "X-Location": "51.5,-0.1"}
+
+
+def make_device(timezone="Europe/London", location=(51.525, -0.125), expires=None):
+    return Device(
+        timezone,
+        ZoneInfo(timezone),
+        "51.5,-0.1",
+        location,
+        [["SR 07:29", 1], None],
+        expires or time.time() + 3600,
+    )
+
+
+class TestDeviceRegistry(unittest.TestCase):
+    """Test devices are kept in memory and written behind to SQLite"""
+
+    def setUp(self):
+        """Open a registry in a temporary directory, never pruning the
+        devices the tests see at made-up times long past"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "devices.db")
+        self.registry = DeviceRegistry(self.path, flush_interval=3600, ttl=math.inf)
+
+    def tearDown(self):
+        """Write anything queued, then remove the database"""
+        self.registry.flush()
+        self.directory.cleanup()
+
+    def rows(self):
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(SCHEMA)
+            return connection.execute(
+                "SELECT device_id, timezone, last_seen FROM devices"
+            ).fetchall()
+
+    def test_write_behind(self):
+        """Test nothing is written until the registry is flushed"""
+        self.registry.register("clock-1", make_device())
+        self.registry.seen("clock-1", 1000.0)
+
+        self.assertEqual(self.registry.lookup("clock-1").timezone, "Europe/London")
+        self.assertEqual(self.rows(), [])
+
+        self.registry.flush()
+        self.assertEqual(self.rows(), [("clock-1", "Europe/London", 1000.0)])
+
+    def test_last_seen_batched(self):
+        """Test only the latest of many last-seen times is written"""
+        self.registry.register("clock-1", make_device())
+        self.registry.flush()
+        for now in range(2000, 2100):
+            self.registry.seen("clock-1", float(now))
+        self.registry.seen("unregistered", 2100.0)
+
+        self.registry.flush()
+
+        self.assertEqual(self.rows(), [("clock-1", "Europe/London", 2099.0)])
+
+    def test_read_by_another_process(self):
+        """Test a registry on the same database finds flushed devices"""
+        self.registry.register("clock-1", make_device())
+        self.registry.flush()
+
+        device = DeviceRegistry(self.path, flush_interval=3600).lookup("clock-1")
+
+        self.assertEqual(device.tzinfo, ZoneInfo("Europe/London"))
+        self.assertEqual(device.location, (51.525, -0.125))
+        self.assertEqual(device.payload, [["SR 07:29", 1], None])
+        self.assertIsNone(self.registry.lookup("clock-2"))
+
+    def test_moved_on_another_registry(self):
+        """Test a device registered again by another process is reloaded,
+        and not written back with its old location"""
+        self.registry.register("clock-1", make_device())
+        self.registry.flush()
+        self.assertEqual(self.registry.lookup("clock-1").timezone, "Europe/London")
+
+        other = DeviceRegistry(self.path, flush_interval=3600)
+        other.register(
+            "clock-1", make_device("America/New_York", location=(40.725, -73.975))
+        )
+        other.flush()
+
+        device = self.registry.lookup("clock-1")
+        self.assertEqual(device.timezone, "America/New_York")
+        self.assertEqual(device.location, (40.725, -73.975))
+
+    def test_older_registration_not_written(self):
+        """Test a registration queued before another process's newer one
+        doesn't overwrite it"""
+        self.registry.register("clock-1", make_device())
+        other = DeviceRegistry(self.path, flush_interval=3600)
+        other.register(
+            "clock-1", make_device("America/New_York", location=(40.725, -73.975))
+        )
+        other.flush()
+
+        self.registry.flush()
+
+        self.assertEqual(self.rows(), [("clock-1", "America/New_York", mock.ANY)])
+        self.assertEqual(self.registry.lookup("clock-1").timezone, "America/New_York")
+
+    def test_memory_bounded(self):
+        """Test only the most recently used devices are kept in memory"""
+        registry = DeviceRegistry(self.path, flush_interval=3600, cache_size=2)
+        for index in range(5):
+            registry.register("clock-%d" % index, make_device())
+        registry.flush()
+
+        self.assertEqual(list(registry._devices), ["clock-3", "clock-4"])
+        self.assertEqual(registry.lookup("clock-0").timezone, "Europe/London")
+        self.assertEqual(list(registry._devices), ["clock-4", "clock-0"])
+
+    def test_unseen_devices_pruned(self):
+        """Test devices not seen for the TTL are deleted"""
+        registry = DeviceRegistry(self.path, flush_interval=3600, ttl=600)
+        registry.register("clock-1", make_device())
+        registry.register("clock-2", make_device())
+        registry.seen("clock-1", time.time() - 1000)
+        registry.flush()
+
+        self.assertEqual([row[0] for row in self.rows()], ["clock-2"])
+
+    def test_rows_capped(self):
+        """Test only the most recently seen devices are kept past the cap"""
+        registry = DeviceRegistry(self.path, flush_interval=3600, max_devices=2)
+        now = time.time()
+        for index in range(4):
+            registry.register("clock-%d" % index, make_device())
+            registry.seen("clock-%d" % index, now - 10 * index)
+        registry.flush()
+
+        self.assertEqual(sorted(row[0] for row in self.rows()), ["clock-0", "clock-1"])
+
+    def test_counts(self):
+        """Test the registry counts devices and distinct locations"""
+        self.registry.register("clock-1", make_device())
+        self.registry.register("clock-2", make_device())
+        self.registry.register("clock-3", make_device(location=(40.725, -73.975)))
+        self.registry.flush()
+
+        self.assertEqual(self.registry.counts(), (3, 2))
+        self.assertEqual(
+            REGISTRY.get_sample_value("matrix_portal_registered_devices"), 3
+        )
+
+
+class TestRegisteredRequests(unittest.TestCase):
+    """Test requests with X-Device-Id use and maintain the registry"""
+
+    def setUp(self):
+        """Swap in a registry writing to a temporary directory"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_registry = server.DEVICE_REGISTRY
+        server.DEVICE_REGISTRY = DeviceRegistry(
+            os.path.join(self.directory.name, "devices.db"), flush_interval=3600
+        )
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        """Write anything queued, then restore the server's registry"""
+        server.DEVICE_REGISTRY.flush()
+        server.DEVICE_REGISTRY = self.original_registry
+        self.directory.cleanup()
+
+    def test_registered_on_almanac(self):
+        """Test a device is registered with its almanac and can drop headers"""
+        first = self.client.get("/almanac", headers={**HEADERS, "X-Device-Id": "a"})
+        device = server.DEVICE_REGISTRY.lookup("a")
+
+        self.assertEqual(device.timezone, "Europe/London")
+        self.assertEqual(device.location, server.snap_location(51.5, -0.1))
+        self.assertGreater(device.expires, time.time())
+
+        # Answered from the payload, without searching for events again
+        server.ALMANAC_CACHE.clear()
+        second = self.client.get("/almanac", headers={"X-Device-Id": "a"})
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(server.ALMANAC_CACHE.misses, 0)
+
+    def test_motd_from_payload(self):
+        """Test /motd astronomy items come from the registered payload"""
+        self.client.get("/almanac", headers={**HEADERS, "X-Device-Id": "a"})
+        items = self.client.get("/almanac", headers=HEADERS).get_json()
+
+        server.ALMANAC_CACHE.clear()
+        for _ in range(20):
+            text, color = self.client.get(
+                "/motd", headers={"X-Device-Id": "a"}
+            ).get_json()
+            # Random messages can land on the same colors
+            if text not in server.MOTD_OPTIONS:
+                self.assertIn([text, color], items)
+        self.assertEqual(server.ALMANAC_CACHE.misses, 0)
+
+    def test_time_uses_registered_timezone(self):
+        """Test /time uses the registered timezone when none is sent"""
+        self.client.get("/almanac", headers={**HEADERS, "X-Device-Id": "a"})
+
+        _, utc_offset, *_ = self.client.get(
+            "/time", headers={"X-Device-Id": "a"}
+        ).get_json()
+
+        self.assertEqual(
+            utc_offset,
+            ZoneInfo("Europe/London")
+            .utcoffset(server.datetime.datetime.now())
+            .total_seconds(),
+        )
+
+    def test_moved_device_reregistered(self):
+        """Test a device sending a new location is registered again"""
+        self.client.get("/almanac", headers={**HEADERS, "X-Device-Id": "a"})
+
+        self.client.get(
+            "/almanac",
+            headers={**HEADERS, "X-Location": "40.7,-74.0", "X-Device-Id": "a"},
+        )
+
+        device = server.DEVICE_REGISTRY.lookup("a")
+        self.assertEqual(device.location, server.snap_location(40.7, -74.0))
+        self.assertEqual(device.location_header, "40.7,-74.0")
+
+    def test_expired_payload_recomputed(self):
+        """Test an expired payload is computed and registered again"""
+        self.client.get("/almanac", headers={**HEADERS, "X-Device-Id": "a"})
+        server.DEVICE_REGISTRY.register(
+            "a", server.DEVICE_REGISTRY.lookup("a")._replace(expires=0.0)
+        )
+
+        self.client.get("/almanac", headers={"X-Device-Id": "a"})
+
+        self.assertGreater(server.DEVICE_REGISTRY.lookup("a").expires, time.time())
+
+    def test_disabled_without_path(self):
+        """Test X-Device-Id is ignored with no registry configured"""
+        server.DEVICE_REGISTRY = DeviceRegistry("", flush_interval=3600)
+
+        response = self.client.get("/almanac", headers={"X-Device-Id": "a"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(server.DEVICE_REGISTRY._devices, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,7 +5,7 @@ import datetime
 import unittest
 from zoneinfo import ZoneInfo
 
-from app import get_next_dst_transition
+from app import get_dst_schedule, get_dst_transitions, get_next_dst_transition
 
 
 class TestDSTTransitionDetection(unittest.TestCase):
@@ -87,6 +87,88 @@ class TestDSTTransitionDetection(unittest.TestCase):
         self.assertIsNone(next_dst_change)
         self.assertIsNone(dst_offset_change)
 
+    def test_transition_table_america_new_york(self):
+        """Test the precomputed transition table for America/New_York in 2024"""
+        tzinfo = ZoneInfo("America/New_York")
+        spring_forward = datetime.datetime(2024, 3, 10, 7, 0, tzinfo=ZoneInfo("UTC"))
+        fall_back = datetime.datetime(2024, 11, 3, 6, 0, tzinfo=ZoneInfo("UTC"))
+
+        timestamps, offsets = get_dst_transitions(
+            tzinfo, int(spring_forward.timestamp()) // (365 * 24 * 3600)
+        )
+
+        self.assertEqual(
+            timestamps,
+            (int(spring_forward.timestamp()), int(fall_back.timestamp())),
+        )
+        self.assertEqual(offsets, (-14400, -18000))
+
+    def test_transition_table_utc(self):
+        """Test the precomputed transition table for UTC is empty"""
+        timestamps, offsets = get_dst_transitions(ZoneInfo("UTC"), 54)
+
+        self.assertEqual(timestamps, ())
+        self.assertEqual(offsets, ())
+
+
+class TestDSTSchedule(unittest.TestCase):
+    """Test the long-horizon transition schedule"""
+
+    YEAR = 365 * 24 * 3600
+
+    def test_america_new_york_year(self):
+        """Test a year of America/New_York transitions from New Year 2026"""
+        now = datetime.datetime(2026, 1, 1, tzinfo=ZoneInfo("UTC"))
+        spring_forward = datetime.datetime(2026, 3, 8, 7, 0, tzinfo=ZoneInfo("UTC"))
+        fall_back = datetime.datetime(2026, 11, 1, 6, 0, tzinfo=ZoneInfo("UTC"))
+
+        schedule = get_dst_schedule(ZoneInfo("America/New_York"), now, self.YEAR)
+
+        self.assertEqual(
+            schedule,
+            [
+                (int(spring_forward.timestamp()), -14400),
+                (int(fall_back.timestamp()), -18000),
+            ],
+        )
+
+    def test_exact_to_the_second(self):
+        """Test every scheduled transition is the first second of its offset"""
+        for timezone in ["Europe/London", "Australia/Lord_Howe", "Pacific/Chatham"]:
+            tzinfo = ZoneInfo(timezone)
+            now = datetime.datetime(2025, 6, 1, tzinfo=tzinfo)
+
+            schedule = get_dst_schedule(tzinfo, now, 2 * self.YEAR)
+
+            self.assertEqual(len(schedule), 4, timezone)
+            for timestamp, offset in schedule:
+                before = datetime.datetime.fromtimestamp(timestamp - 1, tzinfo)
+                after = datetime.datetime.fromtimestamp(timestamp, tzinfo)
+                self.assertNotEqual(before.utcoffset().total_seconds(), offset)
+                self.assertEqual(after.utcoffset().total_seconds(), offset)
+
+    def test_window_bounds(self):
+        """Test a transition at the current time is left out"""
+        tzinfo = ZoneInfo("Europe/Berlin")
+        transition = datetime.datetime(2026, 3, 29, 1, 0, tzinfo=ZoneInfo("UTC"))
+
+        at_transition = get_dst_schedule(tzinfo, transition, 3600)
+        before_transition = get_dst_schedule(
+            tzinfo, transition - datetime.timedelta(hours=1), 3600
+        )
+
+        self.assertEqual(at_transition, [])
+        self.assertEqual(before_transition, [(int(transition.timestamp()), 7200)])
+
+    def test_no_dst(self):
+        """Test zones without DST have an empty schedule"""
+        now = datetime.datetime(2026, 1, 1, tzinfo=ZoneInfo("UTC"))
+
+        for timezone in ["UTC", "America/Phoenix", "Asia/Tokyo"]:
+            self.assertEqual(
+                get_dst_schedule(ZoneInfo(timezone), now, self.YEAR), [], timezone
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
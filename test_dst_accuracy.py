@@ -160,6 +160,21 @@ class TestDSTAccuracy(unittest.TestCase):
         self.assertLessEqual(abs(next_dst_change - expected_timestamp), 1)
         self.assertEqual(new_utc_offset, -14400, "New offset should be EDT (UTC-4)")
 
+    def test_lord_howe_half_hour_fall_back(self):
+        """Australia/Lord_Howe Fall back 2024 - 30 minute shift, 42 minutes 37 seconds before"""
+        test_time = datetime.datetime(
+            2024, 4, 7, 1, 17, 23, tzinfo=ZoneInfo("Australia/Lord_Howe")
+        )
+        expected_utc = datetime.datetime(2024, 4, 6, 15, 0, 0, tzinfo=ZoneInfo("UTC"))
+
+        next_dst_change, new_utc_offset = get_next_dst_transition(
+            ZoneInfo("Australia/Lord_Howe"), test_time
+        )
+
+        self.assertIsNotNone(next_dst_change)
+        self.assertEqual(next_dst_change, int(expected_utc.timestamp()))
+        self.assertEqual(new_utc_offset, 37800, "New offset should be LHST (UTC+10:30)")
+
 
 if __name__ == "__main__":
     unittest.main()
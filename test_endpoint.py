@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Test the /time endpoint with DST transition fields"""
 
+import struct
 import unittest
 
 from app import app
@@ -103,6 +104,159 @@ class TestTimeEndpoint(unittest.TestCase):
         data = response.json
         self.assertEqual(len(data), 4, "Response should have 4 fields")
 
+    def test_malformed_location_ignored(self):
+        """Test /time endpoint doesn't parse the location header"""
+        response = self.client.get(
+            "/time",
+            headers={"X-Timezone": "America/New_York", "X-Location": "not-a-location"},
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class TestAlmanacEndpoint(unittest.TestCase):
+    """Test the /almanac endpoint returning every astronomy item"""
+
+    def setUp(self):
+        """Set up test client"""
+        self.client = app.test_client()
+
+    def test_all_items(self):
+        """Test /almanac returns every item for a mid-latitude location"""
+        response = self.client.get(
+            "/almanac",
+            headers={
+                "X-Timezone": "America/New_York",
+                "X-Location": "40.7128,-74.0060",
+            },
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json
+        self.assertEqual(len(data), 7, "Response should have 7 items")
+        for text, color in data:
+            self.assertIsInstance(text, str)
+            self.assertIsInstance(color, int)
+        self.assertTrue(data[0][0].startswith(("SR ", "SS ")))
+        self.assertTrue(data[2][0].startswith(("MR ", "MS ")))
+        self.assertIn(data[4][0], ["Daytime", "Nighttime"])
+        self.assertIn(data[5][0], ["Moon up", "Moon down"])
+
+    def test_events_alternate(self):
+        """Test the next and following events are a rise and a set"""
+        response = self.client.get(
+            "/almanac",
+            headers={"X-Timezone": "Europe/London", "X-Location": "51.5,-0.1"},
+        )
+
+        data = response.json
+        self.assertNotEqual(data[0][0][:2], data[1][0][:2])
+        self.assertNotEqual(data[2][0][:2], data[3][0][:2])
+
+
+class TestBinaryFormat(unittest.TestCase):
+    """Test the packed binary responses for microcontroller clients"""
+
+    def setUp(self):
+        """Set up test client"""
+        self.client = app.test_client()
+        self.headers = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+
+    def test_time_fmt_parameter(self):
+        """Test ?fmt=bin packs the same fields as the JSON response"""
+        fields = self.client.get("/time", headers=self.headers).json
+        response = self.client.get("/time?fmt=bin", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/octet-stream")
+        self.assertEqual(len(response.data), 24)
+        timestamp, utc_offset, next_change, new_offset = struct.unpack(
+            "<qiqi", response.data
+        )
+        self.assertAlmostEqual(timestamp, fields[0], delta=5000)
+        self.assertEqual(
+            [utc_offset, next_change, new_offset],
+            [field or 0 for field in fields[1:]],
+        )
+
+    def test_time_accept_header(self):
+        """Test Accept: application/octet-stream selects the binary format"""
+        response = self.client.get(
+            "/time",
+            headers={"X-Timezone": "UTC", "Accept": "application/octet-stream"},
+        )
+
+        self.assertEqual(response.mimetype, "application/octet-stream")
+        # UTC has no transitions, so both DST fields are zero
+        self.assertEqual(struct.unpack("<qiqi", response.data)[1:], (0, 0, 0))
+
+    def test_motd_length_prefixed(self):
+        """Test /motd packs a color and length-prefixed UTF-8 text"""
+        for _ in range(20):
+            response = self.client.get("/motd?fmt=bin", headers=self.headers)
+
+            self.assertEqual(response.status_code, 200)
+            color, length = struct.unpack_from("<IH", response.data)
+            self.assertLessEqual(color, 0xFFFFFF)
+            self.assertEqual(len(response.data), 6 + length)
+            self.assertTrue(response.data[6:].decode())
+
+    def test_json_default(self):
+        """Test JSON stays the default, including for Accept: */*"""
+        response = self.client.get(
+            "/time", headers={"X-Timezone": "UTC", "Accept": "*/*"}
+        )
+
+        self.assertEqual(response.mimetype, "application/json")
+
+    def test_unknown_format(self):
+        """Test an unknown fmt value is rejected"""
+        response = self.client.get("/time?fmt=xml", headers=self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestTimeSchedule(unittest.TestCase):
+    """Test /time?horizon= adding the transition schedule"""
+
+    def setUp(self):
+        """Set up test client"""
+        self.client = app.test_client()
+        self.headers = {"X-Timezone": "Europe/London"}
+
+    def test_json_schedule(self):
+        """Test a year's schedule is appended as [timestamp_ms, offset] pairs"""
+        response = self.client.get("/time?horizon=365", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json
+        self.assertEqual(len(data), 5)
+        self.assertEqual(len(data[4]), 2)
+        for timestamp_ms, offset in data[4]:
+            self.assertGreater(timestamp_ms, data[0])
+            self.assertIn(offset, [0, 3600])
+
+    def test_binary_schedule(self):
+        """Test the packed schedule follows the packed /time fields"""
+        json_data = self.client.get("/time?horizon=365", headers=self.headers).json
+        response = self.client.get("/time?horizon=365&fmt=bin", headers=self.headers)
+
+        (count,) = struct.unpack_from("<H", response.data, 24)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(response.data), 24 + 2 + 12 * count)
+        entries = [
+            list(struct.unpack_from("<qi", response.data, 26 + 12 * index))
+            for index in range(count)
+        ]
+        self.assertEqual(entries, json_data[4])
+
+    def test_invalid_horizon(self):
+        """Test horizons that aren't a whole number of days in range are rejected"""
+        for horizon in ["0", "-5", "abc", "1.5", "100000"]:
+            response = self.client.get(
+                "/time?horizon=%s" % horizon, headers=self.headers
+            )
+            self.assertEqual(response.status_code, 400, horizon)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Test the Prometheus metrics and their aggregation across processes"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from prometheus_client import REGISTRY
+
+import metrics
+from app import MOTD_BRANCHES, app
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+
+# Makes the given number of /time requests, or prints /metrics if none
+WORKER_SCRIPT = """
+import sys
+from app import app
+
+client = app.test_client()
+count = int(sys.argv[1])
+for _ in range(count):
+    client.get("/time", headers={"X-Timezone": "UTC"})
+if not count:
+    sys.stdout.write(client.get("/metrics").get_data(as_text=True))
+"""
+
+
+def sample(name, **labels):
+    """Current value of a sample in this process, 0 if not recorded yet"""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics(unittest.TestCase):
+    """Test requests, /motd branches and helpers are recorded"""
+
+    def setUp(self):
+        """Set up test client"""
+        self.client = app.test_client()
+
+    def test_request_counted(self):
+        """Test each request is counted and timed by route and status"""
+        before = sample("matrix_portal_requests_total", endpoint="/time", status="200")
+        timed_before = sample("matrix_portal_request_seconds_count", endpoint="/time")
+
+        self.client.get("/time", headers=HEADERS)
+
+        self.assertEqual(
+            sample("matrix_portal_requests_total", endpoint="/time", status="200"),
+            before + 1,
+        )
+        self.assertEqual(
+            sample("matrix_portal_request_seconds_count", endpoint="/time"),
+            timed_before + 1,
+        )
+
+    def test_error_status_counted(self):
+        """Test errors are counted under their status, unknown paths together"""
+        before = sample(
+            "matrix_portal_requests_total", endpoint="unmatched", status="404"
+        )
+
+        self.client.get("/no-such-page-1", headers=HEADERS)
+        self.client.get("/no-such-page-2", headers=HEADERS)
+
+        self.assertEqual(
+            sample("matrix_portal_requests_total", endpoint="unmatched", status="404"),
+            before + 2,
+        )
+
+    def test_motd_branch_timed(self):
+        """Test each /motd request is timed under exactly one branch"""
+
+        def total():
+            return sum(
+                sample("matrix_portal_motd_branch_seconds_count", branch=branch)
+                for branch in MOTD_BRANCHES
+            )
+
+        before = total()
+        for _ in range(10):
+            self.client.get("/motd", headers=HEADERS)
+
+        self.assertEqual(total(), before + 10)
+
+    def test_helpers_timed(self):
+        """Test the DST and almanac helpers record their latency"""
+        before = sample(
+            "matrix_portal_helper_seconds_count", helper="get_next_dst_transition"
+        )
+        almanac_before = sample(
+            "matrix_portal_helper_seconds_count", helper="get_sun_state"
+        )
+
+        self.client.get("/time", headers=HEADERS)
+        self.client.get("/almanac", headers=HEADERS)
+
+        self.assertEqual(
+            sample(
+                "matrix_portal_helper_seconds_count", helper="get_next_dst_transition"
+            ),
+            before + 1,
+        )
+        self.assertEqual(
+            sample("matrix_portal_helper_seconds_count", helper="get_sun_state"),
+            almanac_before + 1,
+        )
+
+    def test_metrics_endpoint(self):
+        """Test /metrics serves the Prometheus text format"""
+        self.client.get("/time", headers=HEADERS)
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        self.assertIn(
+            'matrix_portal_requests_total{endpoint="/time",status="200"}',
+            response.get_data(as_text=True),
+        )
+
+    def test_timed_keeps_name(self):
+        """Test timed() keeps the wrapped function's name and result"""
+
+        @metrics.timed
+        def example_helper():
+            return 42
+
+        self.assertEqual(example_helper.__name__, "example_helper")
+        self.assertEqual(example_helper(), 42)
+        self.assertEqual(
+            sample("matrix_portal_helper_seconds_count", helper="example_helper"), 1
+        )
+
+
+class TestMultiprocessMetrics(unittest.TestCase):
+    """Test /metrics adds up counts from every worker process"""
+
+    def run_worker(self, directory, count):
+        """Run a separate process sharing the metrics directory"""
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=directory)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+        )
+        env["ALMANAC_WARMER_INTERVAL"] = "0"
+        return subprocess.run(
+            [sys.executable, "-c", WORKER_SCRIPT, str(count)],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+
+    def test_counts_aggregated(self):
+        """Test counts from two workers are summed by a third"""
+        with tempfile.TemporaryDirectory() as directory:
+            self.run_worker(directory, 3)
+            self.run_worker(directory, 5)
+            output = self.run_worker(directory, 0)
+
+        self.assertIn(
+            'matrix_portal_requests_total{endpoint="/time",status="200"} 8.0', output
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
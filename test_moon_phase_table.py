@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Test the precomputed moon phase table"""
+
+import time
+import unittest
+
+import numpy as np
+
+from app import ENGINE, MOON_PHASE_NAMES, MoonPhaseTable, get_moon_quarter
+
+
+class TestMoonQuarter(unittest.TestCase):
+    """Test rounding phase angles to quarters"""
+
+    def test_quarter_boundaries(self):
+        """Each quarter starts at 46, 136, 226 or 316 degrees"""
+        angles = np.array([0.0, 45.9, 46.0, 135.9, 136.0, 225.9, 226.0, 315.9, 316.0])
+
+        quarters = [MOON_PHASE_NAMES[quarter] for quarter in get_moon_quarter(angles)]
+
+        self.assertEqual(
+            quarters,
+            [
+                "New Moon",
+                "New Moon",
+                "1st Qtr Mn",
+                "1st Qtr Mn",
+                "Full Moon",
+                "Full Moon",
+                "Lst Qtr Mn",
+                "Lst Qtr Mn",
+                "New Moon",
+            ],
+        )
+
+
+class TestMoonPhaseTable(unittest.TestCase):
+    """Test moon phase lookups against the astronomy engine"""
+
+    def test_matches_engine(self):
+        """Table lookups match the engine's phase over the next 60 days"""
+        now = time.time()
+        table = MoonPhaseTable(days=90, refresh_days=10)
+        samples = np.linspace(now, now + 60 * 24 * 3600, 500)
+
+        expected = get_moon_quarter(ENGINE.moon_phase(samples))
+
+        for timestamp, quarter in zip(samples, expected):
+            with self.subTest(timestamp=timestamp):
+                self.assertEqual(table.quarter_at(timestamp), quarter)
+
+    def test_refresh_before_window_ends(self):
+        """The table is rebuilt once fewer than refresh_days remain"""
+        now = time.time()
+        table = MoonPhaseTable(days=40, refresh_days=10)
+        table.refresh(now)
+        first_end = table.end
+
+        table.quarter_at(first_end - 20 * 24 * 3600)
+        self.assertEqual(table.end, first_end)
+
+        table.quarter_at(first_end - 5 * 24 * 3600)
+        self.assertGreater(table.end, first_end)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Test /motd falls back to a cheap item when its branch is too slow"""
+
+import time
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+import app as server
+from app import AnalyticEngine
+from recording_engine import RecordingEngine
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+SUN_EVENT_BRANCH = server.MOTD_BRANCHES.index("next_sun_event")
+
+
+def fallbacks(branch="next_sun_event"):
+    return (
+        REGISTRY.get_sample_value(
+            "matrix_portal_motd_fallbacks_total", {"branch": branch}
+        )
+        or 0
+    )
+
+
+class TestMotdDeadline(unittest.TestCase):
+    """Test the deadline on computations /motd's branch needs"""
+
+    def setUp(self):
+        """Start from an empty cache with a slow engine, always choosing the
+        next sun event branch"""
+        server.MOON_PHASE_TABLE.refresh(time.time())
+        server.ALMANAC_CACHE.clear()
+        self.original_engine = server.ENGINE
+        server.ENGINE = self.engine = RecordingEngine(AnalyticEngine(), delay=0.5)
+        patches = [
+            mock.patch.object(server, "MOTD_DEADLINE_SECONDS", 0.05),
+            mock.patch.object(
+                server.secrets, "randbelow", return_value=SUN_EVENT_BRANCH
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        """Let background searches finish, then restore the engine"""
+        self.wait_for_searches()
+        server.ENGINE = self.original_engine
+        server.ALMANAC_CACHE.clear()
+
+    def wait_for_searches(self):
+        deadline = time.monotonic() + 10
+        while self.engine.running:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_fallback_within_deadline(self):
+        """Test a slow branch answers with the moon phase, counted, in time"""
+        before = fallbacks()
+
+        start = time.perf_counter()
+        text, color = self.client.get("/motd", headers=HEADERS).get_json()
+
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertIn(text, server.MOON_PHASE_NAMES)
+        self.assertEqual(color, server.MOON_COLOR)
+        self.assertEqual(fallbacks() - before, 1)
+
+    def test_finished_in_background(self):
+        """Test the search carries on and answers the next request"""
+        self.client.get("/motd", headers=HEADERS)
+        self.wait_for_searches()
+        before = fallbacks()
+
+        text, color = self.client.get("/motd", headers=HEADERS).get_json()
+
+        self.assertRegex(text, r"^S[RS] \d\d:\d\d$")
+        self.assertEqual(color, server.SUN_COLOR)
+        self.assertEqual(fallbacks(), before)
+        self.assertEqual(self.engine.searches, 1)
+
+    def test_fast_enough(self):
+        """Test a search finishing before the deadline is used"""
+        self.engine.delay = 0.0
+
+        text, color = self.client.get("/motd", headers=HEADERS).get_json()
+
+        self.assertEqual(color, server.SUN_COLOR)
+
+    def test_no_deadline(self):
+        """Test a deadline of 0 waits for the search"""
+        with mock.patch.object(server, "MOTD_DEADLINE_SECONDS", 0):
+            _, color = self.client.get("/motd", headers=HEADERS).get_json()
+
+        self.assertEqual(color, server.SUN_COLOR)
+
+    def test_queue_full(self):
+        """Test nothing more is queued while the background queue is full"""
+        other = {"X-Timezone": "Europe/London", "X-Location": "51.5,-0.1"}
+        with mock.patch.object(server, "MOTD_BACKGROUND_QUEUE", 1):
+            self.client.get("/motd", headers=HEADERS)
+            before = fallbacks()
+
+            _, color = self.client.get("/motd", headers=other).get_json()
+
+            self.assertEqual(color, server.MOON_COLOR)
+            self.assertEqual(fallbacks() - before, 1)
+            self.wait_for_searches()
+            self.assertEqual(self.engine.searches, 1)
+
+            # Room again once the first search is done
+            while server.motd_background_pending:
+                time.sleep(0.01)
+            self.client.get("/motd", headers=other)
+            self.wait_for_searches()
+            self.assertEqual(self.engine.searches, 2)
+
+    def test_stale_phase_table(self):
+        """Test the fallback is a random message while the phase table is
+        being rebuilt"""
+        with mock.patch.object(server.MOON_PHASE_TABLE, "is_stale", return_value=True):
+            text, _ = server.app.test_client().get("/motd", headers=HEADERS).get_json()
+
+        self.assertIn(text, server.MOTD_OPTIONS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Test sampled request profiling and the profile report"""
+
+import os
+import tempfile
+import unittest
+
+import app as server
+from profile_report import find_profiles, merge_profiles, parse_profile_name
+from profiling import RequestProfiler
+
+
+class TestRequestProfiling(unittest.TestCase):
+    """Test which requests are profiled and how profiles are written"""
+
+    def setUp(self):
+        """Swap in a profiler writing to a temporary directory"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.original_profiler = server.PROFILER
+        self.client = server.app.test_client()
+        self.headers = {"X-Timezone": "Europe/London", "X-Location": "51.5,-0.1"}
+
+    def tearDown(self):
+        """Restore the server's profiler"""
+        server.PROFILER = self.original_profiler
+        self.directory.cleanup()
+
+    def use_profiler(self, every=0, token=""):
+        server.PROFILER = RequestProfiler(every, self.directory.name, token)
+
+    def test_disabled_by_default(self):
+        """Test nothing is profiled with no sample rate or token"""
+        self.use_profiler()
+        self.client.get("/time", headers=self.headers)
+
+        self.assertFalse(server.PROFILER.enabled)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_every_nth_request(self):
+        """Test one request in every N is profiled, tagged with its branch"""
+        self.use_profiler(every=3)
+        for _ in range(9):
+            self.client.get("/motd", headers=self.headers)
+
+        paths = find_profiles(self.directory.name, endpoint="motd")
+        self.assertGreater(len(paths), 0)
+        stats = merge_profiles(paths)
+        self.assertEqual(
+            sum(
+                calls
+                for (_, _, function), (_, calls, *_) in stats.stats.items()
+                if function == "get_motd"
+            ),
+            3,
+        )
+        for path in paths:
+            endpoint, branch, timezone = parse_profile_name(path)
+            self.assertIn(branch, server.MOTD_BRANCHES)
+            self.assertEqual(timezone, "Europe/London")
+
+    def test_token_header(self):
+        """Test the X-Profile header forces profiling only with the token"""
+        self.use_profiler(token="secret")
+        self.client.get("/time", headers={**self.headers, "X-Profile": "wrong"})
+        self.assertEqual(find_profiles(self.directory.name), [])
+
+        self.client.get("/time", headers={**self.headers, "X-Profile": "secret"})
+        paths = find_profiles(self.directory.name)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(parse_profile_name(paths[0]), ("time", "-", "Europe/London"))
+
+    def test_invalid_zones_share_a_profile(self):
+        """Test requests for unknown zones are tagged "invalid", not with
+        their header, so they don't add a file each"""
+        self.use_profiler(every=1)
+        for index in range(5):
+            self.client.get("/time", headers={"X-Timezone": "Bogus/Zone%d" % index})
+
+        paths = find_profiles(self.directory.name)
+        self.assertEqual(len(paths), 1)
+        self.assertEqual(parse_profile_name(paths[0]), ("time", "-", "invalid"))
+        self.assertEqual(len(server.PROFILER._profiles), 1)
+
+    def test_report_shows_search(self):
+        """Test a merged profile of a cold /almanac shows the skyfield search"""
+        self.use_profiler(token="secret")
+        server.ALMANAC_CACHE.clear()
+        self.client.get("/almanac", headers={**self.headers, "X-Profile": "secret"})
+
+        stats = merge_profiles(find_profiles(self.directory.name, endpoint="almanac"))
+        functions = {function for _, _, function in stats.stats}
+        self.assertIn("find_discrete", functions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Test astronomy is loaded lazily and not at all in the time-only profile"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Prints the astronomy modules imported after each step, the statuses and the
+# almanac snapshot version
+PROFILE_SCRIPT = """
+import json
+import sys
+
+HEAVY = ("skyfield", "numpy", "jplephem")
+
+
+def imported():
+    return sorted(module for module in HEAVY if module in sys.modules)
+
+
+import app
+
+result = {"import": imported()}
+client = app.app.test_client()
+result["time"] = client.get("/time", headers={"X-Timezone": "UTC"}).status_code
+result["after_time"] = imported()
+result["almanac"] = client.get("/almanac").status_code
+result["after_almanac"] = imported()
+app.preload_shared_state()
+result["after_preload"] = imported()
+result["almanac_version"] = app.get_snapshot_versions()["almanac"]
+print(json.dumps(result))
+"""
+
+
+def run_profile(profile, **variables):
+    """Run PROFILE_SCRIPT in a fresh process with the given service profile
+    and environment variables"""
+    env = dict(
+        os.environ, SERVICE_PROFILE=profile, ALMANAC_WARMER_INTERVAL="0", **variables
+    )
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", PROFILE_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+class TestServiceProfiles(unittest.TestCase):
+    """Test what each service profile imports and serves"""
+
+    def test_full_profile_lazy(self):
+        """Test skyfield is imported by the first astronomy request only"""
+        result = run_profile("full")
+
+        self.assertEqual(result["import"], [])
+        self.assertEqual(result["time"], 200)
+        self.assertEqual(result["after_time"], [])
+        self.assertEqual(result["almanac"], 200)
+        self.assertEqual(result["after_almanac"], ["jplephem", "numpy", "skyfield"])
+
+    def test_time_profile(self):
+        """Test the time-only profile serves /time and never loads astronomy"""
+        result = run_profile("time")
+
+        self.assertEqual(result["time"], 200)
+        self.assertEqual(result["almanac"], 404)
+        self.assertEqual(result["after_preload"], [])
+
+    def test_analytic_engine(self):
+        """Test the analytic engine never loads the ephemeris, even to preload
+        or version its snapshot"""
+        result = run_profile(
+            "full", ASTRONOMY_ENGINE="analytic", EPHEMERIS_FILE="missing.bsp"
+        )
+
+        self.assertEqual(result["almanac"], 200)
+        self.assertEqual(result["after_preload"], ["numpy"])
+        self.assertEqual(result["almanac_version"][0], "AnalyticEngine")
+
+    def test_unknown_profile(self):
+        """Test an unknown profile stops the app from starting"""
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            run_profile("astronomy-only")
+
+        self.assertIn("SERVICE_PROFILE", context.exception.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Test the cache of almanac timelines and DST tables shared by workers"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import app as server
+import shared_cache
+from app import AnalyticEngine, EventTimeline, SharedAlmanacCache, update_timeline
+from recording_engine import RecordingEngine
+from shared_cache import (
+    MAX_DST_TRANSITIONS,
+    MAX_TIMELINE_EVENTS,
+    SharedCache,
+    pack_dst_transitions,
+    pack_timeline,
+    unpack_dst_transitions,
+    unpack_timeline,
+)
+
+DAY = 24 * 3600
+
+# Answers /almanac and /time, printing them and how many almanac searches and
+# DST scans it ran
+WORKER_SCRIPT = """
+import json
+import app
+
+searches = []
+body_events = app.ENGINE.body_events
+app.ENGINE.body_events = lambda *args, **kwargs: (
+    searches.append(args[0]) or body_events(*args, **kwargs)
+)
+scans = []
+build_dst_transitions = app._build_dst_transitions
+app._build_dst_transitions = lambda *args: (
+    scans.append(args[1]) or build_dst_transitions(*args)
+)
+
+client = app.app.test_client()
+headers = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+almanac = client.get("/almanac", headers=headers).get_json()
+time_fields = client.get("/time", headers=headers).get_json()
+print(json.dumps({
+    "searches": len(searches),
+    "scans": len(scans),
+    "almanac": almanac,
+    "next_change": time_fields[2],
+}))
+"""
+
+# Repeatedly replaces and reads one timeline, printing any torn reads
+WRITER_SCRIPT = """
+import sys
+import shared_cache
+
+cache = shared_cache.SharedCache(sys.argv[1])
+value = float(sys.argv[2])
+torn = 0
+for _ in range(200):
+    record = shared_cache.pack_timeline(value, value, (value,) * 12, (True,) * 12, True)
+    cache.put("timelines", "key", record, 1e12)
+    start, end, times, events, is_up = shared_cache.unpack_timeline(
+        cache.get("timelines", "key", 0.0)
+    )
+    torn += len(set(times + (start, end))) != 1 or len(times) != 12
+print(torn)
+"""
+
+
+def worker_env(path):
+    env = dict(os.environ, SHARED_CACHE=path, ALMANAC_WARMER_INTERVAL="0")
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+    )
+    return env
+
+
+class TestRecords(unittest.TestCase):
+    """Test timelines and DST tables pack into fixed-size records"""
+
+    def test_timeline_round_trip(self):
+        """Test a timeline is unpacked as it was packed"""
+        timeline = (100.0, 2 * DAY, (3600.5, 40000.25), (True, False), False)
+
+        record = pack_timeline(*timeline)
+
+        self.assertEqual(unpack_timeline(record), timeline)
+        self.assertEqual(len(record), shared_cache.TIMELINE_STRUCT.size)
+        self.assertEqual(len(pack_timeline(0.0, 1.0, (), (), True)), len(record))
+
+    def test_long_timeline_cut_short(self):
+        """Test a timeline with too many events ends at its last kept one"""
+        count = MAX_TIMELINE_EVENTS + 3
+        times = tuple(float(hour * 3600) for hour in range(1, count + 1))
+        events = tuple(hour % 2 == 0 for hour in range(count))
+
+        start, end, kept_times, kept_events, _ = unpack_timeline(
+            pack_timeline(0.0, 30 * DAY, times, events, True)
+        )
+
+        self.assertEqual(kept_times, times[:MAX_TIMELINE_EVENTS])
+        self.assertEqual(kept_events, events[:MAX_TIMELINE_EVENTS])
+        self.assertEqual(end, times[MAX_TIMELINE_EVENTS - 1])
+
+    def test_dst_round_trip(self):
+        """Test a DST table is unpacked as it was packed"""
+        table = ((1741503600, 1762063200), (-14400, -18000))
+
+        self.assertEqual(unpack_dst_transitions(pack_dst_transitions(*table)), table)
+        self.assertEqual(unpack_dst_transitions(pack_dst_transitions((), ())), ((), ()))
+
+    def test_long_dst_table_not_shared(self):
+        """Test a DST table with too many transitions isn't packed"""
+        count = MAX_DST_TRANSITIONS + 1
+        self.assertIsNone(pack_dst_transitions(tuple(range(count)), (0,) * count))
+
+
+class TestSharedCache(unittest.TestCase):
+    """Test records are stored by key until they expire"""
+
+    def setUp(self):
+        """Open a cache in a temporary directory"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = SharedCache(os.path.join(self.directory.name, "cache.db"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_expiry(self):
+        """Test a record isn't returned once it expires, and is then purged"""
+        self.cache.put("timelines", "a", b"record", expires=1000.0)
+        self.cache.put("dst_transitions", "b", b"record", expires=5000.0)
+
+        self.assertEqual(self.cache.get("timelines", "a", 999.0), b"record")
+        self.assertIsNone(self.cache.get("timelines", "a", 1000.0))
+
+        self.cache.purge(1000.0)
+        self.assertEqual(self.cache.count("timelines"), 0)
+        self.assertEqual(self.cache.count("dst_transitions"), 1)
+
+    def test_forked_worker(self):
+        """Test a forked worker opens its own connection and leaves the one it
+        inherited open and unused"""
+        self.cache.put("timelines", "a", b"record", expires=1000.0)
+        inherited = self.cache._connection()
+
+        with mock.patch.object(shared_cache.os, "getpid", return_value=os.getpid() + 1):
+            self.assertEqual(self.cache.get("timelines", "a", 0.0), b"record")
+            self.assertIsNot(self.cache._connection(), inherited)
+
+        self.assertEqual(self.cache._inherited, [inherited])
+        inherited.execute("SELECT 1")
+
+    def test_closed_before_fork(self):
+        """Test the master's connection is closed when it preloads, so
+        workers don't inherit it"""
+        self.cache.put("timelines", "a", b"record", expires=1000.0)
+
+        with (
+            mock.patch.object(server, "SHARED_CACHE", self.cache),
+            mock.patch.object(server, "SERVICE_PROFILE", "time"),
+        ):
+            server.preload_shared_state()
+
+        self.assertIsNone(getattr(self.cache._local, "connection", None))
+        self.assertEqual(self.cache.get("timelines", "a", 0.0), b"record")
+
+    def test_almanac_cache(self):
+        """Test timelines are only returned while they cover the lookup"""
+        cache = SharedAlmanacCache(self.cache, max_size=256)
+        timeline = EventTimeline(0.0, 3 * DAY, (3600.0, 50000.0), (True, False), False)
+        key = ("sun", 40.725, -73.975)
+
+        cache.put(key, timeline)
+
+        self.assertEqual(cache.get(key, 1000.0), timeline)
+        self.assertIsNone(cache.get(key, 2 * DAY))
+        self.assertEqual(cache.peek(key), timeline)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+
+        cache.clear()
+        self.assertIsNone(cache.peek(key))
+
+    def test_local_first(self):
+        """Test warm lookups are answered in memory, and another worker's
+        timeline is read once and then kept"""
+        worker = SharedAlmanacCache(self.cache, max_size=256)
+        other = SharedAlmanacCache(self.cache, max_size=256)
+        timeline = EventTimeline(0.0, 3 * DAY, (3600.0,), (True,), False)
+        key = ("moon", 51.525, -0.125)
+        other.put(key, timeline)
+
+        with mock.patch.object(self.cache, "get", wraps=self.cache.get) as get:
+            for _ in range(3):
+                self.assertEqual(worker.get(key, 1000.0), timeline)
+            other.get(key, 1000.0)
+
+        self.assertEqual(get.call_count, 1)
+
+    def test_longer_shared_timeline_used(self):
+        """Test a local timeline that has run short is replaced by a longer
+        one another worker wrote"""
+        worker = SharedAlmanacCache(self.cache, max_size=256)
+        other = SharedAlmanacCache(self.cache, max_size=256)
+        key = ("sun", 40.725, -73.975)
+        short = EventTimeline(0.0, 2 * DAY, (3600.0,), (True,), False)
+        worker.put(key, short)
+        self.assertIsNone(worker.get(key, DAY))
+
+        extended = EventTimeline(0.0, 4 * DAY, (3600.0, 2 * DAY), (True, False), False)
+        other.put(key, extended)
+
+        self.assertEqual(worker.get(key, DAY), extended)
+        self.assertEqual(worker.local.peek(key), extended)
+
+    def test_warmer_uses_shared_extension(self):
+        """Test a warmer looking ahead reads the extension another worker
+        wrote instead of searching again"""
+        worker = SharedAlmanacCache(self.cache, max_size=256)
+        other = SharedAlmanacCache(self.cache, max_size=256)
+        location = (40.725, -73.975)
+        now = 1741502400.0
+        lookahead = 2 * DAY
+        engine = RecordingEngine(AnalyticEngine())
+
+        with mock.patch.object(server, "ENGINE", engine):
+            update_timeline(worker, "sun", location, now)
+            update_timeline(other, "sun", location, now)
+            extended = update_timeline(other, "sun", location, now, lookahead)
+            found = update_timeline(worker, "sun", location, now, lookahead)
+
+        self.assertEqual(engine.searches, 2)
+        self.assertEqual(found, extended)
+
+    def test_local_bounded(self):
+        """Test each worker keeps only a few timelines in memory"""
+        worker = SharedAlmanacCache(self.cache, max_size=256, local_size=2)
+        timeline = EventTimeline(0.0, 3 * DAY, (3600.0,), (True,), False)
+        keys = [("sun", 0.025, longitude) for longitude in (0.025, 0.075, 0.125)]
+        for key in keys:
+            worker.put(key, timeline)
+
+        self.assertEqual(len(worker.local), 2)
+        self.assertEqual(len(worker), 3)
+        self.assertEqual(worker.get(keys[0], 1000.0), timeline)
+
+    def test_disabled_without_path(self):
+        """Test no path disables the cache"""
+        self.assertFalse(SharedCache("").enabled)
+        self.assertTrue(self.cache.enabled)
+
+
+class TestAcrossProcesses(unittest.TestCase):
+    """Test worker processes share one cache"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def start(self, script, *args):
+        return subprocess.Popen(
+            [sys.executable, "-c", script, *args],
+            env=worker_env(self.path),
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+    def finish(self, process):
+        output, _ = process.communicate(timeout=300)
+        self.assertEqual(process.returncode, 0)
+        return json.loads(output.splitlines()[-1])
+
+    def test_computed_once(self):
+        """Test workers use the timelines and DST table the first one built"""
+        first = self.finish(self.start(WORKER_SCRIPT))
+        others = [self.start(WORKER_SCRIPT) for _ in range(3)]
+        others = [self.finish(process) for process in others]
+
+        self.assertEqual(first["searches"], 2)
+        self.assertGreater(first["scans"], 0)
+        for other in others:
+            self.assertEqual(other["searches"], 0)
+            self.assertEqual(other["scans"], 0)
+            self.assertEqual(other["almanac"], first["almanac"])
+            self.assertEqual(other["next_change"], first["next_change"])
+
+    def test_atomic_updates(self):
+        """Test concurrent writers never leave a half-written record"""
+        writers = [
+            self.start(WRITER_SCRIPT, self.path, str(value)) for value in range(4)
+        ]
+
+        self.assertEqual([self.finish(writer) for writer in writers], [0] * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Test identical astronomy searches running at once are coalesced"""
+
+import threading
+import time
+import unittest
+
+from prometheus_client import REGISTRY
+
+import app as server
+from app import AnalyticEngine, SingleFlight
+from recording_engine import RecordingEngine
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+REQUESTS = 8
+# Slow enough for every request to arrive while the search runs
+SEARCH_SECONDS = 0.3
+
+
+def coalesced():
+    return REGISTRY.get_sample_value("matrix_portal_coalesced_searches_total") or 0
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test callers of a running call share its result or exception"""
+
+    def run_together(self, flight, func, count=REQUESTS):
+        """Call ``func`` through ``flight`` from ``count`` threads at once"""
+        results = [None] * count
+        barrier = threading.Barrier(count)
+
+        def call(index):
+            barrier.wait()
+            try:
+                results[index] = flight.do(("key",), func)
+            except Exception as error:
+                results[index] = error
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_result_shared(self):
+        """Test one call runs and every caller gets its result"""
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return object()
+
+        results = self.run_together(
+            SingleFlight(server.metrics.COALESCED_SEARCHES), compute
+        )
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def test_error_propagated(self):
+        """Test every caller gets the exception of the one call"""
+        error = RuntimeError("search failed")
+
+        def compute():
+            time.sleep(0.3)
+            raise error
+
+        flight = SingleFlight(server.metrics.COALESCED_SEARCHES)
+        results = self.run_together(flight, compute)
+
+        self.assertEqual(results, [error] * REQUESTS)
+        # Finished calls aren't kept, so the next caller runs a new one
+        self.assertEqual(flight.do(("key",), lambda: "again"), "again")
+
+
+class TestCoalescedRequests(unittest.TestCase):
+    """Test simultaneous identical requests share one search per body"""
+
+    def setUp(self):
+        """Start from an empty cache with a slow, counting engine"""
+        server.ALMANAC_CACHE.clear()
+        self.original_engine = server.ENGINE
+
+    def tearDown(self):
+        server.ENGINE = self.original_engine
+        server.ALMANAC_CACHE.clear()
+
+    def request_together(self):
+        """Make REQUESTS identical /almanac requests at once"""
+        responses = [None] * REQUESTS
+        barrier = threading.Barrier(REQUESTS)
+
+        def request(index):
+            client = server.app.test_client()
+            barrier.wait()
+            responses[index] = client.get("/almanac", headers=HEADERS)
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def test_one_search(self):
+        """Test N simultaneous requests run one sun and one moon search"""
+        server.ENGINE = engine = RecordingEngine(AnalyticEngine(), delay=SEARCH_SECONDS)
+        before = coalesced()
+
+        responses = self.request_together()
+
+        self.assertEqual(engine.searches, 2)
+        self.assertGreaterEqual(coalesced() - before, REQUESTS - 1)
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(
+            len({response.get_data() for response in responses}), 1, responses
+        )
+
+    def test_error_reaches_every_request(self):
+        """Test a failed search fails every request waiting for it"""
+        server.ENGINE = engine = RecordingEngine(
+            AnalyticEngine(), delay=SEARCH_SECONDS, error=RuntimeError("search failed")
+        )
+        with self.assertLogs(server.app.logger, "ERROR"):
+            responses = self.request_together()
+
+        self.assertEqual(engine.searches, 1)
+        self.assertEqual({response.status_code for response in responses}, {500})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Test the warm-start snapshot of computed tables"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import app as server
+import snapshot
+from shared_cache import MAX_DST_TRANSITIONS
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+DAY = 24 * 3600
+
+# Answers /almanac and /time, printing how many almanac searches, DST scans
+# and moon phase table builds it ran
+WORKER_SCRIPT = """
+import json
+import app
+
+counts = {"searches": 0, "scans": 0, "moon_phase_builds": 0}
+
+
+def counting(name, function):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+app.ENGINE.body_events = counting("searches", app.ENGINE.body_events)
+app._build_dst_transitions = counting("scans", app._build_dst_transitions)
+app.MOON_PHASE_TABLE.build = counting("moon_phase_builds", app.MOON_PHASE_TABLE.build)
+
+client = app.app.test_client()
+headers = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+counts["almanac"] = client.get("/almanac", headers=headers).get_json()
+client.get("/time", headers=headers)
+print(json.dumps(counts))
+"""
+
+# Builds one zone's DST table and saves it at the given time, slowly enough
+# that processes saving together would overwrite each other's tables without
+# the lock
+SAVING_SCRIPT = """
+import sys
+import time
+from zoneinfo import ZoneInfo
+
+import app
+import snapshot
+
+read = snapshot.read
+snapshot.read = lambda path: time.sleep(0.2) or read(path)
+path, zone, start = sys.argv[1:]
+app.get_dst_transitions(ZoneInfo(zone), int(time.time() // app.DST_CHUNK_SECONDS))
+time.sleep(max(0.0, float(start) - time.time()))
+app.save_snapshot(path)
+"""
+
+
+def make_snapshot(versions=None, **tables):
+    return snapshot.Snapshot(
+        versions or {"dst": ["2025b", 1], "almanac": None},
+        tables.get("timelines", {}),
+        tables.get("dst_tables", {}),
+        tables.get("moon_phase"),
+    )
+
+
+class TestSnapshotFile(unittest.TestCase):
+    """Test snapshots are written and read back whole"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """Test every table is read back as it was written"""
+        saved = make_snapshot(
+            timelines={
+                ("sun", 40.725, -73.975): (0.0, 2 * DAY, (3600.0,), (True,), False),
+                ("moon", 51.525, -0.125): (10.0, 3 * DAY, (), (), True),
+            },
+            dst_tables={("America/New_York", 55): ((1741503600,), (-14400,))},
+            moon_phase=(0.0, 400 * DAY, (5.0 * DAY, 12.0 * DAY), (0, 1, 2)),
+        )
+
+        snapshot.write(self.path, saved)
+
+        self.assertEqual(snapshot.read(self.path), saved)
+        self.assertEqual(os.listdir(self.directory.name), ["snapshot.bin"])
+
+    def test_long_dst_table_skipped(self):
+        """Test a DST table too long for a record isn't written"""
+        count = MAX_DST_TRANSITIONS + 1
+        snapshot.write(
+            self.path,
+            make_snapshot(dst_tables={("Odd/Zone", 1): (tuple(range(count)),) * 2}),
+        )
+
+        self.assertEqual(snapshot.read(self.path).dst_tables, {})
+
+    def test_unreadable(self):
+        """Test a missing, foreign or truncated file reads as no snapshot"""
+        self.assertIsNone(snapshot.read(self.path))
+
+        with open(self.path, "wb") as file:
+            file.write(b"not a snapshot")
+        self.assertIsNone(snapshot.read(self.path))
+
+        snapshot.write(
+            self.path,
+            make_snapshot(
+                dst_tables={("UTC", 1): ((), ())}, moon_phase=(0, 1, (), (0,))
+            ),
+        )
+        with open(self.path, "rb") as file:
+            data = file.read()
+        with open(self.path, "wb") as file:
+            file.write(data[:-1])
+        self.assertIsNone(snapshot.read(self.path))
+
+
+class TestSaveAndLoad(unittest.TestCase):
+    """Test the server saves its tables and restores the valid ones"""
+
+    def setUp(self):
+        """Compute New York's almanac and DST tables"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot.bin")
+        client = server.app.test_client()
+        client.get("/almanac", headers=HEADERS)
+        client.get("/time", headers=HEADERS)
+        self.now = time.time()
+        self.key = ("sun", *server.snap_location(40.7, -74.0))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def forget(self):
+        """Drop the computed tables, as a restart would"""
+        server.ALMANAC_CACHE.clear()
+        server.DST_TABLES.clear()
+        server.get_dst_transitions.cache_clear()
+
+    def test_restored(self):
+        """Test a restarted server finds its timelines and DST tables"""
+        server.save_snapshot(self.path, self.now)
+        self.forget()
+
+        server.load_snapshot(self.path, self.now)
+
+        self.assertIsNotNone(server.ALMANAC_CACHE.get(self.key, self.now))
+        chunk = int(self.now // server.DST_CHUNK_SECONDS)
+        self.assertIn(("America/New_York", chunk), server.DST_TABLES)
+
+    def test_new_tzdata_discards_dst_tables(self):
+        """Test DST tables from other time zone data aren't restored"""
+        server.save_snapshot(self.path, self.now)
+        self.forget()
+
+        with mock.patch.object(server, "get_tzdata_version", return_value="1999z"):
+            server.load_snapshot(self.path, self.now)
+
+        self.assertEqual(server.DST_TABLES, {})
+        self.assertIsNotNone(server.ALMANAC_CACHE.get(self.key, self.now))
+
+    def test_new_ephemeris_discards_almanac(self):
+        """Test timelines from another ephemeris aren't restored"""
+        server.save_snapshot(self.path, self.now)
+        self.forget()
+
+        with mock.patch.object(server, "get_ephemeris_version", return_value="new"):
+            server.load_snapshot(self.path, self.now)
+
+        self.assertIsNone(server.ALMANAC_CACHE.peek(self.key))
+        self.assertNotEqual(server.DST_TABLES, {})
+
+    def test_expired_dropped(self):
+        """Test tables that have run out aren't saved"""
+        server.save_snapshot(self.path, self.now + 3 * 365 * DAY)
+
+        saved = snapshot.read(self.path)
+
+        self.assertEqual((saved.timelines, saved.dst_tables), ({}, {}))
+
+    def test_merged_with_other_workers(self):
+        """Test saving keeps the tables another worker saved"""
+        other = ("Europe/Paris", int(self.now // server.DST_CHUNK_SECONDS))
+        server.get_dst_transitions(ZoneInfo(other[0]), other[1])
+        server.save_snapshot(self.path, self.now)
+        self.forget()
+
+        server.get_dst_transitions(ZoneInfo("Asia/Tokyo"), other[1])
+        server.save_snapshot(self.path, self.now)
+
+        saved = snapshot.read(self.path)
+        self.assertIn(other, saved.dst_tables)
+        self.assertIn(("Asia/Tokyo", other[1]), saved.dst_tables)
+        self.assertIn(self.key, saved.timelines)
+
+    def test_dst_tables_bounded(self):
+        """Test only the most recently used DST tables are kept"""
+        self.forget()
+        self.addCleanup(self.forget)
+        chunk = int(self.now // server.DST_CHUNK_SECONDS)
+        zones = ["Europe/Paris", "Asia/Tokyo", "Australia/Sydney"]
+
+        with mock.patch.object(server, "DST_TABLES_SIZE", 2):
+            for zone in zones:
+                server.get_dst_transitions(ZoneInfo(zone), chunk)
+
+        self.assertEqual(list(server.DST_TABLES), [(zone, chunk) for zone in zones[1:]])
+
+
+class TestRestart(unittest.TestCase):
+    """Test a restarted process starts with what the last one computed"""
+
+    def run_worker(self, path):
+        env = dict(os.environ, SNAPSHOT_FILE=path, ALMANAC_WARMER_INTERVAL="0")
+        env.pop("SHARED_CACHE", None)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", WORKER_SCRIPT],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return json.loads(output.splitlines()[-1])
+
+    def test_workers_exiting_together(self):
+        """Test workers saving at the same time all keep their tables"""
+        zones = ["Europe/Paris", "Asia/Tokyo", "Australia/Sydney", "America/Denver"]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.bin")
+            env = dict(os.environ, ALMANAC_WARMER_INTERVAL="0", SERVICE_PROFILE="time")
+            env.pop("SHARED_CACHE", None)
+            env.pop("SNAPSHOT_FILE", None)
+            env["PYTHONPATH"] = os.pathsep.join(
+                [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")]
+            )
+            start = str(time.time() + 3)
+            workers = [
+                subprocess.Popen(
+                    [sys.executable, "-c", SAVING_SCRIPT, path, zone, start], env=env
+                )
+                for zone in zones
+            ]
+            for worker in workers:
+                self.assertEqual(worker.wait(timeout=120), 0)
+
+            saved = snapshot.read(path)
+
+        self.assertEqual({zone for zone, _ in saved.dst_tables}, set(zones))
+
+    def test_warm_start(self):
+        """Test the second process searches, scans and builds nothing"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.bin")
+            first = self.run_worker(path)
+            second = self.run_worker(path)
+
+        self.assertEqual(first["searches"], 2)
+        self.assertGreater(first["scans"], 0)
+        self.assertEqual(first["moon_phase_builds"], 1)
+        self.assertEqual(
+            (second["searches"], second["scans"], second["moon_phase_builds"]),
+            (0, 0, 0),
+        )
+        self.assertEqual(second["almanac"], first["almanac"])
+
+
+if __name__ == "__main__":
+    unittest.main()
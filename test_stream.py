@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Test the Server-Sent Events stream of time and MOTD updates"""
+
+import asyncio
+import json
+import tracemalloc
+import unittest
+from zoneinfo import ZoneInfo
+
+import stream
+
+HEADERS = {"X-Timezone": "America/New_York", "X-Location": "40.7,-74.0"}
+
+# 2025-03-09 02:00 EST, when New York springs forward
+NEW_YORK_SPRING_FORWARD = 1741503600
+
+
+class Device:
+    """A device reading /stream, through stream.serve()"""
+
+    def __init__(self, hub, headers):
+        self.status = None
+        self.events = []
+        self.received = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        scope = {
+            "type": "http",
+            "path": "/stream",
+            "headers": [
+                (name.lower().encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+        self.task = asyncio.create_task(
+            stream.serve(hub, scope, self.receive, self.send)
+        )
+
+    async def receive(self):
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+            return
+        body = message["body"]
+        if body.startswith(b"event: "):
+            event, data = body.decode().strip().split("\n")
+            self.events.append((event[len("event: ") :], json.loads(data[6:])))
+            self.received.set()
+
+    async def wait_for(self, event, count=1):
+        """Wait until ``count`` events of the given type have arrived"""
+        while sum(name == event for name, _ in self.events) < count:
+            self.received.clear()
+            await asyncio.wait_for(self.received.wait(), 5)
+
+    async def disconnect(self):
+        self.disconnected.set()
+        await self.task
+
+
+class StreamTestCase(unittest.IsolatedAsyncioTestCase):
+    """Runs each test with a hub computing almanacs in-process"""
+
+    async def asyncSetUp(self):
+        async def compute(timezone, location):
+            return stream.compute_almanac(timezone, location)
+
+        self.hub = stream.StreamHub(compute, motd_interval=60, keepalive_interval=60)
+
+    async def asyncTearDown(self):
+        self.hub.close()
+
+
+class TestStream(StreamTestCase):
+    """Test channels are shared, pushed to and closed"""
+
+    async def test_event_format(self):
+        """Test each update is a named SSE event with a JSON payload"""
+        self.assertEqual(
+            stream.format_event("motd", ["Hello", 255]),
+            b'event: motd\ndata: ["Hello",255]\n\n',
+        )
+
+    async def test_devices_share_channel(self):
+        """Test devices in one grid cell share one almanac computation"""
+        devices = [
+            Device(self.hub, {**HEADERS, "X-Location": "40.70%d,-74.0" % i})
+            for i in range(50)
+        ]
+        for device in devices:
+            await device.wait_for("time")
+            await device.wait_for("motd")
+
+        self.assertEqual(len(self.hub.channels), 1)
+        self.assertEqual(self.hub.computations, 1)
+        for device in devices:
+            self.assertEqual(device.status, 200)
+            time_fields = dict(device.events)["time"]
+            self.assertEqual(len(time_fields), 4)
+            self.assertIn(time_fields[1], (-5 * 3600, -4 * 3600))
+
+        for device in devices:
+            await device.disconnect()
+        self.assertEqual(self.hub.channels, {})
+
+    async def test_late_device_gets_last_motd(self):
+        """Test a device joining a channel is sent its current MOTD at once"""
+        first = Device(self.hub, HEADERS)
+        await first.wait_for("motd")
+
+        second = Device(self.hub, HEADERS)
+        await second.wait_for("motd")
+
+        self.assertEqual(dict(second.events)["motd"], dict(first.events)["motd"])
+        self.assertEqual(self.hub.computations, 1)
+        await first.disconnect()
+        await second.disconnect()
+
+    async def test_separate_channels(self):
+        """Test other timezones and locations get their own channel"""
+        devices = [
+            Device(self.hub, HEADERS),
+            Device(self.hub, {**HEADERS, "X-Timezone": "Europe/London"}),
+            Device(self.hub, {**HEADERS, "X-Location": "51.5,-0.1"}),
+        ]
+        for device in devices:
+            await device.wait_for("motd")
+
+        self.assertEqual(len(self.hub.channels), 3)
+        await devices[0].disconnect()
+        self.assertEqual(len(self.hub.channels), 2)
+        for device in devices[1:]:
+            await device.disconnect()
+        self.assertEqual(self.hub.channels, {})
+
+    async def test_drift_push(self):
+        """Test the time is pushed again every time interval"""
+        self.hub.time_interval = 0.05
+        device = Device(self.hub, {"X-Timezone": "UTC"})
+
+        await device.wait_for("time", count=3)
+        await device.disconnect()
+
+    async def test_motd_rotation(self):
+        """Test the MOTD rotates through the almanac and a message"""
+        self.hub.motd_interval = 0.01
+        device = Device(self.hub, HEADERS)
+
+        await device.wait_for("motd", count=16)
+        await device.disconnect()
+
+        texts = {tuple(data) for event, data in device.events if event == "motd"}
+        self.assertEqual(len(texts), 8)
+        self.assertEqual(self.hub.computations, 1)
+
+    async def test_invalid_headers(self):
+        """Test unknown timezones are a 404 and malformed locations a 400"""
+        bad_timezone = Device(self.hub, {"X-Timezone": "Not/AZone"})
+        bad_location = Device(self.hub, {**HEADERS, "X-Location": "north"})
+        await bad_timezone.task
+        await bad_location.task
+
+        self.assertEqual(bad_timezone.status, 404)
+        self.assertEqual(bad_location.status, 400)
+        self.assertEqual(self.hub.channels, {})
+
+    async def test_idle_devices_memory(self):
+        """Test thousands of idle devices on one channel stay cheap"""
+        # Debug mode, on in these tests, keeps a traceback for every task
+        asyncio.get_running_loop().set_debug(False)
+        first = Device(self.hub, HEADERS)
+        await first.wait_for("motd")
+
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            devices = [Device(self.hub, HEADERS) for _ in range(2000)]
+            await devices[-1].wait_for("motd")
+            after, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(self.hub.computations, 1)
+        self.assertLess((after - before) / len(devices), 16 * 1024)
+        for device in [first, *devices]:
+            device.disconnected.set()
+        await asyncio.gather(first.task, *(device.task for device in devices))
+        self.assertEqual(self.hub.channels, {})
+
+
+class TestNextTimePush(unittest.TestCase):
+    """Test when the time is next pushed"""
+
+    def test_dst_transition(self):
+        """Test the time is pushed at a DST transition within the interval"""
+        tzinfo = ZoneInfo("America/New_York")
+
+        self.assertEqual(
+            stream.next_time_push(tzinfo, NEW_YORK_SPRING_FORWARD - 60, 3600),
+            NEW_YORK_SPRING_FORWARD,
+        )
+
+    def test_interval(self):
+        """Test the time is pushed an interval on, with no transition near"""
+        now = NEW_YORK_SPRING_FORWARD - 7200
+
+        self.assertEqual(
+            stream.next_time_push(ZoneInfo("America/New_York"), now, 3600),
+            now + 3600,
+        )
+        self.assertEqual(stream.next_time_push(ZoneInfo("UTC"), now, 3600), now + 3600)
+
+
+if __name__ == "__main__":
+    unittest.main()
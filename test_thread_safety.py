@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Test requests served by many threads at once, as gunicorn's gthread
+workers serve them, match the same requests served one at a time"""
+
+import os
+import random
+import threading
+import time
+import unittest
+
+import app as server
+from app import load_once
+
+LOCATIONS = [
+    ("America/New_York", "40.7,-74.0"),
+    ("Europe/London", "51.5,-0.1"),
+    ("Asia/Tokyo", "35.7,139.7"),
+    ("Australia/Sydney", "-33.9,151.2"),
+    ("America/Sao_Paulo", "-23.5,-46.6"),
+    ("Europe/Oslo", "59.9,10.7"),
+]
+THREADS = 8
+ROUNDS = 3
+
+# Shortly before the US spring-forward transition, 2025-03-09 07:00 UTC, so
+# /time reports an upcoming change
+CURRENT_TIME = "1741500000"
+
+
+def headers(timezone, location):
+    return {"X-Timezone": timezone, "X-Location": location}
+
+
+class TestLoadOnce(unittest.TestCase):
+    """Test threads asking for a lazy load at once share one"""
+
+    def test_loaded_once(self):
+        """Test the loader runs once and every thread gets its result"""
+        calls = []
+
+        @load_once
+        def load():
+            calls.append(1)
+            time.sleep(0.2)
+            return object()
+
+        results = []
+        barrier = threading.Barrier(THREADS)
+
+        def call():
+            barrier.wait()
+            results.append(load())
+
+        threads = [threading.Thread(target=call) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+
+class TestParallelRequests(unittest.TestCase):
+    """Test /time, /almanac and /motd from many threads at once"""
+
+    def setUp(self):
+        """Fix the time /time reports"""
+        self.original_time = os.environ.get("OVERRIDE_CURRENT_TIME")
+        os.environ["OVERRIDE_CURRENT_TIME"] = CURRENT_TIME
+        self.client = server.app.test_client()
+
+    def tearDown(self):
+        if self.original_time is None:
+            del os.environ["OVERRIDE_CURRENT_TIME"]
+        else:
+            os.environ["OVERRIDE_CURRENT_TIME"] = self.original_time
+
+    def forget(self):
+        """Empty the caches, so the threads search and scan concurrently"""
+        server.ALMANAC_CACHE.clear()
+        server.DST_TABLES.clear()
+        server.get_dst_transitions.cache_clear()
+
+    def serial(self, path):
+        """Each location's response, requested one at a time"""
+        return {
+            location: self.client.get(path, headers=headers(*location)).get_json()
+            for location in LOCATIONS
+        }
+
+    def test_matches_serial(self):
+        """Test threaded responses match serial ones"""
+        expected_time = self.serial("/time")
+        # An event passing mid-test changes the almanac, so accept the almanac
+        # from just before or just after
+        almanac_before = self.serial("/almanac")
+        self.forget()
+
+        responses = []
+        errors = []
+        barrier = threading.Barrier(THREADS)
+
+        def run(seed):
+            client = server.app.test_client()
+            order = LOCATIONS * ROUNDS
+            random.Random(seed).shuffle(order)
+            barrier.wait()
+            try:
+                for location in order:
+                    for path in ("/almanac", "/motd", "/time"):
+                        response = client.get(path, headers=headers(*location))
+                        responses.append((location, path, response.get_json()))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        almanac_after = self.serial("/almanac")
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(responses), THREADS * ROUNDS * len(LOCATIONS) * 3)
+        for location, path, body in responses:
+            if path == "/time":
+                self.assertEqual(body, expected_time[location], location)
+            elif path == "/almanac":
+                self.assertIn(
+                    body, (almanac_before[location], almanac_after[location]), location
+                )
+            else:
+                items = almanac_before[location] + almanac_after[location]
+                text, color = body
+                self.assertTrue(
+                    [text, color] in items or text in server.MOTD_OPTIONS,
+                    (location, body),
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
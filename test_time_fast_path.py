@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Test the WSGI fast path for /time answers exactly as Flask does"""
+
+import os
+import unittest
+from unittest import mock
+
+from prometheus_client import REGISTRY
+from werkzeug.test import Client
+
+import app as server
+from app import TimeFastPath
+
+ZONES = ["America/New_York", "Europe/London", "Asia/Kolkata", "UTC"]
+
+# Shortly before the US spring-forward transition, 2025-03-09 07:00 UTC, so
+# New York's response includes the upcoming change
+CURRENT_TIME = "1741500000"
+
+
+def served_time_requests():
+    return (
+        REGISTRY.get_sample_value(
+            "matrix_portal_requests_total", {"endpoint": "/time", "status": "200"}
+        )
+        or 0
+    )
+
+
+class TestTimeFastPath(unittest.TestCase):
+    """Test plain /time requests skip Flask and the rest reach it"""
+
+    def setUp(self):
+        """Wrap the Flask app, counting the requests that reach it"""
+        patcher = mock.patch.dict(os.environ, {"OVERRIDE_CURRENT_TIME": CURRENT_TIME})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.flask_requests = 0
+
+        def flask_app(environ, start_response):
+            self.flask_requests += 1
+            return server.app.wsgi_app(environ, start_response)
+
+        self.fast = Client(TimeFastPath(flask_app))
+        self.flask = server.app.test_client()
+
+    def assertSameResponse(self, path, headers):
+        expected = self.flask.get(path, headers=headers)
+        response = self.fast.get(path, headers=headers)
+
+        self.assertEqual(response.status, expected.status)
+        self.assertEqual(list(response.headers), list(expected.headers))
+        self.assertEqual(response.get_data(), expected.get_data())
+
+    def test_same_response(self):
+        """Test the body and headers match Flask's, bypassing it"""
+        for zone in ZONES:
+            with self.subTest(zone=zone):
+                self.assertSameResponse("/time", {"X-Timezone": zone})
+        self.assertSameResponse("/time", {})
+        self.assertSameResponse("/time", {"X-Timezone": "UTC", "Accept": "*/*"})
+
+        self.assertEqual(self.flask_requests, 0)
+
+    def test_passed_to_flask(self):
+        """Test requests the fast path doesn't handle get Flask's response"""
+        cases = [
+            ("/time?fmt=bin", {"X-Timezone": "America/New_York"}),
+            ("/time?horizon=30", {"X-Timezone": "America/New_York"}),
+            ("/time", {"Accept": "application/octet-stream"}),
+            ("/time", {"X-Timezone": "Not/AZone"}),
+            ("/time", {"X-Timezone": ""}),
+            ("/time/", {}),
+            ("/timezone", {}),
+        ]
+        for path, headers in cases:
+            with self.subTest(path=path, headers=headers):
+                before = self.flask_requests
+                self.assertSameResponse(path, headers)
+                self.assertEqual(self.flask_requests, before + 1)
+
+        self.fast.post("/time")
+        self.assertEqual(self.flask_requests, len(cases) + 1)
+
+    def test_unknown_zone(self):
+        """Test an unknown zone is still a 404 with the CORS and cache headers"""
+        response = self.fast.get("/time", headers={"X-Timezone": "Not/AZone"})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers["Access-Control-Allow-Origin"], "*")
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+
+    def test_device_request(self):
+        """Test requests with X-Device-Id go to Flask, for the registry"""
+        self.fast.get("/time", headers={"X-Device-Id": "device-1"})
+
+        self.assertEqual(self.flask_requests, 1)
+
+    def test_counted(self):
+        """Test fast path requests are counted in the request metrics"""
+        before = served_time_requests()
+
+        self.fast.get("/time", headers={"X-Timezone": "Europe/London"})
+
+        self.assertEqual(served_time_requests() - before, 1)
+        self.assertEqual(self.flask_requests, 0)
+
+    def test_zones_cached(self):
+        """Test each zone is looked up once"""
+        fast_path = self.fast.application
+        with mock.patch.object(server, "ZoneInfo", wraps=server.ZoneInfo) as zone_info:
+            for _ in range(3):
+                self.fast.get("/time", headers={"X-Timezone": "Asia/Tokyo"})
+
+        self.assertEqual(zone_info.call_count, 1)
+        self.assertIn("Asia/Tokyo", fast_path.zones)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Test the trimmed ephemeris gives the same results as the full one"""
+
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from skyfield.api import load_file
+
+from app import EPH, AstronomyContext, SkyfieldEngine, get_ephemeris_version
+from trim_ephemeris import trim_ephemeris
+
+
+class TestTrimmedEphemeris(unittest.TestCase):
+    """Compare the skyfield engine on the full and trimmed ephemeris"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Write a trimmed ephemeris covering the next year"""
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.today = datetime.datetime.now(datetime.UTC)
+        path = os.path.join(cls.directory.name, "trimmed.bsp")
+        trim_ephemeris(
+            EPH.path,
+            path,
+            cls.today - datetime.timedelta(days=30),
+            cls.today + datetime.timedelta(days=365),
+        )
+        cls.trimmed = load_file(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove the trimmed ephemeris"""
+        cls.trimmed.close()
+        cls.directory.cleanup()
+
+    def test_only_needed_segments(self):
+        """The trimmed ephemeris only holds the segments the server needs"""
+        targets = sorted(segment.target for segment in self.trimmed.segments)
+
+        self.assertEqual(targets, [3, 5, 6, 10, 301, 399])
+
+    def test_same_snapshot_version(self):
+        """The trimmed ephemeris keeps the full one's snapshot version, so
+        rebuilding it for other dates keeps the saved almanac tables"""
+        path = os.path.join(self.directory.name, "trimmed.bsp")
+        versions = []
+        for ephemeris in (EPH.path, path):
+            with mock.patch.dict(os.environ, {"EPHEMERIS_FILE": ephemeris}):
+                get_ephemeris_version.cache_clear()
+                versions.append(get_ephemeris_version())
+        get_ephemeris_version.cache_clear()
+
+        self.assertEqual(versions, ["DE-0421LE-0421"] * 2)
+
+    def test_same_event_times(self):
+        """Rise/set events and moon phase match the full ephemeris"""
+        full = SkyfieldEngine(EPH)
+        trimmed = SkyfieldEngine(self.trimmed)
+
+        for days in (0, 45, 130, 300):
+            now = self.today + datetime.timedelta(days=days)
+            for location in ((40.725, -74.025), (-33.875, 151.225), (64.125, -21.925)):
+                astronomy = AstronomyContext.at(location, now)
+                for body in ("sun", "moon"):
+                    with self.subTest(now=now, location=location, body=body):
+                        self.assertEqual(
+                            trimmed.body_events(body, astronomy),
+                            full.body_events(body, astronomy),
+                        )
+
+            with self.subTest(now=now):
+                self.assertEqual(
+                    trimmed.moon_phase([now.timestamp()]),
+                    full.moon_phase([now.timestamp()]),
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
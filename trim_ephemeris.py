@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Write a date-limited excerpt of an ephemeris with only the segments the
+server uses"""
+
+import argparse
+import datetime
+
+from jplephem.commandline import main as jplephem_main
+
+# Earth-Moon barycenter, Sun, Moon and Earth, plus the Jupiter and Saturn
+# barycenters skyfield needs for light deflection in apparent positions
+TARGETS = "3,5,6,10,301,399"
+
+
+def trim_ephemeris(
+    input_path: str, output_path: str, start: datetime.date, end: datetime.date
+) -> str:
+    """Write the segments the server needs of ``input_path`` between
+    ``start`` and ``end`` to ``output_path``, returning jplephem's report."""
+    return jplephem_main(
+        [
+            "excerpt",
+            "--targets",
+            TARGETS,
+            start.strftime("%Y/%m/%d"),
+            end.strftime("%Y/%m/%d"),
+            input_path,
+            output_path,
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_path", help="Full ephemeris, e.g. de421.bsp")
+    parser.add_argument("output_path", help="Trimmed ephemeris to write")
+    parser.add_argument(
+        "--years",
+        type=int,
+        default=10,
+        help="Years from today the trimmed ephemeris covers (default: 10)",
+    )
+    args = parser.parse_args()
+
+    # Start a little in the past, since searches begin slightly before now
+    today = datetime.date.today()
+    print(
+        trim_ephemeris(
+            args.input_path,
+            args.output_path,
+            today - datetime.timedelta(days=30),
+            today + datetime.timedelta(days=365 * args.years),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()